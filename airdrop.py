@@ -1,35 +1,92 @@
 #!/usr/bin/env python
 
 import sys
+import csv
 import json
-from web3 import Web3
-from web3.exceptions import ContractLogicError, BadFunctionCallOutput
-from peewee import fn
+import time
+import heapq
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from decimal import Decimal, InvalidOperation
+from peewee import fn, Case, JOIN
 from peewee import OperationalError
 
 from models import (
     db,
+    create_triggers,
+    schema_version,
+    set_schema_version,
+    upgrade_schema,
+    SCHEMA_VERSION,
     Recipient,
     Config,
+    Sender,
     Tx,
 )
 
-from pretty_table import print_pretty_table
+import metrics
+from pretty_table import print_pretty_table, print_table_rows
+from transactions import (
+    APPROVE_GAS,
+    TRANSFER_GAS,
+    TRANSFER_TOPIC,
+    address_topic,
+    build_call,
+    build_transfer,
+    call_params,
+    decode_transfer_log,
+    disperse_batch_size,
+    disperse_gas,
+    encode_approve,
+    encode_balance_of,
+    encode_disperse,
+    is_checksum_address,
+    keccak,
+    sign_chunks,
+    to_checksum_address,
+    to_token_units,
+    transfer_call,
+    transfer_template,
+)
+
+# web3 and rpc (requests, web3) take most of the startup time, so they are
+# imported only by commands that talk to the node
 
 
 def send_raw_tx(web3_endpoint, signed_tx):
-    w3 = Web3(Web3.HTTPProvider(web3_endpoint, request_kwargs={"timeout": 20}))
+    from rpc import get_web3
+
+    w3 = get_web3(web3_endpoint)
     return w3.eth.send_raw_transaction(signed_tx)
 
 
+# seconds to wait for a receipt of a sent tx
+RECEIPT_TIMEOUT = 120
+# receipts per batch request and seconds between polls of 'receipt --all' and 'send --all --bump-after'
+RECEIPT_BATCH = 100
+RECEIPT_POLL_INTERVAL = 5
+
+
 def get_tx_receipt(web3_endpoint, tx_hash):
-    w3 = Web3(Web3.HTTPProvider(web3_endpoint, request_kwargs={"timeout": 20}))
-    return w3.eth.wait_for_transaction_receipt(tx_hash)
+    """Waits for the receipt: with a newHeads subscription the tx is looked for in new blocks, else polled."""
+    from web3.exceptions import TransactionNotFound
+    from heads import get_watcher
+    from rpc import get_web3
+
+    w3 = get_web3(web3_endpoint)
+    watcher = get_watcher(web3_endpoint)
+    if watcher is not None and watcher.wait_included(bytes(tx_hash), RECEIPT_TIMEOUT) is not None:
+        try:
+            return w3.eth.get_transaction_receipt(tx_hash)
+        except TransactionNotFound:
+            pass
+    return w3.eth.wait_for_transaction_receipt(tx_hash, RECEIPT_TIMEOUT)
 
 
 def initialize():
     db.connect()
-    db.create_tables([Config, Recipient, Tx])
+    db.create_tables([Config, Sender, Recipient, Tx])
+    create_triggers()
+    set_schema_version(SCHEMA_VERSION)
     Config.create(address="0x0000000000000000000000000000000000000000",
                   private_key="0000000000000000000000000000000000000000000000000000000000000000",
                   gas_price=10000000000,
@@ -39,9 +96,11 @@ def initialize():
 
 
 def import_key():
+    from rpc import get_web3
+
     private_key = input("Paste your private key in hex format: ")
 
-    w3 = Web3(Web3.HTTPProvider(Config.get(1).web3_node, request_kwargs={"timeout": 20}))
+    w3 = get_web3(Config.get(1).web3_node)
     address = w3.eth.account.from_key(private_key).address
     config = Config.get(1)
     config.address = address
@@ -50,8 +109,32 @@ def import_key():
     print(f'Sender address: {address}')
 
 
+def add_sender():
+    """Imports one more sender account, recipients are shared between all senders."""
+    from rpc import get_web3
+
+    private_key = input("Paste private key of additional sender in hex format: ")
+
+    w3 = get_web3(Config.get(1).web3_node)
+    address = w3.eth.account.from_key(private_key).address
+    if address == Config.get(1).address or Sender.select().where(Sender.address == address).exists():
+        print(f'Sender {address} is already added.')
+        return
+    Sender.create(address=address, private_key=private_key)
+    print(f'Sender address: {address}, {Sender.select().count() + 1} senders in total.')
+
+
+def senders():
+    """Sender lanes: None for the Config account, then additional Sender rows."""
+    return [None] + list(Sender.select().order_by(Sender.id))
+
+
+def sender_filter(sender):
+    return Tx.sender.is_null() if sender is None else Tx.sender == sender.id
+
+
 def set_token(token_address):
-    if not Web3.isChecksumAddress(token_address):
+    if not is_checksum_address(token_address):
         print('Wrong token address. Try again.')
         return
 
@@ -61,55 +144,198 @@ def set_token(token_address):
     print(f"Now token for airdrop is {token_address}")
 
 
-def set_node_address(node_address):
-    try:
-        w3 = Web3(Web3.HTTPProvider(node_address, request_kwargs={"timeout": 20}))
-        assert w3.isConnected() == True
-    except AssertionError:
+def set_disperse(disperse_address):
+    if not is_checksum_address(disperse_address):
+        print('Wrong disperse contract address. Try again.')
+        return
+
+    config = Config.get(1)
+    config.disperse = disperse_address
+    config.save()
+    print(f"Now disperse contract is {disperse_address}")
+
+
+def migrate_db():
+    before, after = upgrade_schema()
+    if before == after:
+        print(f'Db is up to date, version {after}.')
+    else:
+        print(f'Db was upgraded from version {before} to {after}.')
+
+
+def set_node_address(*node_addresses):
+    """
+    Accepts one or several endpoints, the pool fails over between them.
+    A WebSocket or IPC endpoint adds a newHeads subscription to HTTP ones.
+    """
+    from rpc import get_web3, is_push_endpoint, parse_endpoints
+
+    endpoints = parse_endpoints(" ".join(str(address) for address in node_addresses))
+    if endpoints and all(is_push_endpoint(endpoint) for endpoint in endpoints):
+        print('WebSocket and IPC endpoints only carry the newHeads subscription. Add an HTTP endpoint too.')
+        return
+    for endpoint in endpoints:
+        if is_push_endpoint(endpoint):
+            from heads import check_subscription
+
+            if not check_subscription(endpoint):
+                print(f'No newHeads subscription on {endpoint}. Try again.')
+                return
+            continue
+        try:
+            w3 = get_web3(endpoint)
+            assert w3.isConnected() == True
+        except (AssertionError, ValueError):
+            print(f'Wrong node URL or connection error: {endpoint}. Try again.')
+            return
+    if not endpoints:
         print('Wrong node URL or connection error. Try again.')
         return
     config = Config.get(1)
-    config.web3_node = node_address
+    config.web3_node = ",".join(endpoints)
     config.save()
-    print(f'New node address: {node_address}')
+    print(f'New node address: {config.web3_node}')
+
+
+REBASE_CHUNK = 500
+
+
+def rebase_nonces(config, workers=1, sender=None):
+    """
+    Gives SIGNED txs of the sender consecutive nonces right after its account nonce and
+    pending SENT txs. Only the range from the first wrong nonce on is re-signed, all in
+    one transaction. Returns number of re-signed txs.
+    """
+    account = sender or config
+    base = account.current_nonce
+    last_sent = (Tx.select(fn.MAX(Tx.nonce))
+                 .where(Tx.status.in_(['SENT', 'BROADCASTING']), Tx.parent.is_null(), sender_filter(sender))
+                 .scalar())
+    if last_sent is not None and last_sent >= base:
+        base = last_sent + 1
+
+    queue = list(Tx.select(Tx.id, Tx.nonce)
+                 .where(Tx.status == 'SIGNED', Tx.parent.is_null(), sender_filter(sender))
+                 .order_by(Tx.nonce, Tx.id)
+                 .tuples())
+    start = next((i for i, (_, nonce) in enumerate(queue) if nonce != base + i), None)
+    if start is None:
+        return 0
+    affected = queue[start:]
+
+    def chunks():
+        for offset in range(0, len(affected), REBASE_CHUNK):
+            part = [tx_id for tx_id, _ in affected[offset:offset + REBASE_CHUNK]]
+            raw_txs = dict(Tx.select(Tx.id, Tx.raw_tx).where(Tx.id.in_(part)).tuples())
+            items = []
+            for nonce, tx_id in enumerate(part, start=base + start + offset):
+                raw_tx = raw_txs[tx_id]
+                raw_tx['nonce'] = nonce
+                items.append((tx_id, raw_tx))
+            yield items
+
+    done = 0
+    with db.atomic():
+        for signed in sign_chunks(account.private_key, chunks(), workers):
+            save_signed(signed)
+            done += len(signed)
+            print(f"\rRe-signed {done}/{len(affected)} txs of {account.address} from nonce {base + start}",
+                  end="")
+    print()
+    return done
+
 
+def show_nodes(probes=5):
+    """Probes every configured endpoint and prints pool statistics."""
+    from rpc import get_pool, get_web3
 
-def update_data():
     config = Config.get(1)
-    # balances
-    w3 = Web3(Web3.HTTPProvider(config.web3_node, request_kwargs={"timeout": 20}))
-    config.eth_balance = w3.eth.get_balance(config.address)
-    with open("tokens_abi/ERC20.abi", "r") as file:
-        erc20_abi = json.load(file)
+    pool = get_pool(config.web3_node)
+    for _ in range(int(probes)):
+        try:
+            get_web3(config.web3_node).eth.block_number
+        except (IOError, ValueError) as e:
+            print(f'Request failed: {e}')
+
+    # Rate is the client-side limit of requests per second, None until the endpoint throttled us
+    header = [['Endpoint', 'Requests', 'Errors', 'Connections', 'Latency, ms', 'Health',
+               'Rate', 'Concurrency', 'Throttled']]
+    values = [[str(stat[key]) for key in ('url', 'requests', 'errors', 'connections', 'latency_ms', 'health',
+                                          'rate', 'concurrency', 'throttled')]
+              for stat in pool.stats()]
+    print_pretty_table(header + values)
+
+    from heads import get_watcher
+    watcher = get_watcher(config.web3_node)
+    if watcher is not None:
+        print(f"newHeads subscription on {watcher.url}: {'up' if watcher.alive else 'down, receipts are polled'}, "
+              f"head {watcher.head}.")
 
-    token_contract = w3.eth.contract(address=Web3.toChecksumAddress(config.token), abi=erc20_abi)
+
+def show_stats(format='table'):
+    """Summary of the trace left by the last command that called the node, signed or wrote txs."""
     try:
-        config.token_balance = token_contract.functions.balanceOf(config.address).call()
-    except BadFunctionCallOutput:
-        print("Error. Can't update token address. Check token address.")
+        with open(metrics.TRACE_FILE) as file:
+            header, rows = metrics.summarize(file)
+    except FileNotFoundError:
+        print('No stats yet. They are saved by commands that call the node, sign or write txs.')
+        return
+    if format == 'json':
+        print(json.dumps({'run': header, 'stats': rows}, indent=2))
         return
 
-    # nonce
-    config.current_nonce = w3.eth.get_transaction_count(config.address)
-    config.save()
+    print(f"Last run: '{header['command']}' started at "
+          f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(header['started']))}, {header['seconds']:.2f} s")
+    data = [['Kind', 'Name', 'Count', 'Items', 'Total, ms', 'p50, ms', 'p95, ms', 'p99, ms', 'Max, ms', 'Errors']]
+    for row in rows:
+        errors = ', '.join(f'{code}: {count}' for code, count in sorted(row['errors'].items()))
+        data.append([row['kind'], row['name']] + [str(row[key]) for key in (
+            'count', 'items', 'total_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')] + [errors])
+    print_pretty_table(data)
 
-    # update tx nonces
-    txs = Tx.select().where(Tx.status == "SIGNED").order_by(Tx.nonce)
-    if txs and (txs[0].nonce != config.current_nonce):
-        nonce = config.current_nonce
-        for tx in txs:
-            tx.nonce = nonce
-            updated_raw_tx = json.loads(tx.raw_tx.replace("\'", "\""))
-            updated_raw_tx['nonce'] = nonce
-            tx.raw_tx = updated_raw_tx
-            tx.signed_tx = w3.eth.account.sign_transaction(updated_raw_tx,
-                                                           config.private_key).rawTransaction            
-            tx.save()
-            nonce += 1
+
+def update_data(workers=1):
+    from rpc import BatchClient, RPCError
+
+    config = Config.get(1)
+    token = to_checksum_address(config.token)
+    lanes = senders()
+    # balances and nonces of all senders in one batch
+    client = BatchClient(config.web3_node)
+    for sender in lanes:
+        address = (sender or config).address
+        client.add('eth_getBalance', [address, 'latest'])
+        client.add('eth_call', [{'to': token, 'data': encode_balance_of(address)}, 'latest'])
+        client.add('eth_getTransactionCount', [address, 'latest'])
+    results = client.execute()
+
+    token_balance = results[1]
+    if isinstance(token_balance, RPCError) or not token_balance or token_balance == '0x':
+        print("Error. Can't update token address. Check token address.")
+        return
+    for result in results:
+        if isinstance(result, RPCError):
+            raise result
+
+    for i, sender in enumerate(lanes):
+        account = sender or config
+        eth_balance, token_balance, nonce = results[3 * i:3 * i + 3]
+        account.eth_balance = int(eth_balance, 16)
+        account.token_balance = int(token_balance, 16)
+        account.current_nonce = int(nonce, 16)
+        account.save()
+        rebase_nonces(config, int(workers), sender)
+        if len(lanes) > 1:
+            print(f'{account.address}: {account.eth_balance} Wei, {account.token_balance} token Wei, '
+                  f'nonce {account.current_nonce}')
     print('Balance and nonce have been updated.')
 
 
-def show():
+SHOW_PAGE_SIZE = 1000
+HASH_WIDTH = 64
+
+
+def show(status=None, limit=None, offset=0):
     config = Config.get(1)
     print(f"Sender address: {config.address}")
     print(f"Sender ETH balance: {config.eth_balance} Wei")
@@ -118,37 +344,225 @@ def show():
     print(f"Sender nonce: {config.current_nonce}")
     print(f"Web3 endpoint: {config.web3_node}")
     print(f"Gas Price: {config.gas_price}\n")
+    if Sender.select().exists():
+        show_senders(config)
+
+    try:
+        limit = optional_int(limit)
+        offset = int(offset)
+    except ValueError:
+        print('Wrong limit or offset. Try again.')
+        return
 
     print(f"Recipients:")
-    token_sum = Recipient.select(fn.SUM(Recipient.amount))[0].amount
-    recipients = Recipient.select()
+    rows = (Recipient
+            .select(Recipient.id, Recipient.address, Recipient.amount, Tx.nonce, Tx.status, Tx.tx_hash)
+            .join(Tx, on=(Tx.recipient == Recipient.id)))
+    if status is not None:
+        rows = rows.where(Tx.status == status.upper())
+
+    # widths come from the db, values are never all loaded. SQLite renders amounts
+    # as floats (1e+20), so their width is taken from the same str() the rows print
+    nonce_width = rows.select(fn.MAX(fn.LENGTH(Tx.nonce))).scalar()
+    amount_width = max((len(str(amount)) for amount, in rows.select(Recipient.amount).tuples().iterator()),
+                       default=0)
+    col_width = [42, amount_width, max(nonce_width or 0, len('None')),
+                 max(len(choice) for choice, _ in Tx.choices), HASH_WIDTH]
+
+    header = ['Address', 'Tokens', 'Nonce', 'Status', 'Tx Hash']
+    shown = print_table_rows(header, iter_show_rows(rows, limit, offset), col_width)
+
+    recipients, token_sum = Recipient.select(fn.COUNT(Recipient.id), fn.SUM(Recipient.amount)).tuples().get()
+    by_status = (Tx.select(Tx.status, fn.COUNT(Tx.id))
+                 .where(Tx.recipient.is_null(False))
+                 .group_by(Tx.status)
+                 .tuples())
+    print(f"\nShown {shown} rows.")
+    print(", ".join(f"{tx_status}: {count}" for tx_status, count in by_status))
+    print(f"Total {recipients} recipients, {token_sum} ERC-20 Tokens.\n")
+
+
+EXPORT_FORMATS = ('csv', 'jsonl', 'parquet')
+EXPORT_COLUMNS = ['address', 'amount', 'nonce', 'status', 'sender', 'tx_hash', 'block', 'gas_used']
+
+
+def receipt_value(key):
+    """Receipt field read by SQLite, txs without receipt give NULL."""
+    return Case(None, [(Tx.tx_receipt != '', fn.json_extract(Tx.tx_receipt, f'$.{key}').coerce(False))], None)
 
-    header = [['Address', 'Tokens', 'Nonce', 'Status', 'Tx Hash']]
-    values = [
-        [rec.address,
-         str(rec.amount),
-         str(rec.txes[0].nonce),
-         rec.txes[0].status,
-         rec.txes[0].tx_hash.hex()] for rec in recipients
-    ]
-    data_to_print = header + values
-    print_pretty_table(data_to_print)
 
-    print(f"\nTotal {len(recipients)} recipients, {token_sum} ERC-20 Tokens.\n")
+def iter_export_rows(config, status, nonce_from, nonce_to, chunk):
+    """
+    Yields chunks of export rows, each chunk is one keyset page after the last recipient id,
+    so memory doesn't depend on the number of rows. Amounts are in token units.
+    """
+    rows = (Recipient
+            .select(Recipient.id, Recipient.address, Recipient.amount, Tx.nonce, Tx.status, Sender.address,
+                    Tx.tx_hash, receipt_value('blockNumber'), receipt_value('gasUsed'))
+            .join(Tx, on=(Tx.recipient == Recipient.id))
+            .join(Sender, JOIN.LEFT_OUTER, on=(Tx.sender == Sender.id)))
+    if status is not None:
+        rows = rows.where(Tx.status == status.upper())
+    if nonce_from is not None:
+        rows = rows.where(Tx.nonce >= nonce_from)
+    if nonce_to is not None:
+        rows = rows.where(Tx.nonce <= nonce_to)
+
+    last_id = 0
+    while True:
+        page = list(rows.where(Recipient.id > last_id).order_by(Recipient.id).limit(chunk).tuples())
+        if not page:
+            return
+        yield [[address, to_token_units(amount), nonce, tx_status,
+                # txs of the Config account and disperse batches have no sender
+                sender or config.address if nonce is not None else None,
+                '0x' + bytes(tx_hash).hex() if tx_hash else None, block, gas_used]
+               for _, address, amount, nonce, tx_status, sender, tx_hash, block, gas_used in page]
+        last_id = page[-1][0]
+
+
+def write_csv(file, chunks):
+    writer = csv.writer(file)
+    writer.writerow(EXPORT_COLUMNS)
+    count = 0
+    for rows in chunks:
+        writer.writerows(['' if value is None else value for value in row] for row in rows)
+        count += len(rows)
+    return count
+
+
+def write_jsonl(file, chunks):
+    count = 0
+    for rows in chunks:
+        # token units don't fit into JSON numbers of most readers
+        file.writelines(json.dumps(dict(zip(EXPORT_COLUMNS, row[:1] + [str(row[1])] + row[2:]))) + '\n'
+                        for row in rows)
+        count += len(rows)
+    return count
+
+
+def write_parquet(path, chunks):
+    """One row group per chunk, columns are typed, amounts are decimal strings."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([('address', pa.string()), ('amount', pa.string()), ('nonce', pa.int64()),
+                        ('status', pa.string()), ('sender', pa.string()), ('tx_hash', pa.string()),
+                        ('block', pa.int64()), ('gas_used', pa.int64())])
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for rows in chunks:
+            columns = [list(column) for column in zip(*rows)]
+            columns[1] = [str(amount) for amount in columns[1]]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+            count += len(rows)
+    return count
+
+
+def export(file_path, format=None, status=None, nonce_from=None, nonce_to=None, chunk=5000):
+    """
+    Streams recipients with their tx results to CSV, JSONL or Parquet, one page of rows
+    at a time. Format is taken from the file extension unless given, '-' is stdout.
+    """
+    if format is None:
+        extension = file_path.rsplit('.', 1)[-1].lower()
+        format = extension if extension in EXPORT_FORMATS else 'csv'
+    try:
+        nonce_from = optional_int(nonce_from)
+        nonce_to = optional_int(nonce_to)
+        chunk = int(chunk)
+        assert chunk > 0 and format in EXPORT_FORMATS
+        assert status is None or status.upper() in [choice for choice, _ in Tx.choices]
+        assert format != 'parquet' or file_path != '-'
+    except (ValueError, AssertionError):
+        print('Wrong export options. Try again.')
+        return
+    if format == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            print('Parquet export needs pyarrow: pip install pyarrow')
+            return
+
+    started = time.perf_counter()
+    chunks = iter_export_rows(Config.get(1), status, nonce_from, nonce_to, chunk)
+    if format == 'parquet':
+        count = write_parquet(file_path, chunks)
+    else:
+        writer = write_csv if format == 'csv' else write_jsonl
+        if file_path == '-':
+            count = writer(sys.stdout, chunks)
+        else:
+            with open(file_path, 'w', newline='') as file:
+                count = writer(file, chunks)
+    elapsed = time.perf_counter() - started
+    # the summary doesn't mix with exported rows on stdout
+    print(f'Exported {count} rows to {file_path} in {elapsed:.2f} s.',
+          file=sys.stderr if file_path == '-' else sys.stdout)
+
+
+def show_senders(config):
+    """Balances, nonce and tx counts by status of every sender lane."""
+    progress = {}
+    for sender_id, tx_status, count in (Tx.select(Tx.sender, Tx.status, fn.COUNT(Tx.id))
+                                        .where(Tx.recipient.is_null(False))
+                                        .group_by(Tx.sender, Tx.status)
+                                        .tuples()):
+        progress.setdefault(sender_id, {})[tx_status] = count
+    statuses = [choice for choice, _ in Tx.choices]
+    data = [['Sender', 'ETH, Wei', 'Tokens, Wei', 'Nonce'] + statuses]
+    for sender in senders():
+        account = sender or config
+        counts = progress.get(sender.id if sender else None, {})
+        data.append([account.address, str(account.eth_balance), str(account.token_balance),
+                     str(account.current_nonce)] + [str(counts.get(status, 0)) for status in statuses])
+    print("Senders:")
+    print_pretty_table(data)
+    print()
+
+
+def iter_show_rows(rows, limit, offset):
+    """Yields table rows page by page, each page continues after the last recipient id."""
+    last_id = 0
+    if offset:
+        start = rows.select(Recipient.id).order_by(Recipient.id).offset(offset - 1).limit(1).scalar()
+        if start is None:
+            return
+        last_id = start
+    left = limit
+    while left is None or left > 0:
+        page_size = SHOW_PAGE_SIZE if left is None else min(SHOW_PAGE_SIZE, left)
+        page = list(rows.where(Recipient.id > last_id).order_by(Recipient.id).limit(page_size).tuples())
+        if not page:
+            return
+        for _, address, amount, nonce, tx_status, tx_hash in page:
+            yield [address, str(amount), str(nonce), tx_status, bytes(tx_hash).hex()]
+        last_id = page[-1][0]
+        if left is not None:
+            left -= len(page)
+
+
+def validate_amount(amount):
+    """Returns amount as Decimal. Raises ValueError with a message for user."""
+    try:
+        value = Decimal(str(amount))
+    except InvalidOperation:
+        raise ValueError('Wrong amount')
+    if not value.is_finite():
+        raise ValueError('Wrong amount')
+    if value * 10**18 < 1:
+        raise ValueError('Too less amount')
+    return value
 
 
 def add_recepient(recipient_address, amount):
-    if not Web3.isChecksumAddress(recipient_address):
+    if not is_checksum_address(recipient_address):
         print('Wrong recipient address. Try again.')
         return
     try:
-        float(amount)
-        assert float(amount) * 10**18 >= 1
-    except ValueError:
-        print('Wrong amount')
-        return
-    except AssertionError:
-        print('Too less amount')
+        validate_amount(amount)
+    except ValueError as e:
+        print(e)
         return
 
     recipient = Recipient.create(address=recipient_address, amount=amount)
@@ -156,6 +570,178 @@ def add_recepient(recipient_address, amount):
     print(f"{recipient_address} was added with amount {amount}!")
 
 
+def read_csv_rows(file):
+    for line_no, row in enumerate(csv.reader(file), start=1):
+        if not row or row[0].startswith('#'):
+            continue
+        if line_no == 1 and row[0].strip().lower() == 'address':
+            # header
+            continue
+        if len(row) < 2:
+            yield line_no, row[0].strip(), ''
+            continue
+        yield line_no, row[0].strip(), row[1].strip()
+
+
+def read_jsonl_rows(file):
+    for line_no, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            yield line_no, item['address'], item['amount']
+        except (ValueError, KeyError, TypeError):
+            yield line_no, None, None
+
+
+def import_rows(rows, chunk_size, duplicates=None):
+    """
+    Writes validated (line_no, address, amount) rows as NEW recipients.
+    Every chunk goes in one transaction with a single multi-row INSERT per table.
+    With duplicates 'merge' or 'reject' imported rows repeating an address are
+    deduplicated afterwards, see dedupe_recipients.
+    """
+    started = time.perf_counter()
+    imported = rejected = 0
+    next_id = first_id = (Recipient.select(fn.MAX(Recipient.id)).scalar() or 0) + 1
+    chunk = []
+
+    def flush():
+        nonlocal next_id
+        with metrics.timer('db', 'import_chunk', len(chunk)), db.atomic():
+            Recipient.insert_many(
+                [{'id': next_id + i, 'address': address, 'amount': amount}
+                 for i, (address, amount) in enumerate(chunk)]).execute()
+            Tx.insert_many(
+                [{'recipient': next_id + i, 'status': 'NEW'}
+                 for i in range(len(chunk))]).execute()
+        next_id += len(chunk)
+        chunk.clear()
+
+    for line_no, address, amount in rows:
+        if not isinstance(address, str) or not is_checksum_address(address):
+            print(f'Line {line_no}: wrong recipient address, skipped.')
+            rejected += 1
+            continue
+        try:
+            amount = validate_amount(amount)
+        except ValueError as e:
+            print(f'Line {line_no}: {e}, skipped.')
+            rejected += 1
+            continue
+        chunk.append((address, amount))
+        imported += 1
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+
+    elapsed = time.perf_counter() - started
+    rate = imported / elapsed if elapsed else 0
+    print(f"Imported {imported} recipients, rejected {rejected} "
+          f"in {elapsed:.2f} s ({rate:.0f} rows/sec).")
+    if duplicates is not None:
+        report_dedupe(duplicates, dedupe_recipients(duplicates, first_id))
+
+
+def import_file(file_path, reader, chunk_size, duplicates=None):
+    try:
+        chunk_size = int(chunk_size)
+        assert chunk_size > 0 and duplicates in DEDUPE_MODES + (None,)
+    except (ValueError, AssertionError):
+        print('Wrong import options. Try again.')
+        return
+    if file_path == '-':
+        import_rows(reader(sys.stdin), chunk_size, duplicates)
+        return
+    try:
+        with open(file_path, 'r', newline='') as file:
+            import_rows(reader(file), chunk_size, duplicates)
+    except FileNotFoundError:
+        print(f'File {file_path} not found.')
+
+
+def import_csv(file_path, chunk=1000, duplicates=None):
+    import_file(file_path, read_csv_rows, chunk, duplicates)
+
+
+def import_jsonl(file_path, chunk=1000, duplicates=None):
+    import_file(file_path, read_jsonl_rows, chunk, duplicates)
+
+
+DEDUPE_MODES = ('merge', 'reject')
+
+# recipients to drop and the recipient each one is merged into, only NEW txs
+# are touched. merge keeps the first NEW recipient of an address, reject the
+# first one of any status, so an address paid before is not paid again.
+DEDUPE_SQL = """
+INSERT INTO dedupe (id, keep_id)
+SELECT r.id, k.keep_id
+FROM recipient r
+JOIN tx t ON t.recipient_id = r.id AND t.status = 'NEW' AND t.parent_id IS NULL
+JOIN (
+    SELECT r2.address, MIN(r2.id) AS keep_id
+    FROM recipient r2
+    JOIN tx t2 ON t2.recipient_id = r2.id
+    WHERE {keep_filter}
+    GROUP BY r2.address
+    HAVING COUNT(*) > 1
+) k ON k.address = r.address
+WHERE r.id != k.keep_id AND r.id >= ?
+"""
+DEDUPE_KEEP_FILTER = {
+    'merge': "t2.status = 'NEW' AND t2.parent_id IS NULL",
+    'reject': "1",
+}
+MERGE_AMOUNTS_SQL = """
+UPDATE recipient SET amount = amount + (
+    SELECT SUM(r.amount) FROM dedupe d JOIN recipient r ON r.id = d.id WHERE d.keep_id = recipient.id)
+WHERE id IN (SELECT keep_id FROM dedupe)
+"""
+
+
+def dedupe_recipients(mode, since_id=0):
+    """
+    Finds recipients repeating an address in one set-based pass over the address
+    index, merges their amounts into the first one ('merge') or drops them ('reject'),
+    together with their NEW txs. Only recipients from since_id on are dropped.
+    Returns (dropped recipients, addresses they repeated).
+    """
+    with metrics.timer('db', 'dedupe'), db.atomic():
+        db.execute_sql('CREATE TEMP TABLE IF NOT EXISTS dedupe (id INTEGER PRIMARY KEY, keep_id INTEGER)')
+        # amounts are summed per kept recipient
+        db.execute_sql('CREATE INDEX IF NOT EXISTS temp.dedupe_keep_id ON dedupe (keep_id)')
+        db.execute_sql('DELETE FROM dedupe')
+        db.execute_sql(DEDUPE_SQL.format(keep_filter=DEDUPE_KEEP_FILTER[mode]), (since_id,))
+        dropped, addresses = db.execute_sql('SELECT COUNT(*), COUNT(DISTINCT keep_id) FROM dedupe').fetchone()
+        if dropped:
+            if mode == 'merge':
+                db.execute_sql(MERGE_AMOUNTS_SQL)
+            db.execute_sql('DELETE FROM tx WHERE recipient_id IN (SELECT id FROM dedupe)')
+            db.execute_sql('DELETE FROM recipient WHERE id IN (SELECT id FROM dedupe)')
+        db.execute_sql('DROP TABLE dedupe')
+    return dropped, addresses
+
+
+def report_dedupe(mode, result):
+    dropped, addresses = result
+    if not dropped:
+        print('No duplicate recipients.')
+        return
+    config = Config.get(1)
+    gas = dropped * TRANSFER_GAS
+    action = 'merged into' if mode == 'merge' else 'rejected as repeating'
+    print(f'{dropped} duplicate recipients {action} {addresses} addresses. '
+          f'Saved {dropped} txs and about {gas} gas ({gas * config.gas_price} Wei at current gas price).')
+
+
+def dedupe(mode='merge'):
+    if mode not in DEDUPE_MODES:
+        print('Wrong dedupe mode. Use merge or reject.')
+        return
+    report_dedupe(mode, dedupe_recipients(mode))
+
+
 def set_gas_price(new_gas_price):
     try:
         int(new_gas_price)
@@ -168,75 +754,524 @@ def set_gas_price(new_gas_price):
     print(f'New gas price {new_gas_price}')
 
 
-def sign():
-    config = Config.get(1)
-    w3 = Web3(Web3.HTTPProvider(config.web3_node, request_kwargs={"timeout": 20}))
-    with open("tokens_abi/ERC20.abi", "r") as file:
-        erc20_abi = json.load(file)
-    token = w3.eth.contract(address=Web3.toChecksumAddress(config.token), abi=erc20_abi)
-    nonce = config.current_nonce
-
-    recipients = Recipient.select(Recipient, Tx).join(Tx).where(Tx.status == 'NEW')
-    for recipient in recipients:
-        tx = recipient.txes[0]
-        try:
-            raw_tx = token.functions.transfer(
-                                recipient.address,
-                                int(float(recipient.amount) * 10**18),
-                                ).buildTransaction({
-                                                    "from": config.address,
-                                                    "nonce": nonce,
-                                                    "gasPrice": config.gas_price,
-                                                    })
-        except ValueError:
+def save_signed(signed):
+    """
+    Writes one chunk of (tx_id, raw_tx, signed_tx) in a single transaction.
+    The tx hash is known from here on, so a crash after broadcasting can be recovered.
+    """
+    with metrics.timer('db', 'save_signed', len(signed)), db.atomic():
+        Tx.bulk_update(
+            [Tx(id=tx_id, raw_tx=raw_tx, signed_tx=signed_tx, tx_hash=keccak(signed_tx), nonce=raw_tx['nonce'],
+                status='SIGNED')
+             for tx_id, raw_tx, signed_tx in signed],
+            fields=[Tx.raw_tx, Tx.signed_tx, Tx.tx_hash, Tx.nonce, Tx.status],
+        )
+
+
+def optional_int(value):
+    return int(value) if value is not None else None
+
+
+def tx_fees(config, eip1559, fee_percentile, max_fee, priority_fee):
+    """
+    Legacy gas price from config, or type 2 fees. Type 2 fees come from the
+    node's fee history unless both max fee and priority fee are given, a given
+    max fee caps the suggestion.
+    """
+    if not eip1559:
+        return {'gasPrice': config.gas_price}
+    if max_fee is not None and priority_fee is not None:
+        return {'maxFeePerGas': max_fee, 'maxPriorityFeePerGas': min(priority_fee, max_fee)}
+
+    from fees import suggest_fees
+
+    fees = suggest_fees(config.web3_node, fee_percentile)
+    if 'maxFeePerGas' not in fees:
+        print('Node has no EIP-1559 fee history, gas price is used.')
+        return fees
+    if max_fee is not None:
+        fees['maxFeePerGas'] = min(fees['maxFeePerGas'], max_fee)
+    if priority_fee is not None:
+        fees['maxPriorityFeePerGas'] = priority_fee
+    fees['maxPriorityFeePerGas'] = min(fees['maxPriorityFeePerGas'], fees['maxFeePerGas'])
+    return fees
+
+
+def new_transfers():
+    return (Tx.select(Tx, Recipient)
+            .join(Recipient)
+            .where(Tx.status == 'NEW', Tx.parent.is_null())
+            .order_by(Tx.id))
+
+
+def transfer_params(config, token, txs, gas_limit, chain_id, gas_margin, sample):
+    """
+    Gas limit and chain id of transfers, the ones not given are requested from the node
+    in one batch request. Returns None if gas can't be estimated.
+    """
+    if gas_limit is not None and chain_id is not None:
+        return gas_limit, chain_id
+
+    from rpc import batch_request, RPCError
+
+    calls = []
+    if chain_id is None:
+        calls.append(('eth_chainId', []))
+    if gas_limit is None:
+        sample_recipients = [(tx.recipient.address, tx.recipient.amount)
+                             for tx in txs.limit(max(sample, 1))]
+        if not sample_recipients:
+            print('Nothing to sign.')
+            return None
+        calls += [('eth_estimateGas', [transfer_call(config.address, token, address, amount)])
+                  for address, amount in sample_recipients]
+    results = batch_request(config.web3_node, calls)
+
+    if chain_id is None:
+        result = results.pop(0)
+        if isinstance(result, RPCError):
+            raise result
+        chain_id = int(result, 16)
+    if gas_limit is None:
+        if any(isinstance(estimate, RPCError) for estimate in results):
             print('Not enough ETH or Token balance. Fill your balance and try again.')
-            return
-        tx.raw_tx = raw_tx
+            return None
+        # the largest estimate of the sample increased by the safety margin
+        gas_limit = int(max(int(estimate, 16) for estimate in results) * gas_margin)
+    return gas_limit, chain_id
 
-        signed_tx = w3.eth.account.sign_transaction(raw_tx, config.private_key).rawTransaction
-        tx.signed_tx = signed_tx
-        tx.nonce = nonce
-        tx.status = 'SIGNED'
-        tx.save()
 
-        nonce += 1
+def sign(gas_limit=None, chain_id=None, gas_margin=1.5, sample=1, workers=1, chunk=500,
+         disperse=False, batch_size=None, gas_budget=0.1, recipient_gas=35000, block_gas_limit=None,
+         eip1559=False, fee_percentile=50, max_fee=None, priority_fee=None):
+    """
+    Builds transfers locally from one template. The network is used only to get
+    chain id, fees and to estimate gas on a sample, all can be given to sign offline.
+    Nonces are assigned in Tx id order before signing, so they don't depend on workers.
+    """
+    config = Config.get(1)
+    token = to_checksum_address(config.token)
+    txs = new_transfers()
+
+    try:
+        gas_margin = float(gas_margin)
+        gas_budget = float(gas_budget)
+        sample = int(sample)
+        workers = int(workers)
+        chunk = int(chunk)
+        recipient_gas = int(recipient_gas)
+        assert chunk > 0 and recipient_gas > 0
+        gas_limit = optional_int(gas_limit)
+        chain_id = optional_int(chain_id)
+        batch_size = optional_int(batch_size)
+        block_gas_limit = optional_int(block_gas_limit)
+        fee_percentile = float(fee_percentile)
+        max_fee = optional_int(max_fee)
+        priority_fee = optional_int(priority_fee)
+        assert 0 <= fee_percentile <= 100
+    except (ValueError, AssertionError):
+        print('Wrong signing options. Try again.')
+        return
+    fees = tx_fees(config, eip1559, fee_percentile, max_fee, priority_fee)
+
+    if disperse:
+        sign_disperse(config, token, txs, chain_id, fees, workers,
+                      batch_size, gas_budget, recipient_gas, block_gas_limit)
+        return
+
+    params = transfer_params(config, token, txs, gas_limit, chain_id, gas_margin, sample)
+    if params is None:
+        return
+    gas_limit, chain_id = params
+
+    lanes = senders()
+    if len(lanes) > 1:
+        assign_senders(lanes)
+
+    for sender in lanes:
+        account = sender or config
+        template = transfer_template(account.address, token, gas_limit, fees, chain_id)
+        lane_txs = txs.where(sender_filter(sender))
+
+        def chunks():
+            nonce = account.current_nonce
+            last_id = 0
+            while True:
+                batch = list(lane_txs.where(Tx.id > last_id).limit(chunk))
+                if not batch:
+                    return
+                items = []
+                for tx in batch:
+                    items.append((tx.id, build_transfer(template, tx.recipient.address,
+                                                        tx.recipient.amount, nonce)))
+                    nonce += 1
+                last_id = batch[-1].id
+                yield items
+
+        for signed in sign_chunks(account.private_key, chunks(), workers):
+            save_signed(signed)
     print('TXs have been signed.')
 
 
-def send():
+ASSIGN_CHUNK = 500
+
+
+def assign_senders(lanes):
+    """
+    Shards NEW txs over sender lanes so that every sender pays about the same amount:
+    largest amounts first, each one to the lane with the least total so far.
+    Amounts of already signed txs count in the totals.
+    """
+    totals = {sender_id: Decimal(str(total)) for sender_id, total in
+              (Tx.select(Tx.sender, fn.SUM(Recipient.amount))
+               .join(Recipient)
+               .where(Tx.status != 'NEW')
+               .group_by(Tx.sender)
+               .tuples())}
+    heap = [(totals.get(sender.id if sender else None, Decimal(0)), i) for i, sender in enumerate(lanes)]
+    heapq.heapify(heap)
+    assigned = [[] for _ in lanes]
+    new = (Tx.select(Tx.id, Recipient.amount)
+           .join(Recipient)
+           .where(Tx.status == 'NEW', Tx.parent.is_null())
+           .order_by(Recipient.amount.desc(), Tx.id)
+           .tuples())
+    for tx_id, amount in new.iterator():
+        total, i = heapq.heappop(heap)
+        assigned[i].append(tx_id)
+        heapq.heappush(heap, (total + amount, i))
+
+    with metrics.timer('db', 'assign_senders', sum(map(len, assigned))), db.atomic():
+        for sender, tx_ids in zip(lanes, assigned):
+            for start in range(0, len(tx_ids), ASSIGN_CHUNK):
+                (Tx.update(sender=sender.id if sender else None)
+                 .where(Tx.id.in_(tx_ids[start:start + ASSIGN_CHUNK]))
+                 .execute())
+
+
+def sign_disperse(config, token, txs, chain_id, fees, workers,
+                  batch_size, gas_budget, recipient_gas, block_gas_limit):
+    """
+    Signs one approve of the whole amount to the disperse contract and one
+    disperseToken tx per batch of recipients. Recipients' txs become children
+    of their batch tx and follow its nonce, status, hash and receipt.
+    """
+    from rpc import get_web3
+
+    if int(config.disperse, 16) == 0:
+        print("Set disperse contract address with command 'disperse' first.")
+        return
+    disperse = to_checksum_address(config.disperse)
+
+    if chain_id is None or block_gas_limit is None:
+        w3 = get_web3(config.web3_node)
+        if chain_id is None:
+            chain_id = w3.eth.chain_id
+        if block_gas_limit is None:
+            block_gas_limit = w3.eth.get_block('latest').gasLimit
+    size = disperse_batch_size(block_gas_limit, gas_budget, recipient_gas, batch_size)
+
+    total = sum(to_token_units(tx.recipient.amount) for tx in txs.iterator())
+    if not total:
+        print('Nothing to sign.')
+        return
+    template = transfer_template(config.address, token, None, fees, chain_id)
+    batches = 0
+
+    def chunks():
+        nonlocal batches
+        nonce = config.current_nonce
+        approve_tx = Tx.create(status='NEW')
+        yield [(approve_tx.id, build_call(template, token, encode_approve(disperse, total),
+                                          APPROVE_GAS, nonce))]
+        while True:
+            nonce += 1
+            batch = list(txs.limit(size))
+            if not batch:
+                return
+            batches += 1
+            batch_tx = Tx.create(status='NEW')
+            # batches are paid by the Config account
+            Tx.update(parent=batch_tx, sender=None).where(Tx.id.in_([tx.id for tx in batch])).execute()
+            recipients = [(tx.recipient.address, to_token_units(tx.recipient.amount)) for tx in batch]
+            yield [(batch_tx.id, build_call(template, disperse, encode_disperse(token, recipients),
+                                            disperse_gas(len(batch), recipient_gas), nonce))]
+
+    # all or nothing, so a crash doesn't leave recipients in unsigned batches
+    with db.atomic():
+        for signed in sign_chunks(config.private_key, chunks(), workers):
+            save_signed(signed)
+    print(f'Approve and {batches} disperse TXs of up to {size} recipients have been signed.')
+
+
+def check_tx_calls(config, txs):
+    """
+    Simulates txs with one batch of eth_call.
+    Returns how many txs in a row passed, stops at the first contract logic error.
+    """
+    from rpc import BatchClient, RPCError
+
+    client = BatchClient(config.web3_node)
+    simulated = []
+    for i, tx in enumerate(txs):
+        raw_tx = tx.raw_tx
+        # disperse batches spend the allowance of approve sent before them,
+        # so they can't be simulated ahead
+        if raw_tx['to'] == config.token:
+            client.add('eth_call', [call_params(raw_tx), 'latest'])
+            simulated.append(i)
+    for i, result in zip(simulated, client.execute()):
+        if isinstance(result, RPCError):
+            print("""Contract logic error (probably insufficient token balance). Sending aborted.""")
+            return i
+    return len(txs)
+
+
+# signed txs simulated per sender, the rest is covered by the aggregate check
+PREFLIGHT_SAMPLE = 3
+# a balance within this share above the need is reported as close
+PREFLIGHT_MARGIN = 0.05
+
+
+def queue_needs():
+    """
+    Token units and fee Wei needed by SIGNED txs per sender id and by NEW txs,
+    (count, tokens, max fees) each. Fees of signed txs are gas limit times
+    max fee per gas, summed as REAL since they overflow SQLite integers.
+    """
+    tokens = {}
+    for sender_id, status, total in (Tx.select(Tx.sender, Tx.status, fn.TOTAL(Recipient.amount))
+                                     .join(Recipient)
+                                     .where(Tx.status.in_(['NEW', 'SIGNED']))
+                                     .group_by(Tx.sender, Tx.status)
+                                     .tuples()):
+        key = sender_id if status == 'SIGNED' else 'NEW'
+        tokens[key] = tokens.get(key, 0) + to_token_units(total)
+    signed = {}
+    for sender_id, count, fees in db.execute_sql(
+            "SELECT sender_id, COUNT(*), TOTAL(json_extract(raw_tx, '$.gas') * "
+            "COALESCE(json_extract(raw_tx, '$.maxFeePerGas'), json_extract(raw_tx, '$.gasPrice'))) "
+            "FROM tx WHERE status = 'SIGNED' AND parent_id IS NULL GROUP BY sender_id"):
+        signed[sender_id] = (count, tokens.get(sender_id, 0), int(fees))
+    new_count = Tx.select().where(Tx.status == 'NEW', Tx.parent.is_null()).count()
+    return signed, (new_count, tokens.get('NEW', 0))
+
+
+def preflight_check(config, new_gas=None, new_price=None):
+    """
+    Checks the whole queue at once instead of simulating every tx: token and
+    fee needs of SIGNED txs against balances of their sender, NEW txs against
+    what is left on all senders, plus eth_call of a few first txs of every sender
+    for contract errors other than balance. One batch request in total.
+    NEW txs cost new_gas * new_price, by default a typical transfer at config gas price.
+    Returns (ok, rows) with rows of need, balance and result for the report,
+    (False, None) if the token is not a contract.
+    """
+    from rpc import BatchClient, RPCError
+
+    lanes = senders()
+    signed, (new_count, new_tokens) = queue_needs()
+    new_fees = new_count * (new_gas or TRANSFER_GAS) * (new_price or config.gas_price)
+
+    client = BatchClient(config.web3_node)
+    balances, samples = [], []
+    for sender in lanes:
+        address = (sender or config).address
+        balances.append((client.add('eth_getBalance', [address, 'latest']),
+                         client.add('eth_call', [{'to': config.token, 'data': encode_balance_of(address)}, 'latest'])))
+        txs = [tx for tx in next_signed_txs(PREFLIGHT_SAMPLE, sender) if tx.raw_tx['to'] == config.token]
+        samples.append([(tx, client.add('eth_call', [call_params(tx.raw_tx), 'latest'])) for tx in txs])
+    results = client.execute()
+
+    def verdict(need_tokens, tokens, need_fees, fees):
+        if tokens < need_tokens or fees < need_fees:
+            return 'short'
+        if tokens < need_tokens * (1 + PREFLIGHT_MARGIN) or fees < need_fees * (1 + PREFLIGHT_MARGIN):
+            return 'close'
+        return 'ok'
+
+    rows = []
+    free_tokens = free_fees = 0
+    for i, sender in enumerate(lanes):
+        eth_balance, token_balance = (results[index] for index in balances[i])
+        for result in (eth_balance, token_balance):
+            if isinstance(result, RPCError):
+                raise result
+        if not token_balance or token_balance == '0x':
+            print("Error. Token address is not a contract. Check token address.")
+            return False, None
+        eth_balance, token_balance = int(eth_balance, 16), int(token_balance, 16)
+        count, need_tokens, need_fees = signed.get(sender.id if sender else None, (0, 0, 0))
+        result = verdict(need_tokens, token_balance, need_fees, eth_balance)
+        reverted = next((tx for tx, index in samples[i] if isinstance(results[index], RPCError)), None)
+        # a revert with enough balance is a contract error, e.g. a paused token
+        if reverted is not None and result != 'short':
+            result = f'tx with nonce {reverted.nonce} reverts'
+        rows.append(((sender or config).address, count, need_tokens, token_balance, need_fees, eth_balance, result))
+        free_tokens += max(token_balance - need_tokens, 0)
+        free_fees += max(eth_balance - need_fees, 0)
+    if new_count:
+        rows.append(('NEW, any sender', new_count, new_tokens, free_tokens, new_fees, free_fees,
+                     verdict(new_tokens, free_tokens, new_fees, free_fees)))
+    return all(row[-1] in ('ok', 'close') for row in rows), rows
+
+
+def print_preflight(rows):
+    data = [['Sender', 'Txs', 'Tokens needed, Wei', 'Token balance, Wei', 'Fees needed, Wei', 'ETH balance, Wei',
+             'Result']]
+    data += [[str(item) for item in row] for row in rows]
+    print_pretty_table(data)
+
+
+def preflight(new_gas=None, new_price=None):
     config = Config.get(1)
-    w3 = Web3(Web3.HTTPProvider(config.web3_node, request_kwargs={"timeout": 20}))
+    ok, rows = preflight_check(config, optional_int(new_gas), optional_int(new_price))
+    if rows is None:
+        return False
+    print_preflight(rows)
+    print('Balances cover the queue.' if ok else 'Balances don\'t cover the queue. Fill your balance and try again.')
+    return ok
 
-    sending_tx = Tx.select().where(Tx.status == 'SIGNED').order_by(Tx.nonce, Tx.id).first()
 
-    try:
-        w3.eth.call(json.loads(sending_tx.raw_tx.replace("\'", "\"")))
-    except ContractLogicError:
-        print("""Contract logic error (probably insufficient token balance). Sending aborted.""")
+def preflight_before_send(config, new_gas=None, new_price=None):
+    """Preflight of send --all and run: silent unless balances are short or close."""
+    ok, rows = preflight_check(config, new_gas, new_price)
+    if rows is None:
+        return False
+    if not ok or any(row[-1] != 'ok' for row in rows):
+        print_preflight(rows)
+    if not ok:
+        print("Balances don't cover the queue. Fill your balance and try again.")
+    return ok
+
+
+def failed_on_chain(receipt):
+    """Receipt from web3 or raw JSON-RPC one with hex status."""
+    status = receipt.get('status')
+    return status is not None and (int(status, 16) if isinstance(status, str) else status) == 0
+
+
+def broadcast(config, tx, sender=None):
+    """
+    Journals signed tx as BROADCASTING, sends it and marks it SENT.
+    Returns tx hash or None if node refused it, the refused tx is left for 'recover'.
+    """
+    mark_broadcasting([tx])
+    tx_hash = push_tx(config, tx)
+    if tx_hash is not None:
+        mark_sent(config, tx, tx_hash, sender)
+    return tx_hash
+
+
+def mark_broadcasting(txs):
+    """Write-ahead journal of txs about to be sent: a crash leaves them BROADCASTING, not SIGNED."""
+    if not txs:
         return
-    except AttributeError:
-        print("Nothing to send.")
+    with metrics.timer('db', 'mark_broadcasting', len(txs)):
+        Tx.update(status='BROADCASTING').where(Tx.id.in_([tx.id for tx in txs])).execute()
+    for tx in txs:
+        tx.status = 'BROADCASTING'
+
+
+def unmark_broadcasting(txs):
+    """Journaled txs that were never sent go back to the queue."""
+    if not txs:
         return
+    with metrics.timer('db', 'unmark_broadcasting', len(txs)):
+        Tx.update(status='SIGNED').where(Tx.id.in_([tx.id for tx in txs])).execute()
+    for tx in txs:
+        tx.status = 'SIGNED'
+
+
+def push_tx(config, tx):
+    """
+    Sends signed tx to the node without touching db. Returns tx hash or None if node refused it.
+    Errors are told apart by kind, as nodes word them differently; throttling was already
+    retried by the RPC client.
+    """
+    from rpc import classify_error
 
     try:
-        tx_hash = send_raw_tx(config.web3_node, sending_tx.signed_tx)
+        return send_raw_tx(config.web3_node, tx.signed_tx)
     except ValueError as e:
-        if str(e) == "{'code': -32000, 'message': 'insufficient funds for gas * price + value'}":
+        error = e.args[0] if e.args else str(e)
+        kind = classify_error(error)
+        if kind == 'already_known':
+            # sent before a crash, before it was marked SENT
+            return bytes(tx.tx_hash) or keccak(bytes(tx.signed_tx))
+        if kind == 'insufficient_funds':
             print('Not enough ETH Balance. Fill your balance and try again.')
-        elif str(e) == "{'code': -32000, 'message': 'nonce too low'}":
-            print("Needs to update account nonce. Use command 'update'.")
+        elif kind == 'nonce_too_low':
+            # maybe this very tx was mined, 'update' alone would sign its recipient again
+            print("Tx nonce is used already. Use command 'recover', then 'update'.")
+        elif kind == 'underpriced':
+            print(f"A tx with nonce {tx.nonce} and higher fees is pending already. Use command 'recover'.")
+        elif kind == 'rate_limited':
+            print('The node keeps refusing requests because of their rate. Try again later.')
+        else:
+            print(f'The node refused tx with nonce {tx.nonce}: {error}')
+        return None
+
+
+def mark_sent(config, tx, tx_hash, sender=None):
+    with metrics.timer('db', 'mark_sent'):
+        tx.tx_hash = tx_hash
+        tx.status = 'SENT'
+        tx.save()
+
+        account = sender or config
+        account.current_nonce = tx.nonce + 1
+        account.save()
+
+
+def next_signed_txs(count, sender=None):
+    return list(Tx.select()
+                .where(Tx.status == 'SIGNED', Tx.parent.is_null(), sender_filter(sender))
+                .order_by(Tx.nonce, Tx.id)
+                .limit(count))
+
+
+def send(window=1, all=False, bump_after=None, fee_percentile=50, batch_size=RECEIPT_BATCH,
+         poll_interval=RECEIPT_POLL_INTERVAL):
+    config = Config.get(1)
+
+    if all:
+        try:
+            window = int(window)
+            bump_after = optional_int(bump_after)
+            fee_percentile = float(fee_percentile)
+            batch_size = int(batch_size)
+            poll_interval = float(poll_interval)
+            assert window > 0 and batch_size > 0 and (bump_after is None or bump_after > 0)
+        except (ValueError, AssertionError):
+            print('Wrong send options. Try again.')
+            return
+        if not recover_before_send(config) or not preflight_before_send(config):
+            return
+        send_window(config, window)
+        # txs without receipt in time are watched until mined, replaced when stuck
+        if bump_after is not None and Tx.select().where(Tx.status == 'SENT', Tx.parent.is_null()).exists():
+            get_all_receipts(config, batch_size, poll_interval, bump_after, fee_percentile)
         return
-    except AttributeError as e:
-        print(e)
+
+    if not recover_before_send(config):
+        return
+    # next tx of the first sender that has one
+    sending_tx = sender = None
+    for sender in senders():
+        sending_tx = next(iter(next_signed_txs(1, sender)), None)
+        if sending_tx is not None:
+            break
+    if sending_tx is None:
         print("Nothing to send.")
         return
-    sending_tx.tx_hash = tx_hash
-    sending_tx.status = 'SENT'
-    sending_tx.save()
-    print(f"Tx with {sending_tx.nonce} nonce was sent. Waiting for receipt...")
+    if not check_tx_calls(config, [sending_tx]):
+        return
 
-    config.current_nonce += 1
-    config.save()
+    tx_hash = broadcast(config, sending_tx, sender)
+    if tx_hash is None:
+        return
+    print(f"Tx with {sending_tx.nonce} nonce was sent. Waiting for receipt...")
 
     sending_tx.tx_receipt = get_tx_receipt(config.web3_node, tx_hash)
     sending_tx.status = "MINED"
@@ -244,50 +1279,704 @@ def send():
     print('Tx was successfully mined!')
 
 
-def get_receipt():
-    config = Config.get(1)
-    w3 = Web3(Web3.HTTPProvider(config.web3_node, request_kwargs={"timeout": 20}))
+def send_window(config, window):
+    """
+    Sends all SIGNED txs keeping up to `window` consecutive nonces in flight per sender,
+    the senders' lanes are sent side by side. Receipts are awaited in background
+    threads, db is written only from this one. Txs are not simulated one by one,
+    balances are checked by preflight before, a tx failed on chain stops sending.
+    """
+    from web3.exceptions import TimeExhausted
+
+    lanes = senders()
+    in_flight = {}
+    lane_in_flight = [0] * len(lanes)
+    stopped = [False] * len(lanes)
+    sent = mined = 0
+    with ThreadPoolExecutor(max_workers=window * len(lanes)) as pool:
+        while True:
+            for lane, sender in enumerate(lanes):
+                if stopped[lane] or lane_in_flight[lane] >= window:
+                    continue
+                txs = next_signed_txs(window - lane_in_flight[lane], sender)
+                stopped[lane] = not txs
+                mark_broadcasting(txs)
+                for i, tx in enumerate(txs):
+                    tx_hash = push_tx(config, tx)
+                    if tx_hash is None:
+                        # the refused tx stays journaled, the rest never left
+                        unmark_broadcasting(txs[i + 1:])
+                        stopped[lane] = True
+                        break
+                    mark_sent(config, tx, tx_hash, sender)
+                    sent += 1
+                    lane_in_flight[lane] += 1
+                    in_flight[pool.submit(get_tx_receipt, config.web3_node, tx_hash)] = (lane, tx)
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                lane, tx = in_flight.pop(future)
+                lane_in_flight[lane] -= 1
+                try:
+                    tx.tx_receipt = future.result()
+                except TimeExhausted:
+                    print(f"No receipt for tx with nonce {tx.nonce} yet. Use command 'receipt' later.")
+                    continue
+                tx.status = "MINED"
+                with metrics.timer('db', 'save_mined'):
+                    tx.save()
+                mined += 1
+                if failed_on_chain(tx.tx_receipt) and not all(stopped):
+                    print(f"Tx with nonce {tx.nonce} failed on chain. Sending stopped, check balances.")
+                    stopped = [True] * len(lanes)
+    print(f"{sent} txs were sent, {mined} of them mined.")
+
+
+def get_receipt(all=False, batch_size=RECEIPT_BATCH, poll_interval=RECEIPT_POLL_INTERVAL, bump_after=None,
+                fee_percentile=50):
+    from rpc import get_web3
+
+    if all:
+        try:
+            batch_size = int(batch_size)
+            poll_interval = float(poll_interval)
+            bump_after = optional_int(bump_after)
+            fee_percentile = float(fee_percentile)
+            assert batch_size > 0 and (bump_after is None or bump_after > 0)
+        except (ValueError, AssertionError):
+            print('Wrong receipt options. Try again.')
+            return
+        get_all_receipts(Config.get(1), batch_size, poll_interval, bump_after, fee_percentile)
+        return
 
-    tx = Tx.select().where(Tx.status == "SENT").order_by(Tx.id).first()
+    tx = Tx.select().where(Tx.status == "SENT", Tx.parent.is_null()).order_by(Tx.id).first()
+    if tx is None:
+        print("Nothing to wait for, no SENT transactions.")
+        return
+    config = Config.get(1)
+    w3 = get_web3(config.web3_node)
     tx.tx_receipt= w3.eth.wait_for_transaction_receipt(tx.tx_hash)
     tx.status = "MINED"
     tx.save()
     print(f"Tx with nonce {tx.nonce} was successfully mined!")
 
 
+def split_hashes(hashes):
+    hashes = bytes(hashes)
+    return [hashes[i:i + 32] for i in range(0, len(hashes), 32)]
+
+
+def get_all_receipts(config, batch_size, poll_interval, bump_after=None, fee_percentile=50):
+    """
+    Polls receipts of all SENT txs with JSON-RPC batches. Mined txs of every
+    poll cycle are written in one transaction, pending ones go to the next cycle.
+    With a newHeads subscription a cycle starts at a new head and asks only txs
+    found in new blocks, see heads.ReceiptWatch.
+    With bump_after, txs pending for that many blocks are replaced, see replace_stuck_txs.
+    """
+    from heads import RESYNC_INTERVAL, ReceiptWatch, get_watcher
+    from rpc import batch_request, RPCError
+
+    pending = list(Tx.select(Tx.id, Tx.nonce, Tx.tx_hash, Tx.sent_block, Tx.replaced_hashes, Tx.sender)
+                   .where(Tx.status == "SENT", Tx.parent.is_null())
+                   .order_by(Tx.nonce))
+    if not pending:
+        print("Nothing to wait for.")
+        return
+    lanes = {sender.id if sender else None: sender or config for sender in senders()}
+    watch = ReceiptWatch(get_watcher(config.web3_node))
+
+    while True:
+        confirmed_nonces = {}
+        if bump_after is not None:
+            head = batch_request(config.web3_node, [('eth_blockNumber', [])] + [
+                ('eth_getTransactionCount', [account.address, 'latest']) for account in lanes.values()])
+            for result in head:
+                if isinstance(result, RPCError):
+                    raise result
+            block = int(head[0], 16)
+            confirmed_nonces = {sender_id: int(nonce, 16) for sender_id, nonce in zip(lanes, head[1:])}
+
+        mined = pending_receipts(config, watch, pending, batch_size, confirmed_nonces)
+        still_pending = [tx for tx in pending if tx.id not in mined]
+        save_mined(mined.values())
+        if mined or not watch.pushing:
+            print(f"{len(mined)} txs mined, {len(still_pending)} pending.")
+
+        pending = still_pending
+        if not pending:
+            break
+        if bump_after is not None:
+            replaced = replace_stuck_txs(config, lanes, pending, block, bump_after, fee_percentile)
+            if replaced:
+                print(f"{replaced} txs pending for {bump_after} blocks were replaced with higher fees.")
+        # pending txs don't change between heads, there is nothing to ask before the next one
+        watch.wait(RESYNC_INTERVAL if watch.pushing else poll_interval)
+    print("All sent txs were successfully mined!")
+
+
+def fetch_receipts(config, pending, batch_size, confirmed_nonces=None):
+    """
+    Receipts of pending txs in JSON-RPC batches, db is not touched. A tx below its
+    sender's confirmed nonce was mined, maybe in one of its replaced versions, so
+    those hashes are asked too. Returns {tx id: Tx with receipt} of mined txs.
+    """
+    confirmed_nonces = confirmed_nonces or {}
+    queries = []
+    for tx in pending:
+        queries.append((tx, bytes(tx.tx_hash)))
+        if tx.nonce < confirmed_nonces.get(tx.sender_id, 0):
+            queries.extend((tx, tx_hash) for tx_hash in split_hashes(tx.replaced_hashes))
+    return query_receipts(config, queries, batch_size)
+
+
+def pending_receipts(config, watch, pending, batch_size, confirmed_nonces=None):
+    """fetch_receipts of all pending txs, or of those found in new blocks when watch has a subscription."""
+    due = watch.due({tx.id: [bytes(tx.tx_hash)] + split_hashes(tx.replaced_hashes) for tx in pending})
+    if due is None:
+        return fetch_receipts(config, pending, batch_size, confirmed_nonces)
+    return query_receipts(config, [(tx, due[tx.id]) for tx in pending if tx.id in due], batch_size)
+
+
+def query_receipts(config, queries, batch_size):
+    """Receipts of (tx, tx hash) queries, returns {tx id: Tx with receipt} of mined txs."""
+    from rpc import batch_request, RPCError
+
+    mined = {}
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        receipts = batch_request(config.web3_node,
+                                 [('eth_getTransactionReceipt', ['0x' + tx_hash.hex()]) for _, tx_hash in batch],
+                                 batch_size)
+        for (tx, tx_hash), receipt in zip(batch, receipts):
+            if receipt is not None and not isinstance(receipt, RPCError):
+                mined.setdefault(tx.id, Tx(id=tx.id, tx_hash=tx_hash, tx_receipt=receipt, status='MINED'))
+    return mined
+
+
+def save_mined(mined):
+    mined = list(mined)
+    with metrics.timer('db', 'save_mined', len(mined)), db.atomic():
+        Tx.bulk_update(mined, fields=[Tx.tx_hash, Tx.tx_receipt, Tx.status], batch_size=500)
+
+
+def replace_stuck_txs(config, lanes, pending, block, bump_after, fee_percentile):
+    """
+    Watchdog of pending txs. Txs pending since bump_after blocks ago are re-signed
+    with fees raised by the minimal replacement step or to the market and
+    rebroadcast in one batch. lanes maps sender id to its account.
+    Returns number of replaced txs.
+    """
+    from fees import replacement_fees, suggest_fees
+    from rpc import batch_request, RPCError
+
+    unseen = [tx for tx in pending if tx.sent_block is None]
+    for tx in unseen:
+        tx.sent_block = block
+    stuck = {tx.id: tx for tx in pending if block - tx.sent_block >= bump_after}
+    if unseen:
+        with db.atomic():
+            Tx.bulk_update(unseen, fields=[Tx.sent_block], batch_size=500)
+    if not stuck:
+        return 0
+
+    market = suggest_fees(config.web3_node, fee_percentile, block)
+    items = {}
+    for tx_id, raw_tx in Tx.select(Tx.id, Tx.raw_tx).where(Tx.id.in_(list(stuck))).tuples():
+        items.setdefault(stuck[tx_id].sender_id, []).append(
+            (tx_id, dict(raw_tx, **replacement_fees(raw_tx, market))))
+    signed = [item for sender_id, sender_items in items.items()
+              for chunk in sign_chunks(lanes[sender_id].private_key, [sender_items]) for item in chunk]
+    results = batch_request(config.web3_node,
+                            [('eth_sendRawTransaction', ['0x' + signed_tx.hex()]) for _, _, signed_tx in signed])
+
+    replaced = []
+    for (tx_id, raw_tx, signed_tx), tx_hash in zip(signed, results):
+        # refused replacements (underpriced, old version just mined) are retried next cycle
+        if isinstance(tx_hash, RPCError):
+            continue
+        tx = stuck[tx_id]
+        tx.replaced_hashes = bytes(tx.replaced_hashes) + bytes(tx.tx_hash)
+        tx.tx_hash = bytes.fromhex(tx_hash[2:])
+        tx.raw_tx = raw_tx
+        tx.signed_tx = signed_tx
+        tx.sent_block = block
+        replaced.append(tx)
+    with metrics.timer('db', 'save_replaced', len(replaced)), db.atomic():
+        Tx.bulk_update(replaced, fields=[Tx.raw_tx, Tx.signed_tx, Tx.tx_hash, Tx.replaced_hashes, Tx.sent_block],
+                       batch_size=500)
+    return len(replaced)
+
+
+RECOVER_BATCH = 500
+
+
+def recover_journal(config, batch_size=RECOVER_BATCH):
+    """
+    Resolves in-doubt txs in one pass of batch requests: BROADCASTING ones and SIGNED
+    ones below their sender's nonce on chain. Their hashes are known since signing,
+    so the receipt and the node's copy of every tx are asked by hash. Mined txs get
+    their receipt, txs the node has become SENT, the rest go back to SIGNED.
+    Returns counts of 'mined', 'sent', 'signed', 'nonce_used' (signed ones whose nonce
+    was taken by another tx) and 'unresolved' (node errors).
+    """
+    from rpc import batch_request, RPCError
+
+    lanes = {sender.id if sender else None: sender or config for sender in senders()}
+    nonces = batch_request(config.web3_node,
+                           [('eth_getTransactionCount', [account.address, 'latest']) for account in lanes.values()])
+    for nonce in nonces:
+        if isinstance(nonce, RPCError):
+            raise nonce
+    chain_nonces = {sender_id: int(nonce, 16) for sender_id, nonce in zip(lanes, nonces)}
+
+    below = max(chain_nonces.values())
+    in_doubt = [tx for tx in (Tx.select(Tx.id, Tx.nonce, Tx.tx_hash, Tx.signed_tx, Tx.sender, Tx.status)
+                              .where(Tx.parent.is_null(),
+                                     (Tx.status == 'BROADCASTING') | ((Tx.status == 'SIGNED') & (Tx.nonce < below)))
+                              .order_by(Tx.nonce))
+                if tx.status == 'BROADCASTING' or tx.nonce < chain_nonces[tx.sender_id]]
+    counts = {'mined': 0, 'sent': 0, 'signed': 0, 'nonce_used': 0, 'unresolved': 0}
+    mined, sent, signed = [], [], []
+    for start in range(0, len(in_doubt), batch_size):
+        txs = in_doubt[start:start + batch_size]
+        calls = []
+        for tx in txs:
+            tx_hash = '0x' + (bytes(tx.tx_hash) or keccak(bytes(tx.signed_tx))).hex()
+            calls += [('eth_getTransactionReceipt', [tx_hash]), ('eth_getTransactionByHash', [tx_hash])]
+        results = batch_request(config.web3_node, calls)
+        for i, tx in enumerate(txs):
+            receipt, known = results[2 * i:2 * i + 2]
+            tx.tx_hash = bytes(tx.tx_hash) or keccak(bytes(tx.signed_tx))
+            if isinstance(receipt, RPCError) or isinstance(known, RPCError):
+                counts['unresolved'] += 1
+            elif receipt is not None:
+                tx.tx_receipt = receipt
+                tx.status = 'MINED'
+                mined.append(tx)
+            elif known is not None:
+                tx.status = 'SENT'
+                sent.append(tx)
+            else:
+                tx.status = 'SIGNED'
+                signed.append(tx)
+                if tx.nonce < chain_nonces[tx.sender_id]:
+                    counts['nonce_used'] += 1
+    counts.update(mined=len(mined), sent=len(sent), signed=len(signed))
+
+    with metrics.timer('db', 'recover', len(mined) + len(sent) + len(signed)), db.atomic():
+        Tx.bulk_update(mined, fields=[Tx.tx_hash, Tx.tx_receipt, Tx.status], batch_size=500)
+        Tx.bulk_update(sent + signed, fields=[Tx.tx_hash, Tx.status], batch_size=500)
+        # the node took these nonces, as mark_sent would record
+        for sender_id, account in lanes.items():
+            used = [tx.nonce + 1 for tx in mined + sent if tx.sender_id == sender_id]
+            nonce = max([account.current_nonce, chain_nonces[sender_id]] + used)
+            if nonce != account.current_nonce:
+                account.current_nonce = nonce
+                account.save()
+    return counts
+
+
+def report_recover(counts):
+    print(f"In-doubt txs: {counts['mined']} mined, {counts['sent']} pending on the node are SENT, "
+          f"{counts['signed']} unknown to the node are SIGNED again.")
+    if counts['nonce_used']:
+        print(f"{counts['nonce_used']} SIGNED txs have nonces used on chain by other txs. "
+              "Use command 'reconcile' to find recipients paid meanwhile, then 'update'.")
+    if counts['unresolved']:
+        print(f"{counts['unresolved']} txs are still in doubt because of node errors. Try 'recover' again.")
+
+
+def recover(batch_size=RECOVER_BATCH):
+    try:
+        batch_size = int(batch_size)
+        assert batch_size > 0
+    except (ValueError, AssertionError):
+        print('Wrong recover options. Try again.')
+        return
+    counts = recover_journal(Config.get(1), batch_size)
+    if not any(counts.values()):
+        print('Nothing to recover.')
+        return
+    report_recover(counts)
+
+
+def recover_before_send(config):
+    """Recovery of send and run after a crash, only when the journal has txs. False if some are still in doubt."""
+    if not Tx.select().where(Tx.status == 'BROADCASTING', Tx.parent.is_null()).exists():
+        return True
+    counts = recover_journal(config)
+    report_recover(counts)
+    return not counts['unresolved']
+
+
+# blocks per eth_getLogs call, halved when the node refuses a range and doubled
+# while calls return few logs
+LOGS_WINDOW = 5000
+MAX_LOGS_WINDOW = 1000000
+LOGS_TARGET = 5000
+# blocks scanned back from the latest one when no mined tx tells where to start
+RECONCILE_LOOKBACK = 50000
+RECONCILE_SHOW = 10
+
+
+def scan_transfer_logs(config, senders, from_block, to_block, window=LOGS_WINDOW):
+    """
+    Yields Transfer logs of the token from any of senders between the blocks, one
+    eth_getLogs call per window. Windows adapt to the node: a refused call (too many
+    results, range too large, response too big) is retried with half the range.
+    """
+    from rpc import batch_request, RPCError
+
+    topics = [TRANSFER_TOPIC, [address_topic(address) for address in senders]]
+    start = from_block
+    while start <= to_block:
+        end = min(start + window - 1, to_block)
+        logs, = batch_request(config.web3_node, [('eth_getLogs', [{
+            'address': config.token, 'topics': topics, 'fromBlock': hex(start), 'toBlock': hex(end)}])])
+        if isinstance(logs, RPCError):
+            if window == 1:
+                raise logs
+            window = max(window // 2, 1)
+            continue
+        yield logs
+        start = end + 1
+        if len(logs) < LOGS_TARGET // 2:
+            window = min(window * 2, MAX_LOGS_WINDOW)
+
+
+def reconcile(from_block=None, to_block=None, window=LOGS_WINDOW):
+    """
+    Matches Transfer logs of all senders against txs not known as MINED,
+    logs of MINED txs and their replaced versions are skipped. A log of a SENT tx,
+    one of its replaced versions or a SIGNED or BROADCASTING tx sent before
+    a crash is matched by tx hash and marks the tx MINED. Other logs paying
+    an unmined recipient the same amount from its sender mark it as paid:
+    MINED with the paying tx hash and without nonce. Everything else is reported.
+    """
+    from rpc import batch_request, RPCError
+
+    config = Config.get(1)
+    try:
+        from_block = optional_int(from_block)
+        to_block = optional_int(to_block)
+        window = int(window)
+        assert window > 0
+    except (ValueError, AssertionError):
+        print('Wrong reconcile options. Try again.')
+        return
+
+    lanes = {sender.id if sender else None: (sender or config).address.lower() for sender in senders()}
+    # hash index of our txs and (sender, recipient, value) index of unpaid recipients
+    by_hash, by_transfer, unmined = {}, {}, {}
+    rows = (Tx.select(Tx.id, Tx.status, Tx.nonce, Tx.signed_tx, Tx.tx_hash, Tx.replaced_hashes, Tx.sender,
+                      Recipient.address, Recipient.amount)
+            .join(Recipient, JOIN.LEFT_OUTER)
+            .where(Tx.status != 'MINED', Tx.parent.is_null())
+            .tuples())
+    for tx_id, tx_status, nonce, signed_tx, tx_hash, replaced, sender_id, address, amount in rows.iterator():
+        unmined[tx_id] = (tx_status, nonce)
+        hashes = split_hashes(replaced)
+        if tx_hash:
+            hashes.append(bytes(tx_hash))
+        elif tx_status == 'SIGNED':
+            # signed before hashes were saved at signing
+            hashes.append(keccak(bytes(signed_tx)))
+        for item in hashes:
+            by_hash[item] = tx_id
+        if address is not None:
+            key = (lanes[sender_id], address.lower(), to_token_units(amount))
+            by_transfer.setdefault(key, []).append(tx_id)
+    if not unmined:
+        print('Nothing to reconcile, all txs are mined.')
+        return
+    mined_hashes = set()
+    for tx_hash, replaced in (Tx.select(Tx.tx_hash, Tx.replaced_hashes)
+                              .where(Tx.status == 'MINED').tuples().iterator()):
+        mined_hashes.update(split_hashes(replaced))
+        if tx_hash:
+            mined_hashes.add(bytes(tx_hash))
+
+    if to_block is None:
+        latest, = batch_request(config.web3_node, [('eth_blockNumber', [])])
+        if isinstance(latest, RPCError):
+            raise latest
+        to_block = int(latest, 16)
+    if from_block is None:
+        # the earliest block of a mined tx of this airdrop is where its transfers start
+        from_block = Tx.select(fn.MIN(receipt_value('blockNumber'))).where(Tx.status == 'MINED').scalar()
+        if from_block is None:
+            from_block = max(to_block - RECONCILE_LOOKBACK, 0)
+
+    started = time.perf_counter()
+    marked, paid, unknown = {}, [], []
+    calls = logs_count = 0
+    senders_addresses = list(dict.fromkeys(lanes.values()))
+    if config.disperse != "0x0000000000000000000000000000000000000000":
+        # disperse batches transfer from the contract
+        senders_addresses.append(config.disperse.lower())
+    for logs in scan_transfer_logs(config, senders_addresses, from_block, to_block, window):
+        calls += 1
+        logs_count += len(logs)
+        for log in logs:
+            tx_hash = bytes.fromhex(log['transactionHash'][2:])
+            if tx_hash in mined_hashes:
+                continue
+            receipt = {'blockNumber': log['blockNumber'], 'status': 1}
+            tx_id = by_hash.get(tx_hash)
+            if tx_id is not None:
+                if tx_id not in marked:
+                    marked[tx_id] = Tx(id=tx_id, tx_hash=tx_hash, tx_receipt=receipt, status='MINED',
+                                       nonce=unmined[tx_id][1])
+                continue
+            candidates = by_transfer.get(decode_transfer_log(log))
+            while candidates and candidates[0] in marked:
+                candidates.pop(0)
+            if candidates:
+                tx_id = candidates.pop(0)
+                marked[tx_id] = Tx(id=tx_id, tx_hash=tx_hash, tx_receipt=receipt, status='MINED', nonce=None)
+                paid.append(tx_id)
+            else:
+                unknown.append(log)
+
+    with metrics.timer('db', 'reconcile', len(marked)), db.atomic():
+        Tx.bulk_update(list(marked.values()), fields=[Tx.tx_hash, Tx.tx_receipt, Tx.status, Tx.nonce],
+                       batch_size=500)
+
+    by_status = {}
+    for tx_id in marked:
+        if tx_id not in paid:
+            by_status[unmined[tx_id][0]] = by_status.get(unmined[tx_id][0], 0) + 1
+    not_found = sum(1 for tx_id, (tx_status, _) in unmined.items()
+                    if tx_status == 'SENT' and tx_id not in marked)
+    print(f"Scanned blocks {from_block}-{to_block} with {calls} eth_getLogs calls in "
+          f"{time.perf_counter() - started:.2f} s, {logs_count} Transfer logs of senders.")
+    print(f"Mined: {by_status.get('SENT', 0)} sent txs, "
+          f"{by_status.get('SIGNED', 0) + by_status.get('BROADCASTING', 0)} signed txs sent before a crash.")
+    print(f"Already paid by other txs: {len(paid)} recipients.")
+    if any(unmined[tx_id][0] in ('SIGNED', 'BROADCASTING') for tx_id in paid):
+        print("Signed txs of paid recipients are dropped, use command 'update' to re-sign the following nonces.")
+    if not_found:
+        print(f"Not found in these blocks: {not_found} sent txs, check them with 'receipt --all'.")
+    if unknown:
+        print(f"Transfers matching no recipient: {len(unknown)}.")
+        for log in unknown[:RECONCILE_SHOW]:
+            sender, recipient, value = decode_transfer_log(log)
+            print(f"  {log['transactionHash']} block {int(log['blockNumber'], 16)}: "
+                  f"{sender} -> {recipient} {value} token Wei")
+
+
+def run(gas_limit=None, chain_id=None, gas_margin=1.5, sample=1, eip1559=False, fee_percentile=50,
+        max_fee=None, priority_fee=None, window=8, queue=1000, chunk=100, workers=1, batch_size=100,
+        poll_interval=2):
+    """
+    Signs, sends and collects receipts of all txs in one process, see pipeline.Pipeline.
+    Starts from whatever state db is in: SENT txs are waited for, SIGNED ones are sent, NEW ones signed.
+    """
+    import asyncio
+    from pipeline import Pipeline
+
+    config = Config.get(1)
+    token = to_checksum_address(config.token)
+    try:
+        gas_margin = float(gas_margin)
+        sample = int(sample)
+        window = int(window)
+        queue = int(queue)
+        chunk = int(chunk)
+        workers = int(workers)
+        batch_size = int(batch_size)
+        poll_interval = float(poll_interval)
+        gas_limit = optional_int(gas_limit)
+        chain_id = optional_int(chain_id)
+        fee_percentile = float(fee_percentile)
+        max_fee = optional_int(max_fee)
+        priority_fee = optional_int(priority_fee)
+        assert window > 0 and queue > 0 and chunk > 0 and batch_size > 0
+        assert 0 <= fee_percentile <= 100
+    except (ValueError, AssertionError):
+        print('Wrong run options. Try again.')
+        return
+
+    fees = None
+    txs = new_transfers()
+    if txs.exists():
+        fees = tx_fees(config, eip1559, fee_percentile, max_fee, priority_fee)
+        params = transfer_params(config, token, txs, gas_limit, chain_id, gas_margin, sample)
+        if params is None:
+            return
+        gas_limit, chain_id = params
+    lanes = senders()
+    if len(lanes) > 1:
+        assign_senders(lanes)
+    # NEW txs are paid at most the fee cap they will be signed with
+    price = fees and fees.get('maxFeePerGas', fees.get('gasPrice'))
+    if not recover_before_send(config) or not preflight_before_send(config, gas_limit, price):
+        return
+
+    pipeline = Pipeline(sys.modules[__name__], config, token, gas_limit, fees, chain_id, lanes,
+                        window=window, queue_size=queue, chunk=chunk, workers=workers,
+                        batch_size=batch_size, poll_interval=poll_interval)
+    asyncio.run(pipeline.run())
+    print(f"{pipeline.signed} txs signed, {pipeline.sent} sent, {pipeline.mined} mined "
+          f"in {time.monotonic() - pipeline.started:.1f} s.")
+
+
 def help():
     print("""
     init                    Starts project, calls at once.
     import                  Import admin private key, returns user address.
+    add-sender              Import private key of one more sender, recipients are sharded between senders.
     token <address>         Set token address for airdrop.
-    web3 <web_address>      Specify web3 node address.
+    disperse <address>      Set disperse contract address for 'sign --disperse'.
+    migrate                 Upgrades db created by an older version in place.
+    web3 <web_address> ...  Specify web3 node address. Several addresses are used as a pool with failover.
+                            A ws://, wss:// or *.ipc address adds a newHeads subscription for receipts.
+    nodes [--probes N]      Probes web3 nodes and shows requests, connections, latency, health and rate limits of each one.
+    preflight               Checks that token and ETH balances of senders cover all SIGNED and NEW txs.
+        [--new-gas N]       Gas limit of NEW txs for the check, a typical transfer by default.
+        [--new-price N]     Max fee per gas of NEW txs for the check, gasprice by default.
+    stats                   Shows RPC, signing and db write timings of the last run, per RPC method with error codes.
+        [--format json]     Prints the summary as JSON.
     update                  Retrievs latest balances and user nonce. Also updates nonce for 'SIGNED' tx, if necceessary.
+        [--workers N]       Number of processes re-signing transactions.
     show                    Shows current status.
+        [--status S]        Only recipients with tx in status S (NEW, SIGNED, BROADCASTING, SENT, MINED).
+        [--limit N]         Show at most N recipients.
+        [--offset N]        Skip first N recipients.
+    export <file>           Streams recipients with nonce, status, sender, tx hash, block and gas used. '-' is stdout.
+        [--format F]        csv, jsonl or parquet (needs pyarrow), by file extension by default.
+        [--status S]        Only recipients with tx in status S.
+        [--nonce-from N]    Only txs with nonce N or higher.
+        [--nonce-to N]      Only txs with nonce N or lower.
+        [--chunk N]         Rows per db page, 5000 by default.
     add <address> <amount>  Adds recipient with amount.
+    import-csv <file>       Adds recipients from CSV file (address,amount per line). Use '-' for stdin.
+        [--chunk N]         Rows per insert transaction, 1000 by default.
+    import-jsonl <file>     Adds recipients from JSONL file ({"address": ..., "amount": ...} per line).
+        [--chunk N]         Rows per insert transaction, 1000 by default.
+        [--duplicates M]    For both imports, 'merge' or 'reject' imported rows repeating an address as 'dedupe'.
+    dedupe                  Merges amounts of recipients with the same address into the first one, only NEW txs.
+        [--mode reject]     Drops repeated recipients instead, also the ones of addresses already signed or paid.
     gasprice <amount>       Set new <amount> gasprice value for tx in Wei.
-    sign                    Signs all transactions.
+    sign                    Signs all transactions from one local template.
+        [--gas-limit N]     Gas limit for every transfer instead of the estimate.
+        [--chain-id N]      Chain id instead of querying the node. With --gas-limit signs fully offline.
+        [--gas-margin X]    Multiplier applied to the gas estimate, 1.5 by default.
+        [--sample N]        Number of recipients to estimate gas on, the largest estimate is used. 1 by default.
+        [--workers N]       Number of signing processes, 1 by default.
+        [--chunk N]         Transactions per signing chunk and per db write, 500 by default.
+        [--disperse]        Pays recipients in batches through the disperse contract after one approve.
+        [--gas-budget X]    With --disperse, share of block gas limit one batch may use, 0.1 by default.
+        [--recipient-gas N] With --disperse, gas per recipient in a batch, 35000 by default.
+        [--batch-size N]    With --disperse, max recipients per batch.
+        [--block-gas-limit N] With --disperse, block gas limit instead of querying the node.
+        [--eip1559]         Signs type 2 txs with fees from the node's fee history instead of gasprice.
+        [--fee-percentile P] With --eip1559, priority fee percentile of recent blocks, 50 by default.
+        [--max-fee N]       With --eip1559, cap of max fee per gas in Wei.
+        [--priority-fee N]  With --eip1559, priority fee per gas in Wei. With --max-fee no fee history is read.
     send                    Sedns first signed tx.
+        [--all]             Sends all signed txs, collecting receipts in background.
+        [--window K]        With --all, number of consecutive nonces in flight, 1 by default.
+        [--bump-after N]    With --all, then waits for txs left pending and replaces them as 'receipt --all --bump-after N'.
+        [--batch-size N]    With --bump-after, receipts per batch request, 100 by default.
+        [--poll-interval S] With --bump-after, seconds between polls of pending txs, 5 by default.
+    run                     Signs, sends and waits for receipts of all txs at once, resumes after a crash.
+        [--window K]        Consecutive nonces in flight per sender, 8 by default.
+        [--queue N]         Signed txs waiting to be sent per sender, 1000 by default.
+        [--chunk N]         Transactions per signing chunk, 100 by default.
+        [--workers N]       Number of signing processes, 1 by default.
+        [--batch-size N]    Receipts per batch request, 100 by default.
+        [--poll-interval S] Seconds between receipt polls, 2 by default.
+        [...]               --gas-limit, --chain-id, --gas-margin, --sample and fee options as for sign.
+    recover                 Resolves txs left BROADCASTING by a crash, and SIGNED ones below the nonce on chain, by their hashes.
+        [--batch-size N]    Txs checked per batch request, 500 by default.
+    reconcile               Matches token Transfer logs of senders with txs and recipients, marks mined and already paid ones.
+        [--from-block N]    First block to scan, the first block of mined txs by default.
+        [--to-block N]      Last block to scan, the latest by default.
+        [--window N]        Blocks per eth_getLogs call to start with, adapts to the node. 5000 by default.
     receipt                 Queries receipt for transaction with status 'SENT'
+        [--all]             Polls receipts of all 'SENT' txs with batch requests until they are mined.
+        [--batch-size N]    Receipts per batch request, 100 by default.
+        [--poll-interval S] Seconds between polls of pending txs, 5 by default.
+        [--bump-after N]    With --all, re-signs and rebroadcasts txs pending for N blocks with higher fees.
+        [--fee-percentile P] Priority fee percentile of recent blocks for replacements, 50 by default.
     help                    Returns this info
+
+    Any command accepts --profile [file] to run under cProfile, stats are saved to airdrop.prof by default.
+    Timings of every run are saved to metrics.prom (Prometheus text) and trace.jsonl.
           """)
 
 
 command_dict = {
     "init": initialize,
     'import': import_key,
+    'add-sender': add_sender,
     'token': set_token,
+    'disperse': set_disperse,
+    'migrate': migrate_db,
     "web3": set_node_address,
+    "nodes": show_nodes,
+    "preflight": preflight,
+    "stats": show_stats,
     "update": update_data,
     "show": show,
+    "export": export,
     "add": add_recepient,
+    "import-csv": import_csv,
+    "import-jsonl": import_jsonl,
+    "dedupe": dedupe,
     "gasprice": set_gas_price,
     "sign": sign,
     "send": send,
     "receipt": get_receipt,
+    "reconcile": reconcile,
+    "recover": recover,
+    "run": run,
     "help": help,
 }
 
 
+def parse_options(argv):
+    """
+    Splits command line into positional args and '--option value' / '--flag' kwargs.
+    """
+    args, kwargs = [], {}
+    i = 0
+    while i < len(argv):
+        if argv[i].startswith('--'):
+            name = argv[i][2:].replace('-', '_')
+            if i + 1 < len(argv) and not argv[i + 1].startswith('--'):
+                kwargs[name] = argv[i + 1]
+                i += 2
+                continue
+            kwargs[name] = True
+        else:
+            args.append(argv[i])
+        i += 1
+    return args, kwargs
+
+
+PROFILE_FILE = 'airdrop.prof'
+
+
+def run_profiled(function, args, kwargs, output):
+    """Runs command under cProfile, saves the stats and prints the top functions by cumulative time."""
+    import cProfile
+    import pstats
+
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(function, *args, **kwargs)
+    finally:
+        output = output if isinstance(output, str) else PROFILE_FILE
+        profile.dump_stats(output)
+        pstats.Stats(profile, stream=sys.stderr).sort_stats('cumulative').print_stats(20)
+        print(f'Profile saved to {output}.', file=sys.stderr)
+
+
 if __name__ == "__main__":
 
     if len(sys.argv) < 2:
@@ -296,16 +1985,26 @@ if __name__ == "__main__":
         # parse command
         try:
             command = sys.argv[1]
-            args = sys.argv[2:]
+            args, kwargs = parse_options(sys.argv[2:])
+            profile = kwargs.pop('profile', None)
         except IndexError:
             print("Invalid command. Try again or input 'help' for help.")
 
         # execute command
         try:
-            command_dict[command](*args)
+            if (command not in ("init", "migrate", "help") and db.table_exists("config")
+                    and schema_version() < SCHEMA_VERSION):
+                print("Db was created by an older version. Run 'migrate' first.")
+                sys.exit(1)
+            if profile:
+                run_profiled(command_dict[command], args, kwargs, profile)
+            else:
+                command_dict[command](*args, **kwargs)
         except TypeError:
             print(f'Please specify all neccessary argument(s) for command "{command}"')
         except KeyError:
             print("Invalid command. Try again or input 'help' for help.")
         except OperationalError:
             print("Invalid command. Try again or input 'help' for help.")
+        finally:
+            metrics.save(command)
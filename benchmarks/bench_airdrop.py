@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+Throughput of every stage of an airdrop against StubChain, a local node
+stand-in with a deployed ERC-20 token: add, import-csv, sign, update (with
+a rebase of all signed nonces), send --all, receipt --all and show.
+Every size runs on a fresh db, results are comparable between commits.
+Exits with status 1 if not every recipient got the tokens.
+
+    python benchmarks/bench_airdrop.py [sizes] [--latency=ms] [--window=K] [--workers=N] [--json]
+
+sizes are comma separated, 1000,10000,100000 by default.
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import platform
+import subprocess
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import airdrop as ad  # noqa: E402
+from models import db, Tx  # noqa: E402
+from rpc_stub import StubChain, StubNode  # noqa: E402
+from transactions import to_checksum_address, to_token_units  # noqa: E402
+
+
+SIZES = [1000, 10000, 100000]
+PRIVATE_KEY = 'a181ad022696f68244129bc35559d9fe28005d5289fca5961d3ce91dc29d13b3'
+CHAIN_ID = 1337
+GAS_LIMIT = 60000
+# recipients added one by one with 'add', the rest is imported
+ADD_SHARE = 0.01
+
+
+def option(name, default):
+    for arg in sys.argv[1:]:
+        if arg.startswith(f'--{name}='):
+            return type(default)(arg.split('=', 1)[1])
+    return default
+
+
+def random_addresses(count, rnd):
+    return [to_checksum_address('0x' + ''.join(rnd.choice('0123456789abcdef') for _ in range(40)))
+            for _ in range(count)]
+
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def timed(stages, name, rows, stage):
+    started = time.perf_counter()
+    with quiet():
+        stage()
+    seconds = time.perf_counter() - started
+    stages[name] = {'rows': rows, 'seconds': round(seconds, 3),
+                    'rows_per_s': round(rows / seconds, 1) if seconds else None}
+
+
+def bench(size, latency, window, workers):
+    from eth_account import Account
+
+    sender = Account.from_key(PRIVATE_KEY).address
+    chain = StubChain(chain_id=CHAIN_ID)
+    token = chain.deploy_token(sender, to_token_units(size * 10))
+    rnd = random.Random(size)
+    addresses = random_addresses(size, rnd)
+    added = max(int(size * ADD_SHARE), 1)
+    stages = {}
+
+    with tempfile.TemporaryDirectory() as tmp, StubNode(chain.methods(), latency=latency) as node:
+        csv_path = os.path.join(tmp, 'recipients.csv')
+        with open(csv_path, 'w') as file:
+            for address in addresses[added:]:
+                file.write(f'{address},{rnd.randint(1, 10)}\n')
+
+        db.init(os.path.join(tmp, 'db.sqlite'))
+        with quiet():
+            ad.initialize()
+            ad.set_node_address(node.url)
+            ad.set_token(token)
+        config = ad.Config.get(1)
+        config.address = sender
+        config.private_key = PRIVATE_KEY
+        config.gas_price = chain.gas_price
+        config.save()
+
+        timed(stages, 'add', added, lambda: [ad.add_recepient(address, 1) for address in addresses[:added]])
+        timed(stages, 'import', size - added, lambda: ad.import_csv(csv_path))
+        timed(stages, 'sign', size, lambda: ad.sign(GAS_LIMIT, CHAIN_ID, workers=workers))
+        # a tx sent from the account by someone else shifts all signed nonces
+        chain.nonces[sender.lower()] = 1
+        timed(stages, 'update', size, lambda: ad.update_data(workers))
+        timed(stages, 'send', size, lambda: ad.send(window=window, all=True))
+        # receipts again, as if send was interrupted after broadcasting
+        Tx.update(status='SENT', tx_receipt=None).where(Tx.status == 'MINED').execute()
+        timed(stages, 'receipt', size, lambda: ad.get_receipt(all=True, poll_interval=0))
+        timed(stages, 'show', size, ad.show)
+
+        mined = Tx.select().where(Tx.status == 'MINED').count()
+        db.close()
+
+    paid = sum(1 for address in addresses if chain.token_balance(address))
+    return {'recipients': size, 'mined': mined, 'paid': paid, 'rpc_calls': len(node.calls),
+            'http_requests': node.http_requests, 'stages': stages}
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    sizes = [int(size) for size in args[0].split(',')] if args else SIZES
+    latency = option('latency', 0.0)
+    window = option('window', 16)
+    workers = option('workers', 1)
+
+    results = [bench(size, latency / 1000, window, workers) for size in sizes]
+    ok = all(result['mined'] == result['paid'] == result['recipients'] for result in results)
+
+    if '--json' in sys.argv:
+        print(json.dumps({'commit': commit(), 'python': platform.python_version(), 'latency_ms': latency,
+                          'window': window, 'workers': workers, 'results': results}, indent=2))
+    else:
+        print(f'latency {latency} ms, window {window}, {workers} workers\n')
+        for result in results:
+            print(f'{result["recipients"]} recipients, {result["mined"]} mined, {result["paid"]} paid, '
+                  f'{result["rpc_calls"]} calls in {result["http_requests"]} HTTP requests')
+            print(f'{"stage":<10}{"rows":>10}{"seconds":>10}{"rows/s":>10}')
+            for name, stage in result['stages'].items():
+                print(f'{name:<10}{stage["rows"]:>10}{stage["seconds"]:>10.2f}{stage["rows_per_s"] or 0:>10.0f}')
+            print()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Query times of the tx queue on a db without indexes and WAL (schema version 1)
+and on the same db after 'migrate'.
+
+    python benchmarks/bench_db.py [rows] [--json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import db, PRAGMAS, Config, Recipient, Tx, create_triggers, set_schema_version, upgrade_schema  # noqa: E402
+
+
+ROWS = 1000000
+CHUNK = 10000
+REPEATS = 5
+STATUSES = ['MINED'] * 4 + ['SENT'] + ['SIGNED'] * 3 + ['NEW'] * 2
+
+
+def random_address(rnd):
+    return '0x' + ''.join(rnd.choice('0123456789abcdef') for _ in range(40))
+
+
+def populate(rows):
+    rnd = random.Random(1)
+    addresses = []
+    for start in range(0, rows, CHUNK):
+        count = min(CHUNK, rows - start)
+        chunk = [random_address(rnd) for _ in range(count)]
+        addresses.extend(rnd.sample(chunk, 2))
+        with db.atomic():
+            Recipient.insert_many(
+                [{'id': start + i + 1, 'address': address, 'amount': 1} for i, address in enumerate(chunk)]
+            ).execute()
+            txs = []
+            for i in range(count):
+                status = STATUSES[(start + i) * len(STATUSES) // rows]
+                txs.append({'recipient': start + i + 1, 'status': status,
+                            'nonce': None if status == 'NEW' else start + i})
+            Tx.insert_many(txs).execute()
+    return addresses
+
+
+def queries(addresses):
+    return {
+        'next SIGNED by nonce': lambda: list(
+            Tx.select().where(Tx.status == 'SIGNED', Tx.parent.is_null())
+            .order_by(Tx.nonce, Tx.id).limit(100)),
+        'oldest SENT': lambda: Tx.select().where(Tx.status == 'SENT', Tx.parent.is_null())
+        .order_by(Tx.nonce).first(),
+        'count NEW': lambda: Tx.select().where(Tx.status == 'NEW').count(),
+        'first NEW chunk': lambda: list(
+            Tx.select().where(Tx.status == 'NEW', Tx.parent.is_null()).order_by(Tx.id).limit(500)),
+        'recipient by address': lambda: [
+            Recipient.select().where(Recipient.address == address).first() for address in addresses[:10]],
+    }
+
+
+def measure(addresses):
+    results = {}
+    for name, query in queries(addresses).items():
+        timings = []
+        for _ in range(REPEATS):
+            started = time.perf_counter()
+            query()
+            timings.append(time.perf_counter() - started)
+        results[name] = statistics.median(timings) * 1000
+    return results
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    rows = int(args[0]) if args else ROWS
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.sqlite')
+
+        # before: version 1 schema with default journaling
+        db.init(path, pragmas={})
+        db.create_tables([Config, Recipient, Tx])
+        create_triggers()
+        db.execute_sql('DROP INDEX "tx_status_nonce"')
+        db.execute_sql('DROP INDEX "tx_sender_id_status_nonce"')
+        db.execute_sql('DROP INDEX "recipient_address"')
+        set_schema_version(1)
+        started = time.perf_counter()
+        addresses = populate(rows)
+        populate_seconds = time.perf_counter() - started
+        before = measure(addresses)
+        db.close()
+
+        # after: tuned pragmas and migrated schema
+        db.init(path, pragmas=PRAGMAS)
+        started = time.perf_counter()
+        upgrade_schema()
+        migrate_seconds = time.perf_counter() - started
+        after = measure(addresses)
+        db.close()
+
+    if '--json' in sys.argv:
+        print(json.dumps({'rows': rows, 'populate_s': populate_seconds, 'migrate_s': migrate_seconds,
+                          'before_ms': before, 'after_ms': after}, indent=2))
+        return
+
+    print(f'{rows} rows, populated in {populate_seconds:.1f} s, migrated in {migrate_seconds:.1f} s\n')
+    print(f'{"query":<24}{"before, ms":>12}{"after, ms":>12}')
+    for name in before:
+        print(f'{name:<24}{before[name]:>12.2f}{after[name]:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
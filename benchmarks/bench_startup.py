@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Import time of every CLI command, run as a user would run it: one process
+per command against a fresh db and a local node stand-in.
+Exits with status 1 if a command imports longer than its threshold or if
+an offline command loads web3.
+
+    python benchmarks/bench_startup.py [--json]
+"""
+import os
+import re
+import sys
+import json
+import sqlite3
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from rpc_stub import StubNode  # noqa: E402
+from transactions import keccak  # noqa: E402
+
+
+AIRDROP = os.path.join(ROOT, 'airdrop.py')
+PRIVATE_KEY = 'a181ad022696f68244129bc35559d9fe28005d5289fca5961d3ce91dc29d13b3'
+SENDER_KEY = '11' * 32
+TOKEN = '0x688ce8a97d5f1193261DB2271f542193D1dFd866'
+RECIPIENT = '0x754a2bAe5b5eEE723409A1d0013377927Fd5F539'
+
+# milliseconds of imports on top of the bare interpreter
+OFFLINE_THRESHOLD = 250
+ONLINE_THRESHOLD = 2500
+
+# command line, whether it talks to the node
+COMMANDS = [
+    (['help'], False),
+    (['init'], False),
+    (['web3', '{node}'], True),
+    (['import'], True),
+    (['add-sender'], True),
+    (['token', TOKEN], False),
+    (['disperse', TOKEN], False),
+    (['gasprice', '1000000000'], False),
+    (['add', RECIPIENT, '1'], False),
+    (['import-csv', '{csv}'], False),
+    (['import-jsonl', '{jsonl}'], False),
+    (['migrate'], False),
+    (['update'], True),
+    (['nodes', '--probes', '1'], True),
+    (['stats'], False),
+    (['show'], False),
+    (['export', 'ledger.csv'], False),
+    (['sign', '--gas-limit', '60000', '--chain-id', '1'], True),
+    (['preflight'], True),
+    (['send', '--all'], True),
+    (['receipt', '--all', '--poll-interval', '0'], True),
+    (['run', '--poll-interval', '0'], True),
+    (['recover'], True),
+    (['reconcile'], True),
+    # after the run, so the 3 recipients of the same address are paid separately
+    (['dedupe'], False),
+]
+
+
+def node_methods():
+    return {
+        'web3_clientVersion': lambda params: 'stub',
+        'eth_blockNumber': lambda params: hex(100),
+        'eth_getLogs': lambda params: [],
+        'eth_getTransactionByHash': lambda params: None,
+        'eth_getBalance': lambda params: hex(10**18),
+        'eth_call': lambda params: '0x' + format(10**24, '064x'),
+        'eth_getTransactionCount': lambda params: hex(0),
+        'eth_sendRawTransaction': lambda params: '0x' + keccak(bytes.fromhex(params[0][2:])).hex(),
+        'eth_getTransactionReceipt': lambda params: {
+            'transactionHash': params[0], 'blockHash': '0x' + '11' * 32, 'blockNumber': hex(100),
+            'status': '0x1', 'gasUsed': hex(52000)},
+    }
+
+
+def import_ms(stderr):
+    """Sum of cumulative times of top level imports from -X importtime output."""
+    total = 0
+    modules = set()
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)', line)
+        if match is None:
+            continue
+        modules.add(match.group(3).strip())
+        if not match.group(2):
+            total += int(match.group(1))
+    return total / 1000, modules
+
+
+def run(args, cwd, stdin=None):
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=cwd, input=stdin,
+                             capture_output=True, text=True)
+    return import_ms(process.stderr)
+
+
+def main():
+    baseline, _ = run(['-c', 'pass'], ROOT)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp, StubNode(node_methods()) as node:
+        paths = {'node': node.url,
+                 'csv': os.path.join(tmp, 'recipients.csv'),
+                 'jsonl': os.path.join(tmp, 'recipients.jsonl')}
+        with open(paths['csv'], 'w') as file:
+            file.write(f'{RECIPIENT},2\n')
+        with open(paths['jsonl'], 'w') as file:
+            file.write(json.dumps({'address': RECIPIENT, 'amount': 3}) + '\n')
+
+        for command, online in COMMANDS:
+            args = [AIRDROP] + [arg.format(**paths) for arg in command]
+            stdin = {'import': PRIVATE_KEY, 'add-sender': SENDER_KEY}.get(command[0])
+            if stdin is not None:
+                stdin += '\n'
+            total, modules = run(args, tmp, stdin)
+            ms = total - baseline
+            threshold = ONLINE_THRESHOLD if online else OFFLINE_THRESHOLD
+            web3 = 'web3' in modules
+            results.append({'command': command[0], 'import_ms': round(ms, 1), 'threshold_ms': threshold,
+                            'web3': web3, 'ok': ms <= threshold and (online or not web3)})
+
+        # the commands really worked, not just failed fast
+        connection = sqlite3.connect(os.path.join(tmp, 'db.sqlite'))
+        mined = connection.execute("SELECT count(*) FROM tx WHERE status = 'MINED'").fetchone()[0]
+        connection.close()
+
+    if '--json' in sys.argv:
+        print(json.dumps({'baseline_ms': baseline, 'mined': mined, 'commands': results}, indent=2))
+    else:
+        print(f'interpreter {baseline:.1f} ms, {mined} txs mined\n')
+        print(f'{"command":<14}{"import, ms":>12}{"threshold":>11}  web3')
+        for result in results:
+            flag = '' if result['ok'] else '  REGRESSION'
+            print(f'{result["command"]:<14}{result["import_ms"]:>12.1f}{result["threshold_ms"]:>11}'
+                  f'  {"yes" if result["web3"] else "no"}{flag}')
+    sys.exit(0 if all(result['ok'] for result in results) and mined == 3 else 1)
+
+
+if __name__ == '__main__':
+    main()
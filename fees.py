@@ -0,0 +1,63 @@
+"""
+EIP-1559 fee suggestions from eth_feeHistory, eth_gasPrice on nodes without
+a fee market, and fee bumps of replacement transactions.
+"""
+from rpc import batch_request, RPCError
+
+
+FEE_HISTORY_BLOCKS = 10
+DEFAULT_PERCENTILE = 50
+# minimal fee increase of a replacement tx accepted by geth and most other nodes, percent
+REPLACEMENT_BUMP = 10
+
+# (web3_node, percentile) -> (latest block, fees)
+_cache = {}
+
+
+def suggest_fees(web3_node, percentile=DEFAULT_PERCENTILE, block=None):
+    """
+    Fee fields for new txs. The priority fee is the median over recent blocks of
+    the percentile reward, max fee leaves room for the base fee to double.
+    Nodes without fee history get gasPrice. Fees of the given block are cached.
+    """
+    key = (web3_node, percentile)
+    if block is not None and key in _cache and _cache[key][0] == block:
+        return dict(_cache[key][1])
+
+    history, gas_price = batch_request(web3_node, [
+        ('eth_feeHistory', [hex(FEE_HISTORY_BLOCKS), 'latest', [percentile]]),
+        ('eth_gasPrice', []),
+    ])
+    if isinstance(history, RPCError) or not history or not history.get('baseFeePerGas'):
+        if isinstance(gas_price, RPCError):
+            raise gas_price
+        return {'gasPrice': int(gas_price, 16)}
+
+    # the last base fee is the one of the next block
+    base_fee = int(history['baseFeePerGas'][-1], 16)
+    rewards = sorted(int(reward[0], 16) for reward in history.get('reward') or [] if reward)
+    priority_fee = rewards[len(rewards) // 2] if rewards else 0
+    fees = {'maxFeePerGas': 2 * base_fee + priority_fee, 'maxPriorityFeePerGas': priority_fee}
+
+    latest = int(history['oldestBlock'], 16) + len(history['baseFeePerGas']) - 2
+    _cache[key] = (latest, fees)
+    return dict(fees)
+
+
+def bump(fee):
+    return fee + -(-fee * REPLACEMENT_BUMP // 100)
+
+
+def replacement_fees(raw_tx, market):
+    """
+    Fee fields of a tx replacing raw_tx: raised by the minimal replacement step
+    or to the market fees, whichever is higher. The tx keeps its type.
+    """
+    if 'maxFeePerGas' in raw_tx:
+        priority_fee = max(bump(raw_tx['maxPriorityFeePerGas']), market.get('maxPriorityFeePerGas', 0))
+        max_fee = max(bump(raw_tx['maxFeePerGas']),
+                      market.get('maxFeePerGas', market.get('gasPrice', 0)),
+                      priority_fee)
+        return {'maxFeePerGas': max_fee, 'maxPriorityFeePerGas': priority_fee}
+    return {'gasPrice': max(bump(raw_tx['gasPrice']),
+                            market.get('gasPrice', market.get('maxFeePerGas', 0)))}
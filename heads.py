@@ -0,0 +1,337 @@
+"""
+Push-based confirmation: newHeads subscription over a WebSocket or IPC endpoint.
+
+Config.web3_node may list ws://, wss:// or IPC socket (*.ipc) endpoints next to
+HTTP ones. The first of them carries an eth_subscribe('newHeads') subscription
+on a background thread; requests keep going to the HTTP endpoints. On every new
+head the block's tx hashes are fetched once and matched against pending hashes,
+so receipts are asked only for txs that were mined. Without a subscription, while
+it reconnects, and every RESYNC_INTERVAL seconds all pending txs are polled.
+"""
+import json
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+
+from rpc import batch_request, is_push_endpoint, parse_endpoints, RPCError
+
+
+CONNECT_TIMEOUT = 5
+RECONNECT_DELAY = 2
+# seconds between full polls of all pending txs in push mode, covers missed heads and reorgs
+RESYNC_INTERVAL = 60
+# blocks whose tx hashes are kept
+CACHE_BLOCKS = 256
+# txs first seen after their block was matched are looked for in that many recent blocks
+RECHECK_BLOCKS = 64
+
+_watchers = {}
+_lock = threading.Lock()
+
+
+class IPCConnection:
+    """JSON-RPC over a Unix socket, messages are JSON values one after another."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.buffer = ''
+        self.decoder = json.JSONDecoder()
+
+    async def send(self, message):
+        self.writer.write(message.encode())
+        await self.writer.drain()
+
+    async def recv(self):
+        while True:
+            text = self.buffer.lstrip()
+            if text:
+                try:
+                    message, end = self.decoder.raw_decode(text)
+                except ValueError:
+                    pass
+                else:
+                    self.buffer = text[end:]
+                    return message
+            chunk = await self.reader.read(65536)
+            if not chunk:
+                raise ConnectionError('IPC socket closed')
+            self.buffer += chunk.decode()
+
+    async def close(self):
+        self.writer.close()
+
+
+class WSConnection:
+    """JSON-RPC over WebSocket with aiohttp, a web3 dependency."""
+
+    def __init__(self, session, websocket):
+        self.session = session
+        self.websocket = websocket
+
+    async def send(self, message):
+        await self.websocket.send_str(message)
+
+    async def recv(self):
+        import aiohttp
+
+        message = await self.websocket.receive()
+        if message.type != aiohttp.WSMsgType.TEXT:
+            raise ConnectionError(f'WebSocket {message.type.name.lower()}')
+        return json.loads(message.data)
+
+    async def close(self):
+        await self.websocket.close()
+        await self.session.close()
+
+
+async def connect(url):
+    if url.startswith(('ws://', 'wss://')):
+        import aiohttp
+
+        session = aiohttp.ClientSession()
+        try:
+            return WSConnection(session, await session.ws_connect(url, max_msg_size=0, heartbeat=30))
+        except BaseException:
+            await session.close()
+            raise
+    path = url[len('ipc://'):] if url.startswith('ipc://') else url
+    return IPCConnection(*await asyncio.open_unix_connection(path))
+
+
+class HeadWatcher:
+    """
+    Latest head from a newHeads subscription kept by a background thread, which
+    reconnects when the connection drops. Tx hashes of blocks are fetched over
+    HTTP with batch requests and cached for all threads.
+    """
+
+    def __init__(self, url, web3_node):
+        self.url = url
+        self.web3_node = web3_node
+        self.head = None
+        self.alive = False
+        self.heads = 0
+        self._changed = threading.Condition()
+        self._connected = threading.Event()
+        self._blocks = OrderedDict()
+        self._fetch_lock = threading.Lock()
+        self._loop = None
+        self._closed = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._connected.wait(CONNECT_TIMEOUT)
+        return self
+
+    def close(self):
+        self._closed = True
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join(CONNECT_TIMEOUT)
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._stop = asyncio.Event()
+        self._loop = loop
+        try:
+            loop.run_until_complete(self._subscribe_forever())
+        finally:
+            loop.close()
+
+    async def _subscribe_forever(self):
+        while not self._closed:
+            stop = asyncio.ensure_future(self._stop.wait())
+            listen = asyncio.ensure_future(self._listen())
+            await asyncio.wait({stop, listen}, return_when=asyncio.FIRST_COMPLETED)
+            stop.cancel()
+            listen.cancel()
+            await asyncio.gather(stop, listen, return_exceptions=True)
+            self._set_alive(False)
+            self._connected.set()
+            if not self._closed:
+                try:
+                    await asyncio.wait_for(self._stop.wait(), RECONNECT_DELAY)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _listen(self):
+        try:
+            connection = await asyncio.wait_for(connect(self.url), CONNECT_TIMEOUT)
+        except Exception:
+            # refused, unreachable or not a JSON-RPC endpoint, retried after a delay
+            return
+        try:
+            await connection.send(json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'eth_subscribe',
+                                              'params': ['newHeads']}))
+            subscription = None
+            while True:
+                message = await connection.recv()
+                if message.get('id') == 1:
+                    if 'error' in message:
+                        return
+                    subscription = message['result']
+                    self._set_alive(True)
+                    self._connected.set()
+                elif message.get('method') == 'eth_subscription' and subscription is not None:
+                    params = message.get('params') or {}
+                    if params.get('subscription') == subscription:
+                        self._new_head(int(params['result']['number'], 16))
+        except Exception:
+            # dropped connection or a malformed message, the subscription is renewed
+            return
+        finally:
+            await connection.close()
+
+    def _set_alive(self, alive):
+        with self._changed:
+            self.alive = alive
+            self._changed.notify_all()
+
+    def _new_head(self, number):
+        with self._changed:
+            self.heads += 1
+            if self.head is None or number > self.head:
+                self.head = number
+            self._changed.notify_all()
+
+    def wait(self, block, timeout):
+        """Latest head once it is above block, None after timeout or while the subscription is down."""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while self.alive and (self.head is None or (block is not None and self.head <= block)):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._changed.wait(remaining)
+            return self.head if self.alive else None
+
+    def included(self, hashes, from_block, to_block):
+        """
+        {hash: block number} of 32-byte hashes found in blocks from_block..to_block, and
+        the last block checked: blocks the HTTP node doesn't have yet end the range.
+        Missing blocks are fetched in one batch request.
+        """
+        from_block = max(from_block, 0)
+        with self._fetch_lock:
+            missing = [number for number in range(from_block, to_block + 1) if number not in self._blocks]
+            if missing:
+                results = batch_request(self.web3_node, [('eth_getBlockByNumber', [hex(number), False])
+                                                         for number in missing])
+                for number, block in zip(missing, results):
+                    if block is None or isinstance(block, RPCError):
+                        break
+                    self._blocks[number] = {bytes.fromhex(tx_hash[2:]) for tx_hash in block['transactions']}
+                while len(self._blocks) > CACHE_BLOCKS:
+                    self._blocks.popitem(last=False)
+            found = {}
+            checked = from_block - 1
+            for number in range(from_block, to_block + 1):
+                txs = self._blocks.get(number)
+                if txs is None:
+                    break
+                checked = number
+                for tx_hash in hashes:
+                    if tx_hash in txs:
+                        found[tx_hash] = number
+        return found, checked
+
+    def wait_included(self, tx_hash, timeout):
+        """Block number of a tx once a new head includes it, None on timeout or when the subscription is down."""
+        deadline = time.monotonic() + timeout
+        head = self.head
+        if not self.alive or head is None:
+            return None
+        checked = head - RECHECK_BLOCKS
+        while True:
+            found, checked = self.included({tx_hash}, checked + 1, head)
+            if found:
+                return found[tx_hash]
+            # blocks the HTTP node doesn't have yet are asked again after the next head, not at once
+            head = self.wait(head, deadline - time.monotonic())
+            if head is None:
+                return None
+
+
+class ReceiptWatch:
+    """
+    Picks pending txs to ask receipts for. Every one of them is due without a
+    subscription, while it is down and every RESYNC_INTERVAL; otherwise only
+    those whose hash is in blocks that came since the last cycle.
+    """
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+        # last block whose txs were matched and the head at the last cycle,
+        # blocks the HTTP node didn't have yet are matched after the next head
+        self.checked = None
+        self.head = None
+        self.polled = None
+        self.seen = set()
+
+    @property
+    def pushing(self):
+        return self.watcher is not None and self.watcher.alive
+
+    def due(self, pending):
+        """
+        pending is {key: [32-byte hashes]}. Returns {key: hash} of mined ones,
+        None if all of them are due.
+        """
+        now = time.monotonic()
+        if (not self.pushing or self.checked is None or now - self.polled > RESYNC_INTERVAL
+                or self.watcher.head - self.checked > CACHE_BLOCKS):
+            # blocks after the current head are matched next time
+            self.checked = self.head = self.watcher.head if self.pushing else None
+            self.polled = now
+            self.seen = set(pending)
+            return None
+
+        by_hash = {tx_hash: key for key, hashes in pending.items() for tx_hash in hashes}
+        found = {}
+        head = self.head = self.watcher.head
+        if head > self.checked:
+            found, self.checked = self.watcher.included(by_hash, self.checked + 1, head)
+        # added since the last cycle, maybe mined in a block matched before: cached blocks are free
+        new = {tx_hash for key, hashes in pending.items() if key not in self.seen for tx_hash in hashes}
+        if new:
+            found.update(self.watcher.included(new, self.checked - RECHECK_BLOCKS + 1, self.checked)[0])
+        self.seen = set(pending)
+        return {by_hash[tx_hash]: tx_hash for tx_hash in found}
+
+    def wait(self, timeout):
+        """Sleeps until a new head or timeout."""
+        if self.pushing:
+            self.watcher.wait(self.head, timeout)
+        else:
+            time.sleep(timeout)
+
+
+def check_subscription(url):
+    """Whether the endpoint accepts a newHeads subscription."""
+    watcher = HeadWatcher(url, None).start()
+    alive = watcher.alive
+    watcher.close()
+    return alive
+
+
+def get_watcher(web3_node):
+    """Started watcher of the first WebSocket or IPC endpoint, one per process, None without such endpoints."""
+    urls = [url for url in parse_endpoints(web3_node) if is_push_endpoint(url)]
+    if not urls:
+        return None
+    with _lock:
+        if web3_node not in _watchers:
+            _watchers[web3_node] = HeadWatcher(urls[0], web3_node).start()
+        return _watchers[web3_node]
+
+
+def close_watchers():
+    with _lock:
+        for watcher in _watchers.values():
+            watcher.close()
+        _watchers.clear()
@@ -0,0 +1,140 @@
+"""
+Timings of the hot paths: JSON-RPC calls per method, signing and db writes.
+
+Every observation is a (kind, name) pair with its duration, number of items
+(txs in a signed chunk, rows in a write) and error code. They are kept in
+memory by the command and saved when it exits: histograms as a Prometheus
+text file, observations one per line as a JSONL trace. 'stats' summarises
+the trace of the last run.
+"""
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+METRICS_FILE = 'metrics.prom'
+TRACE_FILE = 'trace.jsonl'
+# seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# the trace of longer runs keeps only the first observations, histograms count all of them
+MAX_TRACE = 1000000
+
+_lock = threading.Lock()
+# (kind, name) -> [bucket counts..., count, sum, items]
+_histograms = {}
+# (kind, name, error) -> count
+_errors = {}
+_trace = []
+_started = time.time()
+
+
+def observe(kind, name, seconds, items=1, error=None):
+    key = (kind, name)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 3)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[i] += 1
+                break
+        histogram[-3] += 1
+        histogram[-2] += seconds
+        histogram[-1] += items
+        if error is not None:
+            _errors[(kind, name, str(error))] = _errors.get((kind, name, str(error)), 0) + 1
+        if len(_trace) < MAX_TRACE:
+            _trace.append((time.time(), kind, name, seconds, items, error))
+
+
+@contextmanager
+def timer(kind, name, items=1):
+    """Observes the duration of the block, an exception is recorded as its class name."""
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        observe(kind, name, time.perf_counter() - started, items, type(e).__name__)
+        raise
+    observe(kind, name, time.perf_counter() - started, items)
+
+
+def reset():
+    global _started
+    with _lock:
+        _histograms.clear()
+        _errors.clear()
+        _trace.clear()
+        _started = time.time()
+
+
+def prometheus_text():
+    lines = [
+        '# HELP airdrop_duration_seconds Duration of RPC calls, signing and db writes.',
+        '# TYPE airdrop_duration_seconds histogram',
+    ]
+    with _lock:
+        histograms = {key: list(value) for key, value in _histograms.items()}
+        errors = dict(_errors)
+    for (kind, name), histogram in sorted(histograms.items()):
+        labels = f'kind="{kind}",name="{name}"'
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram):
+            cumulative += count
+            lines.append(f'airdrop_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'airdrop_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram[-3]}')
+        lines.append(f'airdrop_duration_seconds_sum{{{labels}}} {histogram[-2]:.6f}')
+        lines.append(f'airdrop_duration_seconds_count{{{labels}}} {histogram[-3]}')
+    lines += ['# HELP airdrop_items_total Txs or rows handled by the observed calls.',
+              '# TYPE airdrop_items_total counter']
+    for (kind, name), histogram in sorted(histograms.items()):
+        lines.append(f'airdrop_items_total{{kind="{kind}",name="{name}"}} {histogram[-1]}')
+    lines += ['# HELP airdrop_errors_total Failed calls by error code.',
+              '# TYPE airdrop_errors_total counter']
+    for (kind, name, error), count in sorted(errors.items()):
+        lines.append(f'airdrop_errors_total{{kind="{kind}",name="{name}",code="{error}"}} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def save(command, directory='.'):
+    """Writes metrics and trace of this run, a run without observations keeps the previous files."""
+    with _lock:
+        trace = list(_trace)
+    if not trace:
+        return
+    with open(os.path.join(directory, METRICS_FILE), 'w') as file:
+        file.write(prometheus_text())
+    with open(os.path.join(directory, TRACE_FILE), 'w') as file:
+        file.write(json.dumps({'command': command, 'started': _started,
+                               'seconds': round(time.time() - _started, 6)}) + '\n')
+        for ts, kind, name, seconds, items, error in trace:
+            file.write(json.dumps({'ts': round(ts, 6), 'kind': kind, 'name': name,
+                                   'ms': round(seconds * 1000, 3), 'items': items, 'error': error}) + '\n')
+
+
+def percentile(values, share):
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+def summarize(file):
+    """Run header and per (kind, name) count, items, errors and latency percentiles in ms of a trace."""
+    header = json.loads(next(file))
+    durations, items, errors = {}, {}, {}
+    for line in file:
+        event = json.loads(line)
+        key = (event['kind'], event['name'])
+        durations.setdefault(key, []).append(event['ms'])
+        items[key] = items.get(key, 0) + event['items']
+        if event['error'] is not None:
+            errors.setdefault(key, {})
+            errors[key][str(event['error'])] = errors[key].get(str(event['error']), 0) + 1
+    rows = []
+    for key in sorted(durations):
+        values = sorted(durations[key])
+        rows.append({'kind': key[0], 'name': key[1], 'count': len(values), 'items': items[key],
+                     'errors': errors.get(key, {}), 'total_ms': round(sum(values), 1),
+                     'p50_ms': percentile(values, 0.5), 'p95_ms': percentile(values, 0.95),
+                     'p99_ms': percentile(values, 0.99), 'max_ms': values[-1]})
+    return header, rows
@@ -1,8 +1,49 @@
+import re
+import ast
+import json
+
 import peewee as pw
 
 
 DBFILE = 'db.sqlite'
-db = pw.SqliteDatabase(DBFILE)
+PRAGMAS = {
+    'journal_mode': 'wal',
+    # with WAL only a power loss may lose last commits, the db stays consistent
+    'synchronous': 'normal',
+    'cache_size': -64 * 1024,  # KiB
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'memory',
+}
+db = pw.SqliteDatabase(DBFILE, pragmas=PRAGMAS)
+
+
+class JSONField(pw.TextField):
+    """Dict kept as canonical compact JSON, empty value is stored as ''."""
+
+    def db_value(self, value):
+        if not value:
+            return ''
+        return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+    def python_value(self, value):
+        return json.loads(value) if value else None
+
+
+RECEIPT_FIELDS = ('status', 'blockNumber', 'gasUsed', 'effectiveGasPrice')
+
+
+class ReceiptField(JSONField):
+    """Keeps only the receipt fields the airdrop needs, as integers."""
+
+    def db_value(self, value):
+        if not value:
+            return ''
+        receipt = {}
+        for key in RECEIPT_FIELDS:
+            item = value.get(key)
+            if item is not None:
+                receipt[key] = int(item, 16) if isinstance(item, str) else int(item)
+        return super().db_value(receipt)
 
 
 class BaseModel(pw.Model):
@@ -16,14 +57,24 @@ class Config(BaseModel):
     gas_price = pw.IntegerField()
     web3_node = pw.CharField(max_length=255)
     token = pw.CharField(max_length=42)
+    disperse = pw.CharField(max_length=42, default="0x0000000000000000000000000000000000000000")
     
     current_nonce = pw.IntegerField(default=0)
     eth_balance = pw.CharField(default=0)
     token_balance = pw.CharField(default=0)
 
 
+class Sender(BaseModel):
+    """Additional sender account with its own nonce lane, the main one is in Config."""
+    address = pw.CharField(max_length=42, unique=True)
+    private_key = pw.CharField(max_length=64)
+    current_nonce = pw.IntegerField(default=0)
+    eth_balance = pw.CharField(default=0)
+    token_balance = pw.CharField(default=0)
+
+
 class Recipient(BaseModel):
-    address = pw.CharField(max_length=42)
+    address = pw.CharField(max_length=42, index=True)
     amount = pw.DecimalField(max_digits=36, decimal_places=18)
 
 
@@ -32,15 +83,182 @@ class Tx(BaseModel):
     choices = (
         ('NEW', 'NEW'),
         ('SIGNED', 'SIGNED'),
+        # journal: marked before the signed tx goes to the node, SENT once the node took it
+        ('BROADCASTING', 'BROADCASTING'),
         ('SENT', 'SENT'),
         ('MINED', 'MINED'),
     )
 
-    raw_tx = pw.TextField(default="")
+    raw_tx = JSONField(default="")
     signed_tx = pw.BlobField(default="")
     tx_hash = pw.BlobField(default="")
-    tx_receipt = pw.TextField(default="")
+    tx_receipt = ReceiptField(default="")
 
     nonce = pw.IntegerField(null=True)
-    recipient = pw.ForeignKeyField(Recipient, backref='txes')
+    # empty for approve and disperse batch txs
+    recipient = pw.ForeignKeyField(Recipient, backref='txes', null=True)
+    # disperse batch tx paying this recipient, its nonce, status, hash and receipt
+    # are copied to the recipient's tx by the tx_batch_sync trigger
+    parent = pw.ForeignKeyField('self', backref='children', null=True)
+    # empty for the Config account
+    sender = pw.ForeignKeyField(Sender, backref='txes', null=True)
     status = pw.CharField(choices=choices)
+    # replacement watchdog: block the tx was first seen pending or last replaced at,
+    # 32-byte hashes of the versions it replaced
+    sent_block = pw.IntegerField(null=True)
+    replaced_hashes = pw.BlobField(default="")
+
+    class Meta:
+        indexes = (
+            # queue lookups: status filter ordered by nonce
+            (('status', 'nonce'), False),
+            # the same per sender lane
+            (('sender', 'status', 'nonce'), False),
+        )
+
+
+BATCH_SYNC_TRIGGER = """
+CREATE TRIGGER IF NOT EXISTS tx_batch_sync
+AFTER UPDATE OF status, nonce, tx_hash, tx_receipt ON tx
+WHEN NEW.parent_id IS NULL
+BEGIN
+    UPDATE tx SET status = NEW.status, nonce = NEW.nonce,
+                  tx_hash = NEW.tx_hash, tx_receipt = NEW.tx_receipt
+    WHERE parent_id = NEW.id;
+END
+"""
+
+
+def create_triggers():
+    db.execute_sql(BATCH_SYNC_TRIGGER)
+
+
+def migration_1(migrator):
+    """Disperse batches: disperse contract, tx parent, txs without recipient."""
+    from playhouse.migrate import migrate
+
+    config_columns = {column.name: column for column in db.get_columns('config')}
+    tx_columns = {column.name: column for column in db.get_columns('tx')}
+
+    operations = []
+    if 'disperse' not in config_columns:
+        operations.append(migrator.add_column('config', 'disperse', Config.disperse))
+    if 'parent_id' not in tx_columns:
+        operations.append(migrator.add_column('tx', 'parent_id', Tx.parent))
+    if not tx_columns['recipient_id'].null:
+        operations.append(migrator.drop_not_null('tx', 'recipient_id'))
+    migrate(*operations)
+    create_triggers()
+
+
+def migration_2(migrator):
+    """Indexes of queue and recipient lookups."""
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "tx_status_nonce" ON "tx" ("status", "nonce")')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "recipient_address" ON "recipient" ("address")')
+    db.execute_sql('ANALYZE')
+
+
+LEGACY_RECEIPT_FIELD = re.compile(r"'(%s)': '?(0x[0-9a-fA-F]+|\d+)" % '|'.join(RECEIPT_FIELDS))
+
+
+def decode_legacy_receipt(text):
+    """Receipt fields from str() of web3 AttributeDict or of a JSON-RPC receipt dict."""
+    receipt = {}
+    # logs repeat blockNumber, the receipt's own fields come first
+    for key, value in LEGACY_RECEIPT_FIELD.findall(text):
+        receipt.setdefault(key, value if value.startswith('0x') else int(value))
+    return receipt
+
+
+def migration_3(migrator):
+    """Canonical compact JSON in raw_tx and tx_receipt instead of Python reprs."""
+    last_id = 0
+    while True:
+        rows = db.execute_sql(
+            "SELECT id, raw_tx, tx_receipt FROM tx WHERE id > ? AND (raw_tx != '' OR tx_receipt != '') "
+            "ORDER BY id LIMIT 5000", (last_id,)).fetchall()
+        if not rows:
+            return
+        db.cursor().executemany(
+            "UPDATE tx SET raw_tx = ?, tx_receipt = ? WHERE id = ?",
+            [(Tx.raw_tx.db_value(ast.literal_eval(raw_tx)) if raw_tx else '',
+              Tx.tx_receipt.db_value(decode_legacy_receipt(tx_receipt)) if tx_receipt else '',
+              tx_id)
+             for tx_id, raw_tx, tx_receipt in rows])
+        last_id = rows[-1][0]
+
+
+def migration_4(migrator):
+    """Stuck tx replacement: pending since block and hashes of replaced versions."""
+    from playhouse.migrate import migrate
+
+    tx_columns = {column.name for column in db.get_columns('tx')}
+    operations = []
+    if 'sent_block' not in tx_columns:
+        operations.append(migrator.add_column('tx', 'sent_block', Tx.sent_block))
+    if 'replaced_hashes' not in tx_columns:
+        operations.append(migrator.add_column('tx', 'replaced_hashes', Tx.replaced_hashes))
+    migrate(*operations)
+
+
+def migration_5(migrator):
+    """Several sender accounts, each tx belongs to one of them."""
+    from playhouse.migrate import migrate
+
+    Sender.create_table(safe=True)
+    if 'sender_id' not in {column.name for column in db.get_columns('tx')}:
+        migrate(migrator.add_column('tx', 'sender_id', Tx.sender))
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "tx_sender_status_nonce" ON "tx" ("sender_id", "status", "nonce")')
+
+
+def migration_6(migrator):
+    """Hashes of SIGNED txs, known from signing on."""
+    from transactions import keccak
+
+    last_id = 0
+    while True:
+        rows = db.execute_sql(
+            "SELECT id, signed_tx FROM tx WHERE id > ? AND status = 'SIGNED' AND length(tx_hash) = 0 "
+            "ORDER BY id LIMIT 5000", (last_id,)).fetchall()
+        if not rows:
+            return
+        db.cursor().executemany("UPDATE tx SET tx_hash = ? WHERE id = ?",
+                                [(keccak(bytes(signed_tx)), tx_id) for tx_id, signed_tx in rows])
+        last_id = rows[-1][0]
+
+
+# migrations[i] upgrades db of version i to version i + 1
+MIGRATIONS = [
+    migration_1,
+    migration_2,
+    migration_3,
+    migration_4,
+    migration_5,
+    migration_6,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version():
+    return db.pragma('user_version')
+
+
+def set_schema_version(version):
+    db.pragma('user_version', version)
+
+
+def upgrade_schema():
+    """
+    Applies migrations missing in db, each one in its own transaction.
+    Returns versions before and after.
+    """
+    from playhouse.migrate import SqliteMigrator
+
+    migrator = SqliteMigrator(db)
+    version = start = schema_version()
+    while version < SCHEMA_VERSION:
+        with db.atomic():
+            MIGRATIONS[version](migrator)
+            version += 1
+            set_schema_version(version)
+    return start, version
@@ -0,0 +1,271 @@
+"""
+sign -> send -> receipt stages of the 'run' command working side by side.
+
+Every sender lane has a signer task and a sender task connected by a bounded
+queue, one receipt task polls txs of all lanes. Signing and network calls run
+in executors, db is written only from the event loop thread and every step is
+its own transaction, so a run can be resumed from any db state.
+"""
+import time
+import signal
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+from heads import ReceiptWatch, get_watcher
+from models import Tx
+from transactions import build_transfer, observed, timed_sign_chunk, transfer_template
+
+# end of a lane's queue
+DONE = object()
+
+
+class Stopped(Exception):
+    pass
+
+
+class Pipeline:
+
+    def __init__(self, app, config, token, gas_limit, fees, chain_id, lanes,
+                 window=8, queue_size=1000, chunk=100, workers=1, batch_size=100,
+                 poll_interval=2.0, progress_interval=1.0):
+        # stage functions are looked up on the airdrop module at call time
+        self.app = app
+        self.config = config
+        self.token = token
+        self.gas_limit = gas_limit
+        self.fees = fees
+        self.chain_id = chain_id
+        self.lanes = lanes
+        self.window = window
+        self.chunk = chunk
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.progress_interval = progress_interval
+
+        self.queues = [asyncio.Queue(maxsize=queue_size) for _ in lanes]
+        self.in_flight = [0] * len(lanes)
+        self.slots = [asyncio.Condition() for _ in lanes]
+        # tx id -> (lane, tx) of SENT txs
+        self.pending = {}
+        self.stopping = asyncio.Event()
+        self.forced = asyncio.Event()
+        self.error = None
+
+        self.to_sign = 0
+        self.signed = self.sent = self.mined = 0
+        self.started = time.monotonic()
+        self._last = (self.started, 0, 0, 0)
+
+    def lane_of(self, tx):
+        return next(i for i, sender in enumerate(self.lanes)
+                    if (sender.id if sender else None) == tx.sender_id)
+
+    async def until_stopped(self, awaitable):
+        """Result of awaitable, raises Stopped if stop was requested first."""
+        task = asyncio.ensure_future(awaitable)
+        stopper = asyncio.ensure_future(self.stopping.wait())
+        await asyncio.wait({task, stopper}, return_when=asyncio.FIRST_COMPLETED)
+        stopper.cancel()
+        if task.done():
+            return task.result()
+        task.cancel()
+        raise Stopped()
+
+    def interrupt(self):
+        if not self.stopping.is_set():
+            print("\nStopping: no new txs are sent, waiting for receipts of sent ones. "
+                  "Press Ctrl+C again to quit now.")
+            self.stopping.set()
+        else:
+            self.forced.set()
+
+    def task_done(self, task):
+        if not task.cancelled() and task.exception() is not None and self.error is None:
+            self.error = task.exception()
+            self.stopping.set()
+            self.forced.set()
+
+    async def sign_lane(self, lane, pool):
+        """Queues SIGNED txs left from before, then signs NEW ones chunk by chunk."""
+        loop = asyncio.get_running_loop()
+        sender = self.lanes[lane]
+        account = sender or self.config
+        queue = self.queues[lane]
+
+        last_nonce = None
+        while True:
+            txs = (Tx.select()
+                   .where(Tx.status == 'SIGNED', Tx.parent.is_null(), self.app.sender_filter(sender))
+                   .order_by(Tx.nonce)
+                   .limit(self.chunk))
+            if last_nonce is not None:
+                txs = txs.where(Tx.nonce > last_nonce)
+            txs = list(txs)
+            if not txs:
+                break
+            for tx in txs:
+                await queue.put(tx)
+            last_nonce = txs[-1].nonce
+
+        used = (Tx.select(Tx.nonce)
+                .where(Tx.nonce.is_null(False), Tx.parent.is_null(), self.app.sender_filter(sender))
+                .order_by(Tx.nonce.desc())
+                .scalar())
+        nonce = max(account.current_nonce, used + 1 if used is not None else 0)
+        template = transfer_template(account.address, self.token, self.gas_limit, self.fees, self.chain_id)
+        while not self.stopping.is_set():
+            batch = list(self.app.new_transfers().where(self.app.sender_filter(sender)).limit(self.chunk))
+            if not batch:
+                break
+            items = []
+            for tx in batch:
+                items.append((tx.id, build_transfer(template, tx.recipient.address,
+                                                    tx.recipient.amount, nonce)))
+                nonce += 1
+            signed = observed(await loop.run_in_executor(pool, timed_sign_chunk, account.private_key, items))
+            self.app.save_signed(signed)
+            self.signed += len(signed)
+            for tx in Tx.select().where(Tx.id.in_([tx.id for tx in batch])).order_by(Tx.nonce):
+                await queue.put(tx)
+        await queue.put(DONE)
+
+    async def free_slot(self, lane):
+        async with self.slots[lane]:
+            await self.slots[lane].wait_for(lambda: self.in_flight[lane] < self.window)
+
+    async def send_lane(self, lane):
+        """Sends queued txs in nonce order keeping up to window of them in flight."""
+        loop = asyncio.get_running_loop()
+        sender = self.lanes[lane]
+        queue = self.queues[lane]
+        try:
+            while True:
+                tx = await self.until_stopped(queue.get())
+                if tx is DONE:
+                    return
+                await self.until_stopped(self.free_slot(lane))
+                # txs already waiting fill the rest of the window, checked with one batch
+                txs = [tx]
+                while len(txs) < self.window - self.in_flight[lane] and not queue.empty():
+                    txs.append(queue.get_nowait())
+                done = txs[-1] is DONE
+                if done:
+                    txs.pop()
+
+                # balances were checked by preflight, txs are not simulated one by one;
+                # the batch is journaled first, a crash while sending leaves it to 'recover'
+                self.app.mark_broadcasting(txs)
+                for i, tx in enumerate(txs):
+                    if self.stopping.is_set():
+                        self.app.unmark_broadcasting(txs[i:])
+                        return
+                    tx_hash = await loop.run_in_executor(None, self.app.push_tx, self.config, tx)
+                    if tx_hash is None:
+                        self.app.unmark_broadcasting(txs[i + 1:])
+                        return
+                    self.app.mark_sent(self.config, tx, tx_hash, sender)
+                    self.pending[tx.id] = (lane, tx)
+                    self.in_flight[lane] += 1
+                    self.sent += 1
+                if done:
+                    return
+        except Stopped:
+            return
+
+    async def watch_receipts(self, senders):
+        """
+        Polls receipts of all pending txs until senders are finished and nothing is pending.
+        With a newHeads subscription only txs found in new blocks are asked.
+        """
+        loop = asyncio.get_running_loop()
+        watch = ReceiptWatch(await loop.run_in_executor(None, get_watcher, self.config.web3_node))
+        while not self.forced.is_set():
+            if self.pending:
+                txs = [tx for _, tx in self.pending.values()]
+                mined = await loop.run_in_executor(None, self.app.pending_receipts,
+                                                   self.config, watch, txs, self.batch_size)
+                self.app.save_mined(mined.values())
+                failed = [tx for tx in mined.values() if self.app.failed_on_chain(tx.tx_receipt)]
+                if failed and not self.stopping.is_set():
+                    print(f"\nTx with nonce {self.pending[failed[0].id][1].nonce} failed on chain. "
+                          "Sending stopped, check balances.")
+                    self.stopping.set()
+                for tx_id in mined:
+                    lane, _ = self.pending.pop(tx_id)
+                    async with self.slots[lane]:
+                        self.in_flight[lane] -= 1
+                        self.slots[lane].notify_all()
+                self.mined += len(mined)
+            elif all(task.done() for task in senders):
+                return
+            if watch.pushing:
+                # until a new head, newly sent txs are matched against recent blocks at every cycle
+                forced = asyncio.ensure_future(self.forced.wait())
+                await asyncio.wait({forced, loop.run_in_executor(None, watch.wait, self.poll_interval)},
+                                   return_when=asyncio.FIRST_COMPLETED)
+                forced.cancel()
+                continue
+            try:
+                await asyncio.wait_for(self.forced.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def progress(self, end=""):
+        now = time.monotonic()
+        started, signed, sent, mined = self._last
+        elapsed = max(now - started, 1e-9)
+        self._last = (now, self.signed, self.sent, self.mined)
+        queued = sum(queue.qsize() for queue in self.queues)
+        print(f"\rsigned {self.signed}/{self.to_sign} {(self.signed - signed) / elapsed:.0f}/s | "
+              f"sent {self.sent} {(self.sent - sent) / elapsed:.0f}/s | "
+              f"mined {self.mined} {(self.mined - mined) / elapsed:.0f}/s | "
+              f"queued {queued} | in flight {len(self.pending)}   ", end=end, flush=True)
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            self.progress()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGINT, self.interrupt)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+        self.to_sign = self.app.new_transfers().count()
+        # sent before a crash: their receipts come first and they take window slots
+        for tx in Tx.select().where(Tx.status == 'SENT', Tx.parent.is_null()):
+            lane = self.lane_of(tx)
+            self.pending[tx.id] = (lane, tx)
+            self.in_flight[lane] += 1
+
+        pool = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        signers = [asyncio.ensure_future(self.sign_lane(lane, pool)) for lane in range(len(self.lanes))]
+        senders = [asyncio.ensure_future(self.send_lane(lane)) for lane in range(len(self.lanes))]
+        receipts = asyncio.ensure_future(self.watch_receipts(senders))
+        reporter = asyncio.ensure_future(self.report())
+        for task in signers + senders + [receipts]:
+            task.add_done_callback(self.task_done)
+        try:
+            await asyncio.wait(senders)
+            # a lane stopped on error doesn't need more signed txs
+            for task in signers:
+                task.cancel()
+            await asyncio.wait(signers)
+            await receipts
+        finally:
+            for task in signers + senders + [receipts, reporter]:
+                task.cancel()
+            if pool is not None:
+                pool.shutdown()
+            try:
+                loop.remove_signal_handler(signal.SIGINT)
+            except (NotImplementedError, RuntimeError):
+                pass
+            # the last line has average rates of the whole run
+            self._last = (self.started, 0, 0, 0)
+            self.progress(end="\n")
+        if self.error is not None:
+            raise self.error
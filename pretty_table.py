@@ -7,15 +7,24 @@ def print_pretty_table(data, cell_sep=' | ', header_separator=True):
         columns = [data[row][col] for row in range(rows)]
         col_width.append(len(max(columns, key=len)))
 
-    separator = "-+-".join('-' * n for n in col_width)
+    print_table_rows(data[0], data[1:], col_width, cell_sep, header_separator)
+
 
-    for i, row in enumerate(range(rows)):
-        if i == 1 and header_separator:
-            print(separator)
+def print_table_rows(header, rows, col_width, cell_sep=' | ', header_separator=True):
+    """
+    Prints rows of any iterable one at a time, so they don't have to be in memory.
+    Column widths are known upfront and grow to fit the header, a longer value
+    only widens its own row.
+    """
+    col_width = [max(width, len(title)) for width, title in zip(col_width, header)]
+    separator = "-+-".join('-' * n for n in col_width)
 
-        result = []
-        for col in range(cols):
-            item = data[row][col].ljust(col_width[col])
-            result.append(item)
+    print(cell_sep.join(item.ljust(width) for item, width in zip(header, col_width)))
+    if header_separator:
+        print(separator)
 
-        print(cell_sep.join(result))
+    count = 0
+    for row in rows:
+        print(cell_sep.join(item.ljust(width) for item, width in zip(row, col_width)))
+        count += 1
+    return count
@@ -0,0 +1,512 @@
+import re
+import json
+import time
+import random
+import itertools
+import threading
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+from web3 import Web3
+from web3.providers.base import JSONBaseProvider
+
+import metrics
+
+
+# (connect, read) seconds
+TIMEOUT = (5, 20)
+POOL_SIZE = 32
+
+# rounds over all endpoints of a throttled, timed out or failed request, with full jitter backoff
+RETRIES = 4
+BACKOFF = 0.25
+MAX_BACKOFF = 8.0
+RETRY_STATUSES = {429, 502, 503, 504}
+THROTTLE_STATUSES = {429, 503}
+
+# limiter: requests per second are limited only after an endpoint throttled us
+MIN_RATE = 1.0
+MAX_RATE = 10000.0
+# requests per second added every second of traffic without throttling
+RATE_INCREASE = 5.0
+# seconds of rate a burst can take at once
+BURST = 0.2
+# smoothed latency this many times the best one, and above the floor, shrinks the window
+LATENCY_FACTOR = 3.0
+LATENCY_FLOOR = 0.05
+
+# JSON-RPC errors of hosted nodes refusing because of request rate
+RATE_LIMIT_CODES = {-32005, -32029, -32090, 429}
+RATE_LIMIT_MESSAGE = re.compile(r'rate limit|too many requests|request count|rate exceeded|capacity exceeded', re.I)
+# -32005 also means a log query is too large, which is not about the rate
+TOO_MANY_RESULTS = re.compile(r'returned more than|response size|block range', re.I)
+ERROR_KINDS = [
+    ('nonce_too_low', re.compile(r'nonce too low|nonce is too low|OldNonce|invalid nonce', re.I)),
+    ('already_known', re.compile(r'already known|known transaction|already imported|AlreadyKnown|already exists',
+                                 re.I)),
+    ('underpriced', re.compile(r'underpriced|fee too low|gas price too low', re.I)),
+    ('insufficient_funds', re.compile(r'insufficient funds', re.I)),
+]
+
+_request_ids = itertools.count(1)
+_pools = {}
+_web3 = {}
+_lock = threading.Lock()
+
+
+class RPCError(ValueError):
+    """JSON-RPC error object returned by the node for one call."""
+
+    def __init__(self, error):
+        super().__init__(error)
+        self.error = error
+
+    @property
+    def code(self):
+        return self.error.get('code') if isinstance(self.error, dict) else None
+
+    @property
+    def kind(self):
+        return classify_error(self.error)
+
+
+def classify_error(error):
+    """
+    Kind of a JSON-RPC error object or message: 'rate_limited', 'nonce_too_low',
+    'already_known', 'underpriced', 'insufficient_funds' or 'other'.
+    """
+    code = error.get('code') if isinstance(error, dict) else None
+    message = str(error.get('message', '')) if isinstance(error, dict) else str(error)
+    if RATE_LIMIT_MESSAGE.search(message) or (code in RATE_LIMIT_CODES and not TOO_MANY_RESULTS.search(message)):
+        return 'rate_limited'
+    for kind, pattern in ERROR_KINDS:
+        if pattern.search(message):
+            return kind
+    return 'other'
+
+
+def rate_limited(content):
+    """'all' if the JSON-RPC response is a rate limit error, 'some' if some calls of a batch are, else None."""
+    if b'"error"' not in content:
+        return None
+    try:
+        response = json.loads(content)
+    except ValueError:
+        return None
+    responses = response if isinstance(response, list) else [response]
+    limited = [isinstance(item, dict) and 'error' in item and classify_error(item['error']) == 'rate_limited'
+               for item in responses]
+    if limited and all(limited) and not isinstance(response, list):
+        return 'all'
+    return 'some' if any(limited) else None
+
+
+def backoff(attempt, retry_after=None):
+    """Full jitter exponential delay, at least the server's Retry-After."""
+    delay = random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** attempt))
+    return max(delay, retry_after or 0)
+
+
+def retry_after(response):
+    try:
+        return min(float(response.headers.get('Retry-After')), MAX_BACKOFF)
+    except (TypeError, ValueError):
+        return None
+
+
+class Limiter:
+    """
+    Client-side AIMD limit of one endpoint: a window of requests in flight and,
+    once the endpoint throttled us, a token bucket of requests per second.
+    Successes raise both additively, 429 and rate limit errors halve them at most
+    once per round trip, latency far above the best seen shrinks the window.
+    Starts with the full window and no rate limit, so endpoints that never
+    throttle run as fast as before.
+    """
+
+    def __init__(self, max_concurrency=POOL_SIZE):
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        # requests per second, None until the first throttling
+        self.rate = None
+        self.tokens = 0.0
+        self.in_flight = 0
+        self.paused_until = 0.0
+        # seconds, exponentially weighted and the best one
+        self.latency = None
+        self.best_latency = None
+        self.decreased = 0.0
+        self.throttled = 0
+        # finish times of successes in the last second
+        self._recent = deque()
+        self._refilled = time.monotonic()
+        self._changed = threading.Condition()
+
+    def acquire(self):
+        """Blocks until the request fits the window and the rate. Returns seconds waited."""
+        started = time.monotonic()
+        with self._changed:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.in_flight >= max(int(self.concurrency), 1):
+                        # until a release
+                        wait = None
+                    elif self.rate is None:
+                        break
+                    elif self.tokens >= 1:
+                        self.tokens -= 1
+                        break
+                    else:
+                        wait = (1 - self.tokens) / self.rate
+                self._changed.wait(wait)
+            self.in_flight += 1
+        return time.monotonic() - started
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(max(self.rate * BURST, 1.0), self.tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def release(self, latency=None, throttled=False, pause=None):
+        """Ends a request: latency of a success, or throttled with the server's pause."""
+        with self._changed:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self._decrease(now, pause)
+            elif latency is not None:
+                self._increase(now, latency)
+            self._changed.notify_all()
+
+    def _round_trip(self):
+        return max(self.latency or 0.0, 0.05)
+
+    def _increase(self, now, latency):
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        self.best_latency = latency if self.best_latency is None else min(self.best_latency, latency)
+        self._recent.append(now)
+        while self._recent and self._recent[0] < now - 1:
+            self._recent.popleft()
+        if (self.latency > LATENCY_FLOOR and self.latency > LATENCY_FACTOR * self.best_latency
+                and now - self.decreased > self._round_trip()):
+            self.concurrency = max(1.0, self.concurrency * 0.8)
+            self.decreased = now
+            return
+        self.concurrency = min(float(self.max_concurrency), self.concurrency + 1 / self.concurrency)
+        if self.rate is not None:
+            self.rate = min(MAX_RATE, self.rate + RATE_INCREASE / self.rate)
+
+    def _decrease(self, now, pause):
+        self.throttled += 1
+        if pause:
+            self.paused_until = max(self.paused_until, now + pause)
+        if now - self.decreased <= self._round_trip():
+            return
+        while self._recent and self._recent[0] < now - 1:
+            self._recent.popleft()
+        # the first throttling starts from the rate that was reached
+        rate = self.rate if self.rate is not None else float(len(self._recent))
+        self.rate = max(MIN_RATE, rate / 2)
+        self.tokens = 0.0
+        self.concurrency = max(1.0, min(self.concurrency, self.in_flight + 1) / 2)
+        self.decreased = now
+
+    def stats(self):
+        with self._changed:
+            return {'rate': round(self.rate, 1) if self.rate is not None else None,
+                    'concurrency': int(self.concurrency), 'throttled': self.throttled}
+
+
+class Endpoint:
+    """One node URL with its own keep-alive session and health/latency score."""
+
+    def __init__(self, url):
+        self.url = url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.health = 1.0
+        # exponentially weighted average, seconds
+        self.latency = None
+        self.requests = 0
+        self.errors = 0
+        self.limiter = Limiter()
+
+    def weight(self, default_latency):
+        latency = self.latency if self.latency is not None else default_latency
+        return self.health ** 2 / max(latency, 0.001)
+
+    def succeeded(self, elapsed):
+        self.requests += 1
+        self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+        self.health = min(1.0, self.health + 0.2 * (1 - self.health) + 0.01)
+
+    def failed(self):
+        self.requests += 1
+        self.errors += 1
+        self.health *= 0.5
+
+    def connections(self):
+        """Number of TCP connections opened so far."""
+        pools = self.session.get_adapter(self.url).poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+
+class EndpointPool:
+    """
+    Sends JSON-RPC bodies to one of the endpoints. Endpoints are picked at random
+    weighted by health and latency, on connection errors, timeouts and HTTP error
+    responses the next endpoint is tried.
+    """
+
+    def __init__(self, urls, timeout=TIMEOUT):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.timeout = timeout
+        # cleared when a node refuses JSON-RPC batch
+        self.batches = True
+        self._lock = threading.Lock()
+
+    def ordered(self):
+        with self._lock:
+            known = [e.latency for e in self.endpoints if e.latency is not None]
+            # untried endpoints look as fast as the average, so they get a chance
+            default_latency = sum(known) / len(known) if known else 0.1
+            candidates = list(self.endpoints)
+            weights = [e.weight(default_latency) for e in candidates]
+        ordered = []
+        while candidates:
+            i = random.choices(range(len(candidates)), weights=weights)[0] if sum(weights) else 0
+            ordered.append(candidates.pop(i))
+            weights.pop(i)
+        return ordered
+
+    def post(self, data):
+        """
+        Posts JSON body to the best endpoint within its limiter, returns response content.
+        Throttled requests (HTTP 429, rate limit errors), timeouts and gateway errors
+        are tried on the next endpoint and then in rounds with backoff. A response
+        still rate limited after all rounds is returned as it is.
+        """
+        error = content = None
+        for attempt in range(RETRIES + 1):
+            retry = False
+            pause = None
+            for endpoint in self.ordered():
+                waited = endpoint.limiter.acquire()
+                if waited > 0.001:
+                    metrics.observe('rpc', 'limiter_wait', waited)
+                started = time.perf_counter()
+                try:
+                    response = endpoint.session.post(
+                        endpoint.url, data=data, timeout=self.timeout,
+                        headers={'Content-Type': 'application/json'})
+                except requests.RequestException as e:
+                    endpoint.limiter.release()
+                    with self._lock:
+                        endpoint.failed()
+                    error = e
+                    # a refused connection is not worth another round, a timeout may be
+                    retry = retry or isinstance(e, requests.Timeout)
+                    continue
+                elapsed = time.perf_counter() - started
+                if response.status_code in THROTTLE_STATUSES:
+                    pause = retry_after(response)
+                    endpoint.limiter.release(throttled=True, pause=pause)
+                elif response.ok and rate_limited(response.content) == 'all':
+                    endpoint.limiter.release(throttled=True)
+                    content = response.content
+                    retry = True
+                    continue
+                else:
+                    endpoint.limiter.release(latency=elapsed)
+                try:
+                    response.raise_for_status()
+                except requests.RequestException as e:
+                    with self._lock:
+                        endpoint.failed()
+                    error = e
+                    retry = retry or response.status_code in RETRY_STATUSES
+                    continue
+                with self._lock:
+                    endpoint.succeeded(elapsed)
+                return response.content
+            if not retry or attempt == RETRIES:
+                break
+            time.sleep(backoff(attempt, pause))
+        if content is not None:
+            return content
+        raise error
+
+    def stats(self):
+        return [{
+            'url': e.url,
+            'requests': e.requests,
+            'errors': e.errors,
+            'connections': e.connections(),
+            'latency_ms': round(e.latency * 1000, 1) if e.latency is not None else None,
+            'health': round(e.health, 2),
+            **e.limiter.stats(),
+        } for e in self.endpoints]
+
+
+class PooledProvider(JSONBaseProvider):
+
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+
+    def make_request(self, method, params):
+        started = time.perf_counter()
+        try:
+            response = self.decode_rpc_response(self.pool.post(self.encode_rpc_request(method, params)))
+        except Exception as e:
+            metrics.observe('rpc', method, time.perf_counter() - started, error=type(e).__name__)
+            raise
+        error = RPCError(response['error']).code or 'error' if 'error' in response else None
+        metrics.observe('rpc', method, time.perf_counter() - started, error=error)
+        return response
+
+
+def parse_endpoints(web3_node):
+    """Config.web3_node keeps one or several endpoints separated by commas or spaces."""
+    return [url for url in re.split(r'[,\s]+', web3_node.strip()) if url]
+
+
+def is_push_endpoint(url):
+    """WebSocket or IPC endpoint, used for the newHeads subscription, see heads.py."""
+    return url.startswith(('ws://', 'wss://', 'ipc://')) or url.endswith('.ipc')
+
+
+def get_pool(web3_node):
+    """
+    One pool per endpoint list per process, so connections are reused between calls.
+    Requests go to HTTP endpoints only.
+    """
+    with _lock:
+        if web3_node not in _pools:
+            endpoints = parse_endpoints(web3_node)
+            _pools[web3_node] = EndpointPool([url for url in endpoints if not is_push_endpoint(url)] or endpoints)
+        return _pools[web3_node]
+
+
+def get_web3(web3_node):
+    pool = get_pool(web3_node)
+    with _lock:
+        if web3_node not in _web3:
+            _web3[web3_node] = Web3(PooledProvider(pool))
+        return _web3[web3_node]
+
+
+def make_payload(calls):
+    return [{'jsonrpc': '2.0', 'id': next(_request_ids), 'method': method, 'params': params}
+            for method, params in calls]
+
+
+def match_responses(payload, responses):
+    """
+    Orders batch responses as requests in payload. Nodes may answer in any order,
+    so responses are matched by id. Failed calls are returned as RPCError instances.
+    """
+    by_id = {response.get('id'): response for response in responses}
+    results = []
+    for request in payload:
+        response = by_id.get(request['id'])
+        if response is None:
+            results.append(RPCError({'code': None, 'message': 'no response in batch'}))
+        elif 'error' in response:
+            results.append(RPCError(response['error']))
+        else:
+            results.append(response.get('result'))
+    return results
+
+
+class BatchClient:
+    """
+    Collects read calls and sends them as JSON-RPC batches of up to max_batch calls.
+    Results are returned in order of add() calls, failed calls as RPCError instances.
+    If node refuses batches, the pool falls back to sequential calls for the rest of the run.
+    """
+
+    def __init__(self, web3_node, max_batch=100):
+        self.pool = get_pool(web3_node)
+        self.max_batch = max_batch
+        self.calls = []
+
+    def add(self, method, params):
+        self.calls.append((method, params))
+        return len(self.calls) - 1
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        results = []
+        for start in range(0, len(calls), self.max_batch):
+            results.extend(self._execute(calls[start:start + self.max_batch]))
+        return results
+
+    def _execute(self, calls):
+        if self.pool.batches and len(calls) > 1:
+            results = self._batch(calls)
+            if results is None:
+                self.pool.batches = False
+            else:
+                # calls the node refused because of the rate are sent again after a backoff
+                for attempt in range(RETRIES):
+                    limited = [i for i, result in enumerate(results)
+                               if isinstance(result, RPCError) and result.kind == 'rate_limited']
+                    if not limited:
+                        break
+                    time.sleep(backoff(attempt))
+                    retried = self._batch([calls[i] for i in limited]) if len(limited) > 1 else \
+                        [self._call(*calls[limited[0]])]
+                    if retried is None:
+                        break
+                    for i, result in zip(limited, retried):
+                        results[i] = result
+                return results
+        return [self._call(method, params) for method, params in calls]
+
+    def _batch(self, calls):
+        """Results of one batch request, None if the node answered it with a single error."""
+        payload = make_payload(calls)
+        started = time.perf_counter()
+        responses = self._post(calls, json.dumps(payload))
+        if not isinstance(responses, list):
+            return None
+        results = match_responses(payload, responses)
+        observe_calls(calls, results, time.perf_counter() - started)
+        return results
+
+    def _call(self, method, params):
+        payload = make_payload([(method, params)])
+        started = time.perf_counter()
+        result = match_responses(payload, [self._post([(method, params)], json.dumps(payload[0]))])[0]
+        observe_calls([(method, params)], [result], time.perf_counter() - started)
+        return result
+
+    def _post(self, calls, data):
+        started = time.perf_counter()
+        try:
+            return json.loads(self.pool.post(data))
+        except Exception as e:
+            for method, _ in calls:
+                metrics.observe('rpc', method, time.perf_counter() - started, error=type(e).__name__)
+            raise
+
+
+def observe_calls(calls, results, elapsed):
+    """Every call of a batch is observed with the latency of the whole request."""
+    for (method, _), result in zip(calls, results):
+        metrics.observe('rpc', method, elapsed, error=result.code or 'error' if isinstance(result, RPCError) else None)
+
+
+def batch_request(web3_node, calls, max_batch=100):
+    """Sends (method, params) calls in batches, returns their results in the same order."""
+    client = BatchClient(web3_node, max_batch)
+    for method, params in calls:
+        client.add(method, params)
+    return client.execute()
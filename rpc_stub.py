@@ -0,0 +1,585 @@
+"""
+Local JSON-RPC node stand-in for tests and benchmarks.
+Methods are plain callables taking params list, unknown methods return -32601.
+With rate_limit requests per second, StubNode refuses the rest as a hosted node
+does: HTTP 429 with Retry-After, or a -32005 error with limit_status 'json'.
+StubChain provides methods of a chain with one ERC-20 token.
+"""
+import json
+import time
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from transactions import TRANSFER_GAS, TRANSFER_TOPIC, address_topic, keccak, to_checksum_address
+
+
+class StubNode:
+
+    def __init__(self, methods=None, latency=0.0, batches=True, rate_limit=None, limit_status=429,
+                 retry_after=None):
+        self.methods = dict(methods or {})
+        self.latency = latency
+        self.batches = batches
+        self.rate_limit = rate_limit
+        self.limit_status = limit_status
+        self.retry_after = retry_after
+        self.calls = []
+        self.http_requests = 0
+        self.connections = 0
+        self.throttled = 0
+        # times of requests in the last second
+        self._recent = deque()
+        self._rate_lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}/'
+
+    def handle_call(self, request):
+        method = self.methods.get(request.get('method'))
+        self.calls.append(request.get('method'))
+        response = {'jsonrpc': '2.0', 'id': request.get('id')}
+        if method is None:
+            response['error'] = {'code': -32601, 'message': 'the method does not exist'}
+            return response
+        try:
+            response['result'] = method(request.get('params') or [])
+        except StubError as e:
+            response['error'] = {'code': e.code, 'message': e.message}
+        return response
+
+    def over_limit(self):
+        if self.rate_limit is None:
+            return False
+        with self._rate_lock:
+            now = time.monotonic()
+            while self._recent and self._recent[0] < now - 1:
+                self._recent.popleft()
+            if len(self._recent) >= self.rate_limit:
+                self.throttled += 1
+                return True
+            self._recent.append(now)
+            return False
+
+    def handle_body(self, body):
+        if self.latency:
+            time.sleep(self.latency)
+        request = json.loads(body)
+        if isinstance(request, list):
+            if not self.batches:
+                return {'jsonrpc': '2.0', 'id': None,
+                        'error': {'code': -32600, 'message': 'batch requests are not supported'}}
+            return [self.handle_call(item) for item in request]
+        return self.handle_call(request)
+
+    def start(self):
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are separate writes, with Nagle the body waits for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                node.connections += 1
+
+            def do_POST(self):
+                node.http_requests += 1
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                status = 200
+                if not node.over_limit():
+                    response = node.handle_body(body)
+                elif node.limit_status == 'json':
+                    error = {'code': -32005, 'message': 'request rate exceeded'}
+                    request = json.loads(body)
+                    response = ([{'jsonrpc': '2.0', 'id': item.get('id'), 'error': error} for item in request]
+                                if isinstance(request, list) else
+                                {'jsonrpc': '2.0', 'id': request.get('id'), 'error': error})
+                else:
+                    status = node.limit_status
+                    response = {'jsonrpc': '2.0', 'id': None, 'error': {'code': 429, 'message': 'Too Many Requests'}}
+                data = json.dumps(response).encode()
+                self.send_response(status)
+                if status != 200 and node.retry_after is not None:
+                    self.send_header('Retry-After', str(node.retry_after))
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class StubPushNode:
+    """
+    WebSocket, or IPC socket with path, JSON-RPC stand-in with eth_subscribe('newHeads'):
+    subscribers get a notification for every new block number returned by head.
+    Other methods are called as by StubNode.
+    """
+
+    def __init__(self, methods=None, head=None, path=None, interval=0.005):
+        self.node = StubNode(methods)
+        self.head = head or (lambda: 0)
+        self.path = path
+        self.interval = interval
+        self.notifications = 0
+        self._loop = None
+        self._server = None
+        self._port = None
+        self._connections = set()
+        self._ready = threading.Event()
+        self._thread = None
+
+    @property
+    def url(self):
+        return self.path if self.path is not None else f'ws://127.0.0.1:{self._port}'
+
+    @property
+    def calls(self):
+        return self.node.calls
+
+    async def serve(self, send, receive):
+        """Answers calls of one connection, receive returns None when it is closed."""
+        import asyncio
+
+        notifier = None
+        try:
+            while True:
+                request = await receive()
+                if request is None:
+                    return
+                if request.get('method') == 'eth_subscribe':
+                    self.node.calls.append('eth_subscribe')
+                    # heads after the reply are notified
+                    head = self.head()
+                    await send({'jsonrpc': '2.0', 'id': request.get('id'), 'result': '0x1'})
+                    if notifier is None:
+                        notifier = asyncio.ensure_future(self.notify(send, head))
+                else:
+                    await send(self.node.handle_call(request))
+        finally:
+            if notifier is not None:
+                notifier.cancel()
+
+    async def notify(self, send, last):
+        import asyncio
+
+        while True:
+            await asyncio.sleep(self.interval)
+            head = self.head()
+            for number in range(last + 1, head + 1):
+                self.notifications += 1
+                await send({'jsonrpc': '2.0', 'method': 'eth_subscription', 'params': {
+                    'subscription': '0x1', 'result': {'number': hex(number), 'hash': word(number)}}})
+            last = max(last, head)
+
+    async def handle_ws(self, request):
+        from aiohttp import web, WSMsgType
+
+        websocket = web.WebSocketResponse(timeout=1)
+        await websocket.prepare(request)
+        self._connections.add(websocket)
+
+        async def send(message):
+            await websocket.send_str(json.dumps(message))
+
+        async def receive():
+            message = await websocket.receive()
+            return json.loads(message.data) if message.type == WSMsgType.TEXT else None
+
+        try:
+            await self.serve(send, receive)
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.discard(websocket)
+        return websocket
+
+    async def handle_ipc(self, reader, writer):
+        self._connections.add(writer)
+        decoder = json.JSONDecoder()
+        buffer = ''
+
+        async def send(message):
+            writer.write(json.dumps(message).encode() + b'\n')
+            await writer.drain()
+
+        async def receive():
+            nonlocal buffer
+            while True:
+                text = buffer.lstrip()
+                if text:
+                    try:
+                        message, end = decoder.raw_decode(text)
+                    except ValueError:
+                        pass
+                    else:
+                        buffer = text[end:]
+                        return message
+                chunk = await reader.read(65536)
+                if not chunk:
+                    return None
+                buffer += chunk.decode()
+
+        try:
+            await self.serve(send, receive)
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    def drop(self):
+        """Closes all connections, as a restarted node would."""
+        import asyncio
+
+        async def close():
+            for connection in list(self._connections):
+                result = connection.close()
+                if asyncio.iscoroutine(result):
+                    await result
+
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result()
+
+    async def listen(self):
+        import asyncio
+        from aiohttp import web
+
+        if self.path is not None:
+            server = await asyncio.start_unix_server(self.handle_ipc, self.path)
+
+            async def close():
+                server.close()
+                await server.wait_closed()
+            return close
+        app = web.Application()
+        app.router.add_get('/', self.handle_ws)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        self._port = runner.addresses[0][1]
+        return runner.cleanup
+
+    def _run(self):
+        import asyncio
+
+        loop = self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._server = loop.run_until_complete(self.listen())
+        self._ready.set()
+        loop.run_forever()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        import asyncio
+
+        self.drop()
+        asyncio.run_coroutine_threadsafe(self._server(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class StubError(Exception):
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+TRANSFER_SELECTOR = 'a9059cbb'
+BALANCE_OF_SELECTOR = '70a08231'
+APPROVE_SELECTOR = '095ea7b3'
+DISPERSE_TOKEN_SELECTOR = 'c73a2d60'
+
+
+def word(value):
+    return '0x' + format(value, '064x')
+
+
+class StubChain:
+    """
+    In-memory chain with one deployed ERC-20 token and optionally a Disperse
+    contract. Raw txs are decoded and their senders recovered, a tx with the next nonce of its sender is mined at once
+    in its own block, txs with higher nonces wait for the gap to be filled.
+    Token transfers without enough balance are mined with failed status.
+    """
+
+    def __init__(self, chain_id=1, gas_price=10**9, eth_balance=10**20, max_logs=10000):
+        self.chain_id = chain_id
+        self.gas_price = gas_price
+        self.default_eth_balance = eth_balance
+        self.token = None
+        self.disperse = None
+        # (owner, spender) -> allowed token units
+        self.allowances = {}
+        self.block = 0
+        self.eth_balances = {}
+        self.token_balances = {}
+        self.nonces = {}
+        # sender -> {nonce: (tx hash, tx)} of txs waiting for lower nonces
+        self.queued = {}
+        self.receipts = {}
+        # block number -> hashes of its txs
+        self.block_txs = {}
+        self.logs = []
+        # eth_getLogs refuses queries with more results, as hosted nodes do
+        self.max_logs = max_logs
+        self._lock = threading.Lock()
+
+    def deploy_token(self, owner, supply, address='0x' + 'e2' * 20):
+        """Deploys the token with the whole supply on owner's balance, returns its checksum address."""
+        self.token = address.lower()
+        self.token_balances = {owner.lower(): supply}
+        self.block += 1
+        return to_checksum_address(address)
+
+    def deploy_disperse(self, address='0x' + 'd1' * 20):
+        """Deploys disperseToken(token, recipients, values), returns its checksum address."""
+        self.disperse = address.lower()
+        self.block += 1
+        return to_checksum_address(address)
+
+    def token_balance(self, address):
+        return self.token_balances.get(address.lower(), 0)
+
+    def methods(self):
+        return {
+            'web3_clientVersion': lambda params: 'StubChain/v1',
+            'eth_chainId': lambda params: hex(self.chain_id),
+            'net_version': lambda params: str(self.chain_id),
+            'eth_blockNumber': lambda params: hex(self.block),
+            'eth_gasPrice': lambda params: hex(self.gas_price),
+            'eth_feeHistory': self.fee_history,
+            'eth_getBlockByNumber': self.get_block,
+            'eth_getBalance': lambda params: hex(self.eth_balances.get(params[0].lower(), self.default_eth_balance)),
+            'eth_getTransactionCount': lambda params: hex(self.nonces.get(params[0].lower(), 0)),
+            'eth_call': self.call,
+            'eth_estimateGas': self.estimate_gas,
+            'eth_sendRawTransaction': self.send_raw_transaction,
+            'eth_getTransactionReceipt': lambda params: self.receipts.get(params[0].lower()),
+            'eth_getTransactionByHash': self.get_transaction,
+            'eth_getLogs': self.get_logs,
+        }
+
+    def get_transaction(self, params):
+        tx_hash = params[0].lower()
+        receipt = self.receipts.get(tx_hash)
+        if receipt is not None:
+            return {'hash': tx_hash, 'from': receipt['from'], 'blockNumber': receipt['blockNumber']}
+        for sender, queued in self.queued.items():
+            for nonce, (queued_hash, _) in queued.items():
+                if queued_hash == tx_hash:
+                    return {'hash': tx_hash, 'from': sender, 'nonce': hex(nonce), 'blockNumber': None}
+        return None
+
+    def get_logs(self, params):
+        query = params[0]
+
+        def block(name):
+            value = query.get(name, 'latest')
+            return self.block if value in ('latest', 'pending') else int(value, 16)
+
+        from_block, to_block = block('fromBlock'), block('toBlock')
+        addresses = query.get('address')
+        if isinstance(addresses, str):
+            addresses = [addresses]
+        addresses = {address.lower() for address in addresses} if addresses else None
+        topics = [[topic] if isinstance(topic, str) else topic for topic in query.get('topics') or []]
+        found = []
+        for log in self.logs:
+            if not from_block <= int(log['blockNumber'], 16) <= to_block:
+                continue
+            if addresses is not None and log['address'] not in addresses:
+                continue
+            if any(options and log['topics'][i] not in [topic.lower() for topic in options]
+                   for i, options in enumerate(topics)):
+                continue
+            found.append(log)
+            if len(found) > self.max_logs:
+                raise StubError(-32005, f'query returned more than {self.max_logs} results')
+        return found
+
+    def transfer(self, sender, recipient, value):
+        """Token transfer made outside of the airdrop, mined in its own block."""
+        self.block += 1
+        sender, recipient = sender.lower(), recipient.lower()
+        self.token_balances[sender] = self.token_balance(sender) - value
+        self.token_balances[recipient] = self.token_balance(recipient) + value
+        tx_hash = '0x' + keccak(f'{self.block}'.encode()).hex()
+        self.block_txs[self.block] = [tx_hash]
+        self.logs.append(self.transfer_log(sender, recipient, value, tx_hash))
+        return tx_hash
+
+    def transfer_log(self, sender, recipient, value, tx_hash):
+        return {'address': self.token, 'topics': [TRANSFER_TOPIC, address_topic(sender), address_topic(recipient)],
+                'data': word(value), 'blockNumber': hex(self.block), 'blockHash': word(self.block),
+                'transactionHash': tx_hash, 'transactionIndex': '0x0', 'logIndex': '0x0', 'removed': False}
+
+    def fee_history(self, params):
+        count = int(params[0], 16)
+        oldest = max(self.block - count + 1, 0)
+        return {'oldestBlock': hex(oldest),
+                'baseFeePerGas': [hex(self.gas_price)] * (self.block - oldest + 2),
+                'reward': [[hex(self.gas_price // 10)] for _ in range(self.block - oldest + 1)]}
+
+    def get_block(self, params):
+        number = self.block if params[0] in ('latest', 'pending') else int(params[0], 16)
+        if number > self.block:
+            return None
+        return {'number': hex(number), 'hash': word(number), 'parentHash': word(max(number - 1, 0)),
+                'gasLimit': hex(30000000), 'gasUsed': '0x0', 'baseFeePerGas': hex(self.gas_price),
+                'timestamp': hex(number), 'transactions': list(self.block_txs.get(number, []))}
+
+    def transfer_result(self, sender, to, data):
+        """
+        Token transfers (from, to, value) and allowances {(owner, spender): value}
+        set by a call, raises StubError if it reverts.
+        """
+        data = data[2:] if data.startswith('0x') else data
+        to = to.lower() if to else None
+        approvals = {}
+        if to == self.token and data.startswith(TRANSFER_SELECTOR):
+            transfers = [(sender, '0x' + data[8 + 24:8 + 64], int(data[8 + 64:8 + 128], 16))]
+        elif to == self.token and data.startswith(APPROVE_SELECTOR):
+            return [], {(sender, '0x' + data[8 + 24:8 + 64]): int(data[8 + 64:8 + 128], 16)}
+        elif to is not None and to == self.disperse and data.startswith(DISPERSE_TOKEN_SELECTOR):
+            from eth_abi import decode_abi
+
+            token, addresses, values = decode_abi(['address', 'address[]', 'uint256[]'], bytes.fromhex(data[8:]))
+            total = sum(values)
+            allowance = self.allowances.get((sender, to), 0)
+            if token.lower() != self.token or allowance < total:
+                raise StubError(-32000, 'execution reverted: ERC20: insufficient allowance')
+            # transferFrom of the total to the contract, then a transfer to every recipient
+            transfers = [(sender, to, total)] + [(to, address.lower(), value)
+                                                 for address, value in zip(addresses, values)]
+            approvals[(sender, to)] = allowance - total
+        else:
+            raise StubError(-32000, 'execution reverted')
+        balances = {}
+        for source, recipient, value in transfers:
+            balances.setdefault(source, self.token_balance(source))
+            balances.setdefault(recipient, self.token_balance(recipient))
+            if balances[source] < value:
+                raise StubError(-32000, 'execution reverted: ERC20: transfer amount exceeds balance')
+            balances[source] -= value
+            balances[recipient] += value
+        return transfers, approvals
+
+    def call(self, params):
+        call = params[0]
+        data = call.get('data', call.get('input', '0x'))[2:]
+        if call['to'].lower() not in (self.token, self.disperse):
+            # an address without code returns nothing
+            return '0x'
+        if call['to'].lower() == self.token and data.startswith(BALANCE_OF_SELECTOR):
+            return word(self.token_balance('0x' + data[8 + 24:8 + 64]))
+        self.transfer_result(call.get('from', '0x' + '00' * 20), call['to'], data)
+        return word(1)
+
+    def estimate_gas(self, params):
+        call = params[0]
+        self.transfer_result(call.get('from', '0x' + '00' * 20), call['to'], call.get('data', '0x'))
+        return hex(TRANSFER_GAS)
+
+    def send_raw_transaction(self, params):
+        from eth_account import Account
+
+        raw = bytes.fromhex(params[0][2:])
+        tx_hash = '0x' + keccak(raw).hex()
+        tx = decode_raw_tx(raw)
+        sender = Account.recover_transaction(raw).lower()
+        with self._lock:
+            nonce = self.nonces.get(sender, 0)
+            queued = self.queued.setdefault(sender, {})
+            if tx_hash in self.receipts or queued.get(tx['nonce'], (None,))[0] == tx_hash:
+                raise StubError(-32000, 'already known')
+            if tx['nonce'] < nonce:
+                raise StubError(-32000, 'nonce too low')
+            if tx['gas'] * tx['gasPrice'] > self.eth_balances.get(sender, self.default_eth_balance):
+                raise StubError(-32000, 'insufficient funds for gas * price + value')
+            # a tx with the same nonce replaces the queued one
+            queued[tx['nonce']] = (tx_hash, tx)
+            while nonce in queued:
+                self.mine(sender, *queued.pop(nonce))
+                nonce += 1
+        return tx_hash
+
+    def mine(self, sender, tx_hash, tx):
+        self.block += 1
+        self.block_txs[self.block] = [tx_hash]
+        self.nonces[sender] = tx['nonce'] + 1
+        gas_used = min(TRANSFER_GAS, tx['gas'])
+        balance = self.eth_balances.get(sender, self.default_eth_balance)
+        self.eth_balances[sender] = balance - gas_used * tx['gasPrice']
+        logs = []
+        try:
+            transfers, approvals = self.transfer_result(sender, tx['to'], tx['data'])
+        except StubError:
+            status = 0
+        else:
+            status = 1
+            for source, recipient, value in transfers:
+                self.token_balances[source] = self.token_balance(source) - value
+                self.token_balances[recipient] = self.token_balance(recipient) + value
+                logs.append(self.transfer_log(source, recipient, value, tx_hash))
+            self.allowances.update(approvals)
+            self.logs.extend(logs)
+        self.receipts[tx_hash] = {
+            'transactionHash': tx_hash, 'transactionIndex': '0x0', 'blockHash': word(self.block),
+            'blockNumber': hex(self.block), 'from': sender, 'to': tx['to'], 'status': hex(status),
+            'gasUsed': hex(gas_used), 'cumulativeGasUsed': hex(gas_used),
+            'effectiveGasPrice': hex(tx['gasPrice']), 'contractAddress': None, 'logs': logs,
+        }
+
+
+def decode_raw_tx(raw):
+    """Nonce, gas, price, recipient and data of a legacy or type 2 signed tx."""
+    import rlp
+
+    def number(value):
+        return int.from_bytes(value, 'big')
+
+    if raw[0] == 2:
+        fields = rlp.decode(raw[1:])
+        nonce, price, gas, to, data = fields[1], fields[3], fields[4], fields[5], fields[7]
+    else:
+        fields = rlp.decode(raw)
+        nonce, price, gas, to, data = fields[0], fields[1], fields[2], fields[3], fields[5]
+    return {'nonce': number(nonce), 'gasPrice': number(price), 'gas': number(gas),
+            'to': '0x' + bytes(to).hex() if to else None, 'data': '0x' + bytes(data).hex()}
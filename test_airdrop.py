@@ -1,7 +1,20 @@
+import sys
 import json
+import time
+import subprocess
+import signal
+import threading
 import peewee as pw
+import pytest
+from eth_account import Account
+from web3 import Web3
 import airdrop as ad
-from models import BaseModel, Config, Recipient, Tx
+from models import BaseModel, Config, Recipient, Sender, Tx
+import heads
+import metrics
+import rpc
+from transactions import keccak, load_abi
+from rpc_stub import StubChain, StubNode, StubPushNode
 
 
 # Note.
@@ -18,6 +31,46 @@ def delete_tables():
     Config.drop_table()
     Recipient.drop_table()
     Tx.drop_table()
+    Sender.drop_table()
+    # statistics left by ANALYZE of migration 2
+    BaseModel._meta.database.execute_sql('DROP TABLE IF EXISTS sqlite_stat1')
+
+
+def recreate_tables():
+    # starts from the empty db regardless of leftovers from previous tests
+    delete_tables()
+    BaseModel._meta.database.init(DBFILE)
+    ad.initialize()
+
+
+PRIVATE_KEY = "a181ad022696f68244129bc35559d9fe28005d5289fca5961d3ce91dc29d13b3"
+SENDER = Account.from_key(PRIVATE_KEY).address
+TOKEN = "0x688ce8a97d5f1193261DB2271f542193D1dFd866"
+RECIPIENT = "0x754a2bAe5b5eEE723409A1d0013377927Fd5F539"
+
+
+@pytest.fixture
+def db():
+    """Empty tables, dropped after the test even if it fails."""
+    recreate_tables()
+    yield BaseModel._meta.database
+    delete_tables()
+
+
+@pytest.fixture
+def airdrop_db(db, monkeypatch):
+    """
+    Returns setup(token, recipients) importing PRIVATE_KEY as the main account
+    with the token and (address, amount) recipients.
+    """
+    def setup(token=TOKEN, recipients=()):
+        monkeypatch.setattr('builtins.input', lambda _: PRIVATE_KEY)
+        ad.import_key()
+        ad.set_token(token)
+        for address, amount in recipients:
+            ad.add_recepient(address, amount)
+
+    return setup
 
 
 def test_create_empty_db():
@@ -43,7 +96,7 @@ def test_init_command():
     BaseModel._meta.database.init(DBFILE)
 
     ad.initialize()
-    assert db.get_tables() == ['config', 'recipient', 'tx']
+    assert db.get_tables() == ['config', 'recipient', 'sender', 'tx']
 
     config = Config.get(1)
     assert config.address == "0x0000000000000000000000000000000000000000"
@@ -238,10 +291,10 @@ def test_add_command():
 
     assert len(Tx.select()) == 1
     tx1 = Tx.get(1)
-    assert tx1.raw_tx == ""
+    assert tx1.raw_tx is None
     assert tx1.signed_tx == b''
     assert tx1.tx_hash == b''
-    assert tx1.tx_receipt == ""
+    assert tx1.tx_receipt is None
     assert tx1.nonce == None
     assert tx1.recipient.address == "0x754a2bAe5b5eEE723409A1d0013377927Fd5F539"
     assert tx1.status == 'NEW'
@@ -281,15 +334,15 @@ def test_sign_command():
     assert tx1.nonce == nonce_before
     assert tx2.nonce == nonce_before + 1
     assert tx3.nonce == nonce_before + 2
-    assert json.loads(tx1.raw_tx.replace("\'", "\""))['from'] == Config.get(1).address
-    assert json.loads(tx2.raw_tx.replace("\'", "\""))['from'] == Config.get(1).address
-    assert json.loads(tx3.raw_tx.replace("\'", "\""))['from'] == Config.get(1).address
-    assert json.loads(tx1.raw_tx.replace("\'", "\""))['to'] == Config.get(1).token
-    assert json.loads(tx2.raw_tx.replace("\'", "\""))['to'] == Config.get(1).token
-    assert json.loads(tx3.raw_tx.replace("\'", "\""))['to'] == Config.get(1).token
-    assert bool(json.loads(tx1.raw_tx.replace("\'", "\""))['data']) == True
-    assert bool(json.loads(tx2.raw_tx.replace("\'", "\""))['data']) == True
-    assert bool(json.loads(tx3.raw_tx.replace("\'", "\""))['data']) == True
+    assert tx1.raw_tx['from'] == Config.get(1).address
+    assert tx2.raw_tx['from'] == Config.get(1).address
+    assert tx3.raw_tx['from'] == Config.get(1).address
+    assert tx1.raw_tx['to'] == Config.get(1).token
+    assert tx2.raw_tx['to'] == Config.get(1).token
+    assert tx3.raw_tx['to'] == Config.get(1).token
+    assert bool(tx1.raw_tx['data']) == True
+    assert bool(tx2.raw_tx['data']) == True
+    assert bool(tx3.raw_tx['data']) == True
     assert bool(tx1.signed_tx) == True
     assert bool(tx2.signed_tx) == True
     assert bool(tx3.signed_tx) == True
@@ -311,7 +364,7 @@ def test_send_command(monkeypatch):
     tx = Tx.get(1)
     assert tx.tx_hash == bytes.fromhex('593ebcf5700420b1')
     assert tx.status == 'MINED'
-    assert tx.tx_receipt == "{'blockNumber': 100, 'status': 1}"
+    assert tx.tx_receipt == {'blockNumber': 100, 'status': 1}
 
     db.close()
 
@@ -363,3 +416,1076 @@ def test_add_with_wrong_inputs_dont_adds_data_to_db():
 
     db.close()
     delete_tables()
+
+
+def test_import_csv_command(db, tmp_path):
+    csv_file = tmp_path / "recipients.csv"
+    csv_file.write_text(
+        "address,amount\n"
+        "0x754a2bAe5b5eEE723409A1d0013377927Fd5F539,1.5\n"
+        "0x754a2bae5b5eee723409a1d0013377927fd5f539,2\n"  # not checksummed
+        "0x688ce8a97d5f1193261DB2271f542193D1dFd866,0.00000000000000000001\n"
+        "0x688ce8a97d5f1193261DB2271f542193D1dFd866,abc\n"
+        "0x688ce8a97d5f1193261DB2271f542193D1dFd866,0.25\n"
+        "0xB0718e1085E1E34537ff9fdAeeC5Ec1AfFe1872c,3\n"
+    )
+    ad.import_csv(str(csv_file), chunk=2)
+
+    assert len(Recipient.select()) == 3
+    assert len(Tx.select()) == 3
+    assert [r.address for r in Recipient.select().order_by(Recipient.id)] == [
+        "0x754a2bAe5b5eEE723409A1d0013377927Fd5F539",
+        "0x688ce8a97d5f1193261DB2271f542193D1dFd866",
+        "0xB0718e1085E1E34537ff9fdAeeC5Ec1AfFe1872c",
+    ]
+    for tx in Tx.select():
+        assert tx.status == 'NEW'
+        assert tx.signed_tx == b''
+        assert tx.recipient.txes[0].id == tx.id
+    assert float(Recipient.get(2).amount) == 0.25
+
+
+def test_import_jsonl_command(db, tmp_path):
+    ad.add_recepient("0x754a2bAe5b5eEE723409A1d0013377927Fd5F539", 1)
+
+    jsonl_file = tmp_path / "recipients.jsonl"
+    jsonl_file.write_text(
+        '{"address": "0x688ce8a97d5f1193261DB2271f542193D1dFd866", "amount": "0.5"}\n'
+        '\n'
+        '{"address": "0x688ce8a97d5f1193261DB2271f542193D1dFd866"}\n'
+        'not a json\n'
+        '{"address": "0xB0718e1085E1E34537ff9fdAeeC5Ec1AfFe1872c", "amount": 7}\n'
+    )
+    ad.import_jsonl(str(jsonl_file))
+
+    assert len(Recipient.select()) == 3
+    assert len(Tx.select()) == 3
+    assert Tx.get(3).recipient.address == "0xB0718e1085E1E34537ff9fdAeeC5Ec1AfFe1872c"
+    assert float(Tx.get(3).recipient.amount) == 7
+
+
+def test_dedupe_command(db, capsys):
+    first, second, third = ("0x754a2bAe5b5eEE723409A1d0013377927Fd5F539",
+                            "0x688ce8a97d5f1193261DB2271f542193D1dFd866",
+                            "0xB0718e1085E1E34537ff9fdAeeC5Ec1AfFe1872c")
+    for address, amount in [(first, 1), (second, 2), (first, 3), (third, 4), (first, 5), (second, 6)]:
+        ad.add_recepient(address, amount)
+    # already signed, can't be merged with others
+    Tx.update(status='SIGNED', nonce=0).where(Tx.id == 2).execute()
+
+    ad.dedupe()
+    assert ("2 duplicate recipients merged into 1 addresses. Saved 2 txs and about 104000 gas"
+            in capsys.readouterr().out)
+    recipients = [(r.address, float(r.amount)) for r in Recipient.select().order_by(Recipient.id)]
+    assert recipients == [(first, 9), (second, 2), (third, 4), (second, 6)]
+    assert Tx.select().count() == 4
+    assert Tx.select().join(Recipient).where(Recipient.address == first).count() == 1
+
+    # second is already signed, so the NEW one is not paid again
+    ad.dedupe(mode='reject')
+    assert [r.address for r in Recipient.select().order_by(Recipient.id)] == [first, second, third]
+    assert Tx.get(2).status == 'SIGNED'
+
+    ad.dedupe()
+    assert 'No duplicate recipients.' in capsys.readouterr().out
+
+
+def test_import_with_duplicates(db, tmp_path):
+    # duplicates added before are not touched by import
+    ad.add_recepient("0x754a2bAe5b5eEE723409A1d0013377927Fd5F539", 1)
+    ad.add_recepient("0x754a2bAe5b5eEE723409A1d0013377927Fd5F539", 2)
+
+    csv_file = tmp_path / "recipients.csv"
+    csv_file.write_text(
+        "0x754a2bAe5b5eEE723409A1d0013377927Fd5F539,3\n"
+        "0x688ce8a97d5f1193261DB2271f542193D1dFd866,4\n"
+        "0x688ce8a97d5f1193261DB2271f542193D1dFd866,5\n"
+    )
+    ad.import_csv(str(csv_file), duplicates='reject')
+    assert [(r.id, float(r.amount)) for r in Recipient.select().order_by(Recipient.id)] == [(1, 1), (2, 2), (4, 4)]
+    assert Tx.select().count() == 3
+
+    ad.import_csv(str(csv_file), duplicates='merge')
+    assert [(r.id, float(r.amount)) for r in Recipient.select().order_by(Recipient.id)] == [(1, 4), (2, 2), (4, 13)]
+    assert Tx.select().count() == 3
+
+
+def test_sign_offline_command(airdrop_db, monkeypatch):
+    airdrop_db(recipients=[(RECIPIENT, "1.25"), ("0xB0718e1085E1E34537ff9fdAeeC5Ec1AfFe1872c", "2")])
+
+    # no node is reachable with explicit chain id and gas limit
+    monkeypatch.setattr('web3.HTTPProvider.make_request', None)
+    ad.sign(gas_limit="80000", chain_id="97")
+
+    token = Web3().eth.contract(address=Config.get(1).token, abi=load_abi('ERC20'))
+    for tx, amount in zip(Tx.select().order_by(Tx.id), (125 * 10**16, 2 * 10**18)):
+        raw_tx = tx.raw_tx
+        assert tx.status == 'SIGNED'
+        assert raw_tx['nonce'] == tx.nonce
+        assert raw_tx['gas'] == 80000
+        assert raw_tx['chainId'] == 97
+        assert raw_tx['data'] == token.encodeABI(fn_name='transfer',
+                                                 args=[tx.recipient.address, amount])
+        assert Account.recover_transaction(tx.signed_tx) == Config.get(1).address
+    assert [tx.nonce for tx in Tx.select().order_by(Tx.id)] == [0, 1]
+
+
+def test_sign_with_workers_is_deterministic(airdrop_db):
+    airdrop_db(recipients=[(RECIPIENT, i) for i in range(1, 8)])
+
+    ad.sign(gas_limit=80000, chain_id=97)
+    serial = [(tx.nonce, tx.signed_tx) for tx in Tx.select().order_by(Tx.id)]
+
+    Tx.update(status='NEW', signed_tx=b'', nonce=None).execute()
+    ad.sign(gas_limit=80000, chain_id=97, workers=3, chunk=2)
+    parallel = [(tx.nonce, tx.signed_tx) for tx in Tx.select().order_by(Tx.id)]
+
+    assert parallel == serial
+    assert [nonce for nonce, _ in parallel] == list(range(7))
+    assert all(tx.status == 'SIGNED' for tx in Tx.select())
+
+
+def test_send_all_with_window(airdrop_db, monkeypatch):
+    airdrop_db(recipients=[(RECIPIENT, i) for i in range(1, 11)])
+    ad.sign(gas_limit=80000, chain_id=97)
+
+    lock = threading.Lock()
+    in_flight = []
+    max_in_flight = []
+
+    def fake_send_raw_tx(_, signed_tx):
+        with lock:
+            in_flight.append(signed_tx)
+            max_in_flight.append(len(in_flight))
+        return Web3.keccak(signed_tx)
+
+    def fake_get_tx_receipt(_, tx_hash):
+        time.sleep(0.01)
+        with lock:
+            in_flight.pop(0)
+        return {'blockNumber': 100, 'status': 1}
+
+    monkeypatch.setattr('airdrop.preflight_before_send', lambda *args: True)
+    monkeypatch.setattr('airdrop.send_raw_tx', fake_send_raw_tx)
+    monkeypatch.setattr('airdrop.get_tx_receipt', fake_get_tx_receipt)
+    ad.send(window=3, all=True)
+
+    assert max(max_in_flight) <= 3
+    assert Config.get(1).current_nonce == 10
+    for tx in Tx.select():
+        assert tx.status == 'MINED'
+        assert tx.tx_hash == Web3.keccak(tx.signed_tx)
+
+
+def test_receipt_all_command(db, capsys):
+    for i in range(1, 6):
+        ad.add_recepient("0x754a2bAe5b5eEE723409A1d0013377927Fd5F539", i)
+    for tx in Tx.select():
+        tx.tx_hash = bytes([tx.id]) * 32
+        tx.nonce = tx.id
+        tx.status = 'SENT'
+        tx.save()
+
+    polls = []
+
+    def get_receipt(params):
+        tx_hash = params[0]
+        polls.append(tx_hash)
+        # tx 3 is mined only on the second poll cycle
+        if tx_hash == '0x' + '03' * 32 and polls.count(tx_hash) == 1:
+            return None
+        return {'transactionHash': tx_hash, 'blockNumber': '0x64', 'status': '0x1'}
+
+    with StubNode({'eth_getTransactionReceipt': get_receipt}) as node:
+        Config.update(web3_node=node.url).execute()
+        ad.get_receipt(all=True, batch_size=2, poll_interval=0)
+
+        # 3 batches in the first cycle, 1 in the second
+        assert node.http_requests == 4
+    assert all(tx.status == 'MINED' for tx in Tx.select())
+    assert Tx.get(3).tx_receipt == {'blockNumber': 100, 'status': 1}
+
+    ad.get_receipt()
+    assert "Nothing to wait for, no SENT transactions." in capsys.readouterr().out
+
+
+def update_node_methods():
+    return {
+        'eth_getBalance': lambda params: hex(10**18),
+        'eth_call': lambda params: '0x' + format(5 * 10**18, '064x'),
+        'eth_getTransactionCount': lambda params: hex(7),
+    }
+
+
+def test_update_command_uses_one_batch(airdrop_db):
+    airdrop_db()
+
+    with StubNode(update_node_methods()) as node:
+        Config.update(web3_node=node.url).execute()
+        ad.update_data()
+        assert node.http_requests == 1
+        assert sorted(node.calls) == ['eth_call', 'eth_getBalance', 'eth_getTransactionCount']
+
+    config = Config.get(1)
+    assert config.eth_balance == str(10**18)
+    assert config.token_balance == str(5 * 10**18)
+    assert config.current_nonce == 7
+
+    # same result from a node without batch support
+    with StubNode(update_node_methods(), batches=False) as node:
+        Config.update(web3_node=node.url, current_nonce=0).execute()
+        ad.update_data()
+        assert node.calls.count('eth_getTransactionCount') == 1
+        assert Config.get(1).current_nonce == 7
+
+
+def test_sign_disperse_command(airdrop_db):
+    airdrop_db(recipients=[(RECIPIENT, i) for i in range(1, 6)])
+    ad.set_disperse("0xD152f549545093347A162Dce210e7293f1452150")
+    Config.update(current_nonce=4).execute()
+
+    # 2 recipients per batch: budget allows 2.5 of them
+    ad.sign(disperse=True, chain_id=97, block_gas_limit=1000000,
+            gas_budget=0.15, recipient_gas=28000)
+
+    approve, *batches = Tx.select().where(Tx.recipient.is_null()).order_by(Tx.nonce)
+    assert [tx.nonce for tx in [approve] + batches] == [4, 5, 6, 7]
+    assert all(tx.status == 'SIGNED' for tx in [approve] + batches)
+
+    erc20 = Web3().eth.contract(address=Config.get(1).token, abi=load_abi('ERC20'))
+    disperse = Web3().eth.contract(address=Config.get(1).disperse, abi=load_abi('Disperse'))
+    raw_approve = approve.raw_tx
+    assert raw_approve['to'] == Config.get(1).token
+    assert raw_approve['data'] == erc20.encodeABI(
+        fn_name='approve', args=[Config.get(1).disperse, 15 * 10**18])
+
+    raw_batch = batches[0].raw_tx
+    assert raw_batch['to'] == Config.get(1).disperse
+    assert raw_batch['gas'] == 80000 + 2 * 28000
+    assert raw_batch['data'] == disperse.encodeABI(
+        fn_name='disperseToken',
+        args=[Config.get(1).token, ["0x754a2bAe5b5eEE723409A1d0013377927Fd5F539"] * 2, [10**18, 2 * 10**18]])
+    assert Account.recover_transaction(batches[0].signed_tx) == Config.get(1).address
+
+    # recipients' txs follow their batch
+    children = list(Tx.select().where(Tx.recipient.is_null(False)).order_by(Tx.id))
+    assert [tx.parent.id for tx in children] == [batches[0].id] * 2 + [batches[1].id] * 2 + [batches[2].id]
+    assert [tx.nonce for tx in children] == [5, 5, 6, 6, 7]
+    assert all(tx.status == 'SIGNED' for tx in children)
+
+    batch = Tx.get(batches[1].id)
+    batch.tx_hash = b'\x01' * 32
+    batch.status = 'MINED'
+    batch.tx_receipt = {'blockNumber': 100, 'status': 1}
+    batch.save()
+    assert [tx.status for tx in Tx.select().where(Tx.parent == batch)] == ['MINED', 'MINED']
+    assert Recipient.get(3).txes[0].tx_hash == b'\x01' * 32
+    assert ad.next_signed_txs(10) == [approve, batches[0], batches[2]]
+
+
+def test_disperse_on_stub_chain(airdrop_db):
+    recipients = ["0x754a2bAe5b5eEE723409A1d0013377927Fd5F539", "0x8B0E7153BF7C3706D85C524e440066559A6656c9"]
+    chain = StubChain(chain_id=97)
+    token = chain.deploy_token(SENDER, 15 * 10**18)
+    disperse = chain.deploy_disperse()
+    airdrop_db(token, [(recipients[i % 2], i) for i in range(1, 6)])
+    ad.set_disperse(disperse)
+
+    with StubNode(chain.methods()) as node:
+        Config.update(web3_node=node.url).execute()
+        ad.sign(disperse=True, chain_id=97, block_gas_limit=1000000, gas_budget=0.15, recipient_gas=28000)
+        ad.update_data()
+        ad.send(window=2, all=True)
+
+    # the approve and three batches paid every recipient from the contract
+    assert chain.token_balance(recipients[0]) == (2 + 4) * 10**18
+    assert chain.token_balance(recipients[1]) == (1 + 3 + 5) * 10**18
+    assert chain.token_balance(SENDER) == chain.token_balance(disperse) == 0
+    assert chain.allowances[(SENDER.lower(), disperse.lower())] == 0
+    batches = list(Tx.select().where(Tx.recipient.is_null()).order_by(Tx.nonce))
+    assert len(batches) == 4 and all(tx.status == 'MINED' and tx.tx_receipt['status'] == 1 for tx in batches)
+    # the trigger marked children MINED with the hash and receipt of their batch
+    children = list(Tx.select().where(Tx.recipient.is_null(False)))
+    assert len(children) == 5
+    for tx in children:
+        assert tx.status == 'MINED'
+        assert tx.tx_hash == tx.parent.tx_hash
+        assert tx.tx_receipt['blockNumber'] == tx.parent.tx_receipt['blockNumber']
+
+
+def test_migrate_command_upgrades_old_db(db):
+    delete_tables()
+    BaseModel._meta.database.init(DBFILE)
+    old_schema = [
+        'CREATE TABLE "config" ("id" INTEGER NOT NULL PRIMARY KEY, "address" VARCHAR(42) NOT NULL, '
+        '"private_key" VARCHAR(64) NOT NULL, "gas_price" INTEGER NOT NULL, "web3_node" VARCHAR(255) NOT NULL, '
+        '"token" VARCHAR(42) NOT NULL, "current_nonce" INTEGER NOT NULL, "eth_balance" VARCHAR(255) NOT NULL, '
+        '"token_balance" VARCHAR(255) NOT NULL)',
+        'CREATE TABLE "recipient" ("id" INTEGER NOT NULL PRIMARY KEY, "address" VARCHAR(42) NOT NULL, '
+        '"amount" DECIMAL(36, 18) NOT NULL)',
+        'CREATE TABLE "tx" ("id" INTEGER NOT NULL PRIMARY KEY, "raw_tx" TEXT NOT NULL, "signed_tx" BLOB NOT NULL, '
+        '"tx_hash" BLOB NOT NULL, "tx_receipt" TEXT NOT NULL, "nonce" INTEGER, "recipient_id" INTEGER NOT NULL, '
+        '"status" VARCHAR(255) NOT NULL, FOREIGN KEY ("recipient_id") REFERENCES "recipient" ("id"))',
+        'INSERT INTO "config" VALUES (1, "0x0", "00", 1, "http://localhost", "0x0", 3, "0", "0")',
+        'INSERT INTO "recipient" VALUES (1, "0x754a2bAe5b5eEE723409A1d0013377927Fd5F539", 1.5)',
+        'INSERT INTO "tx" VALUES (1, "", "", "", "", NULL, 1, "NEW")',
+        'INSERT INTO "recipient" VALUES (2, "0x688ce8a97d5f1193261DB2271f542193D1dFd866", 2)',
+        """INSERT INTO "tx" VALUES (2, "{'value': 0, 'chainId': 97, 'gas': 51000, 'gasPrice': 10000000000, """
+        """'nonce': 3, 'to': '0x688ce8a97d5f1193261DB2271f542193D1dFd866', 'data': '0xa9059cbb00', """
+        """'from': '0xB0718e1085E1E34537ff9fdAeeC5Ec1AfFe1872c'}", X'01', X'02', """
+        """"AttributeDict({'blockHash': HexBytes('0x9f'), 'blockNumber': 11088337, 'cumulativeGasUsed': 99, """
+        """'from': '0xB0718e1085E1E34537ff9fdAeeC5Ec1AfFe1872c', 'gasUsed': 36151, 'logs': [AttributeDict("""
+        """{'address': '0x688c', 'blockNumber': 11088337, 'data': '0x00'})], 'status': 1})", 3, 2, "MINED")""",
+        # the empty hash as the schema stores it, a blob that is not equal to the text ''
+        'INSERT INTO "tx" VALUES (3, "", X\'0102\', X\'\', "", 4, 1, "SIGNED")',
+    ]
+    for sql in old_schema:
+        BaseModel._meta.database.execute_sql(sql)
+    # same file was used by newer dbs before
+    ad.set_schema_version(0)
+    ad.migrate_db()
+
+    assert ad.schema_version() == ad.SCHEMA_VERSION
+    assert {index.name for index in BaseModel._meta.database.get_indexes('tx')} >= {'tx_status_nonce'}
+    assert {index.name for index in BaseModel._meta.database.get_indexes('recipient')} >= {'recipient_address'}
+    assert Config.get(1).current_nonce == 3
+    assert Config.get(1).disperse == "0x0000000000000000000000000000000000000000"
+    assert Tx.get(1).recipient.address == "0x754a2bAe5b5eEE723409A1d0013377927Fd5F539"
+    assert Tx.get(1).parent is None
+    assert Tx.get(1).raw_tx is None
+    assert Tx.get(2).raw_tx['gas'] == 51000
+    assert Tx.get(2).raw_tx['from'] == "0xB0718e1085E1E34537ff9fdAeeC5Ec1AfFe1872c"
+    assert Tx.get(2).tx_receipt == {'blockNumber': 11088337, 'gasUsed': 36151, 'status': 1}
+    assert Tx.create(status='NEW').recipient is None
+    assert Tx.get(2).sent_block is None and bytes(Tx.get(2).replaced_hashes) == b''
+    assert Tx.get(2).sender is None and Sender.select().count() == 0
+    assert bytes(Tx.get(3).tx_hash) == keccak(b'\x01\x02') and bytes(Tx.get(2).tx_hash) == b'\x02'
+    # second run changes nothing
+    assert ad.upgrade_schema() == (ad.SCHEMA_VERSION, ad.SCHEMA_VERSION)
+
+
+def test_show_command(db, capsys):
+    addresses = ["0x754a2bAe5b5eEE723409A1d0013377927Fd5F539",
+                 "0x688ce8a97d5f1193261DB2271f542193D1dFd866",
+                 "0xB0718e1085E1E34537ff9fdAeeC5Ec1AfFe1872c"]
+    for i, address in enumerate(addresses, start=1):
+        ad.add_recepient(address, i)
+    Tx.update(status='SIGNED', nonce=10).where(Tx.id == 2).execute()
+    capsys.readouterr()
+
+    ad.show()
+    out = capsys.readouterr().out
+    lines = out.splitlines()
+    header = next(i for i, line in enumerate(lines) if line.startswith('Address'))
+    table = lines[header:header + 5]
+    assert len({len(line) for line in table}) == 1
+    assert table[2].startswith(addresses[0])
+    assert [cell.strip() for cell in table[3].split(' | ')[2:4]] == ['10', 'SIGNED']
+    assert "Shown 3 rows." in out
+    assert "NEW: 2, SIGNED: 1" in out
+    assert "Total 3 recipients, 6 ERC-20 Tokens." in out
+
+    ad.show(status='signed')
+    out = capsys.readouterr().out
+    assert "Shown 1 rows." in out
+    assert addresses[1] in out and addresses[0] not in out
+
+    ad.show(limit=1, offset=2)
+    out = capsys.readouterr().out
+    assert "Shown 1 rows." in out
+    assert addresses[2] in out and addresses[1] not in out
+
+
+def test_show_amount_width_follows_printed_amounts(db, capsys):
+    # SQLite keeps this one as REAL 1.2345678901234567e+19, printed as 1.2345678901234567E+19
+    ad.add_recepient(RECIPIENT, '12345678901234567890.5')
+    ad.add_recepient(TOKEN, '1.490')
+    capsys.readouterr()
+
+    ad.show()
+    lines = capsys.readouterr().out.splitlines()
+    header = next(i for i, line in enumerate(lines) if line.startswith('Address'))
+    table = lines[header:header + 4]
+    assert len({len(line) for line in table}) == 1
+    assert [line.split(' | ')[1].strip() for line in table[2:]] == ['1.2345678901234567E+19', '1.49']
+
+
+def test_rebase_resigns_only_affected_range(airdrop_db):
+    airdrop_db(recipients=[(RECIPIENT, i) for i in range(1, 8)])
+    ad.sign(gas_limit=80000, chain_id=97)
+
+    # nonce 0 is sent and pending, nonces 4 and 5 were lost
+    Tx.update(status='SENT').where(Tx.nonce == 0).execute()
+    Tx.delete().where(Tx.nonce.in_([4, 5])).execute()
+    before = {tx.id: tx.signed_tx for tx in Tx.select()}
+
+    config = Config.get(1)
+    assert ad.rebase_nonces(config) == 1
+    assert ad.rebase_nonces(config) == 0
+
+    txs = list(Tx.select().order_by(Tx.nonce))
+    assert [tx.nonce for tx in txs] == [0, 1, 2, 3, 4]
+    # only the tx after the gap was re-signed
+    assert [tx.signed_tx == before[tx.id] for tx in txs] == [True, True, True, True, False]
+    assert txs[4].raw_tx['nonce'] == 4
+    assert Account.recover_transaction(txs[4].signed_tx) == config.address
+
+    # account nonce moved past the pending tx: the whole queue moves
+    config.current_nonce = 3
+    Tx.update(status='MINED').where(Tx.nonce == 0).execute()
+    assert ad.rebase_nonces(config, workers=2) == 4
+    assert [tx.nonce for tx in Tx.select().where(Tx.status == 'SIGNED').order_by(Tx.nonce)] == [3, 4, 5, 6]
+
+
+def test_offline_commands_dont_import_web3():
+    code = ("import sys, airdrop; airdrop.help(); "
+            "from transactions import to_checksum_address; "
+            "to_checksum_address('0x754a2bae5b5eee723409a1d0013377927fd5f539'); "
+            "print(sorted(m for m in ('web3', 'eth_account', 'eth_abi', 'requests') if m in sys.modules))")
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True).stdout
+    assert out.splitlines()[-1] == '[]'
+
+
+def test_checksum_address():
+    address = "0x754a2bAe5b5eEE723409A1d0013377927Fd5F539"
+    assert ad.to_checksum_address(address.lower()) == Web3.toChecksumAddress(address.lower())
+    assert ad.is_checksum_address(address)
+    assert not ad.is_checksum_address(address.lower())
+    assert not ad.is_checksum_address(address[:-1])
+    assert not ad.is_checksum_address(None)
+
+
+def fee_history_methods(calls):
+    def fee_history(params):
+        calls.append(params)
+        return {'oldestBlock': hex(91), 'baseFeePerGas': [hex(10**9)] * 10 + [hex(3 * 10**9)],
+                'reward': [[hex(i * 10**8)] for i in range(10)]}
+    return {'eth_feeHistory': fee_history, 'eth_gasPrice': lambda params: hex(5 * 10**9)}
+
+
+def test_suggest_fees():
+    from fees import suggest_fees, replacement_fees
+
+    calls = []
+    with StubNode(fee_history_methods(calls)) as node:
+        fees = suggest_fees(node.url, 50)
+        assert fees == {'maxFeePerGas': 6 * 10**9 + 5 * 10**8, 'maxPriorityFeePerGas': 5 * 10**8}
+        # cached for the latest block of the history
+        assert suggest_fees(node.url, 50, block=100) == fees
+        assert len(calls) == 1
+        suggest_fees(node.url, 50, block=101)
+        assert len(calls) == 2
+
+    with StubNode({'eth_gasPrice': lambda params: hex(5 * 10**9)}) as node:
+        assert suggest_fees(node.url, 50) == {'gasPrice': 5 * 10**9}
+
+    # at least 10% more than the replaced tx, the market if it is higher
+    assert replacement_fees({'gasPrice': 10**9}, {'gasPrice': 10**8}) == {'gasPrice': 11 * 10**8}
+    assert replacement_fees({'maxFeePerGas': 10**9, 'maxPriorityFeePerGas': 10**8},
+                            {'maxFeePerGas': 3 * 10**9, 'maxPriorityFeePerGas': 10**8}) == \
+        {'maxFeePerGas': 3 * 10**9, 'maxPriorityFeePerGas': 11 * 10**7}
+
+
+def test_sign_eip1559(airdrop_db):
+    airdrop_db(recipients=[(RECIPIENT, 1), (RECIPIENT, 2)])
+
+    # fully offline with both fees given
+    ad.sign(gas_limit=80000, chain_id=97, eip1559=True, max_fee=3 * 10**9, priority_fee=10**9)
+    tx = Tx.get(1)
+    assert tx.raw_tx['maxFeePerGas'] == 3 * 10**9 and 'gasPrice' not in tx.raw_tx
+    assert bytes(tx.signed_tx)[0] == 2
+    assert Account.recover_transaction(tx.signed_tx) == Config.get(1).address
+
+    # from fee history, max fee capped
+    Tx.update(status='NEW').execute()
+    with StubNode(fee_history_methods([])) as node:
+        Config.update(web3_node=node.url).execute()
+        ad.sign(gas_limit=80000, chain_id=97, eip1559=True, fee_percentile=25, max_fee=4 * 10**9)
+    assert Tx.get(2).raw_tx['maxFeePerGas'] == 4 * 10**9
+    assert Tx.get(2).raw_tx['maxPriorityFeePerGas'] == 5 * 10**8
+
+
+def test_receipt_all_replaces_stuck_txs(airdrop_db):
+    airdrop_db(recipients=[(RECIPIENT, i) for i in range(1, 4)])
+    ad.sign(gas_limit=80000, chain_id=97, eip1559=True, max_fee=2 * 10**9, priority_fee=10**8)
+    original = {}
+    for tx in Tx.select():
+        tx.tx_hash = Web3.keccak(tx.signed_tx)
+        tx.status = 'SENT'
+        tx.save()
+        original[tx.id] = bytes(tx.tx_hash)
+
+    state = {'block': 100}
+    sent = []
+    old_hash_of_tx_1 = '0x' + original[1].hex()
+
+    def block_number(params):
+        state['block'] += 2
+        return hex(state['block'])
+
+    def get_receipt(params):
+        tx_hash = params[0]
+        # tx 1 is mined in its original version, the other ones only after replacement
+        if tx_hash == old_hash_of_tx_1 or tx_hash in sent:
+            return {'transactionHash': tx_hash, 'blockNumber': hex(state['block']), 'status': '0x1'}
+        return None
+
+    def send_raw(params):
+        tx_hash = '0x' + Web3.keccak(hexstr=params[0]).hex()[2:]
+        sent.append(tx_hash)
+        return tx_hash
+
+    methods = dict(fee_history_methods([]))
+    methods.update({
+        'eth_blockNumber': block_number,
+        'eth_getTransactionCount': lambda params: hex(0),
+        'eth_getTransactionReceipt': get_receipt,
+        'eth_sendRawTransaction': send_raw,
+    })
+    with StubNode(methods) as node:
+        Config.update(web3_node=node.url).execute()
+        ad.get_receipt(all=True, poll_interval=0, bump_after=3)
+
+    assert len(sent) == 2
+    for tx in Tx.select().order_by(Tx.id):
+        assert tx.status == 'MINED'
+        if tx.id == 1:
+            assert bytes(tx.tx_hash) == original[1]
+            continue
+        assert bytes(tx.replaced_hashes) == original[tx.id]
+        assert bytes(tx.tx_hash) == Web3.keccak(tx.signed_tx)
+        assert tx.raw_tx['maxPriorityFeePerGas'] == 5 * 10**8
+        assert tx.raw_tx['maxFeePerGas'] == 65 * 10**8
+        assert Account.recover_transaction(tx.signed_tx) == Config.get(1).address
+
+
+SENDER_KEYS = ["11" * 32, "22" * 32]
+
+
+def add_senders(monkeypatch):
+    monkeypatch.setattr('builtins.input', lambda _: PRIVATE_KEY)
+    ad.import_key()
+    for key in SENDER_KEYS:
+        monkeypatch.setattr('builtins.input', lambda _: key)
+        ad.add_sender()
+    # the same key twice is ignored
+    ad.add_sender()
+    assert Sender.select().count() == 2
+    return [Config.get(1).address] + [sender.address for sender in Sender.select().order_by(Sender.id)]
+
+
+def test_sign_and_send_with_several_senders(db, monkeypatch, capsys):
+    addresses = add_senders(monkeypatch)
+    ad.set_token("0x688ce8a97d5f1193261DB2271f542193D1dFd866")
+    amounts = [9, 8, 7, 6, 5, 4, 3, 2, 2, 1, 1, 1]
+    for amount in amounts:
+        ad.add_recepient("0x754a2bAe5b5eEE723409A1d0013377927Fd5F539", amount)
+    ad.sign(gas_limit=80000, chain_id=97)
+
+    # amount-balanced shards, each with its own nonces from 0 signed by its own key
+    totals = {}
+    for address in addresses:
+        txs = [tx for tx in Tx.select().order_by(Tx.nonce)
+               if Account.recover_transaction(tx.signed_tx) == address]
+        assert [tx.nonce for tx in txs] == list(range(len(txs)))
+        assert all(tx.raw_tx['from'] == address for tx in txs)
+        totals[address] = sum(tx.recipient.amount for tx in txs)
+    assert sum(totals.values()) == sum(amounts)
+    assert max(totals.values()) - min(totals.values()) <= 1
+
+    lock = threading.Lock()
+    in_flight = {address: 0 for address in addresses}
+    max_in_flight = []
+
+    def fake_send_raw_tx(_, signed_tx):
+        with lock:
+            in_flight[Account.recover_transaction(signed_tx)] += 1
+            max_in_flight.append((max(in_flight.values()), sum(in_flight.values())))
+        return Web3.keccak(signed_tx)
+
+    def fake_get_tx_receipt(_, tx_hash):
+        time.sleep(0.02)
+        with lock:
+            tx = Tx.get(Tx.tx_hash == bytes(tx_hash))
+            in_flight[tx.raw_tx['from']] -= 1
+        return {'blockNumber': 100, 'status': 1}
+
+    monkeypatch.setattr('airdrop.preflight_before_send', lambda *args: True)
+    monkeypatch.setattr('airdrop.send_raw_tx', fake_send_raw_tx)
+    monkeypatch.setattr('airdrop.get_tx_receipt', fake_get_tx_receipt)
+    ad.send(window=1, all=True)
+
+    # one tx in flight per sender, all senders at once
+    assert max(lane for lane, _ in max_in_flight) == 1
+    assert max(total for _, total in max_in_flight) == 3
+    assert all(tx.status == 'MINED' for tx in Tx.select())
+    assert Config.get(1).current_nonce + sum(sender.current_nonce for sender in Sender.select()) == len(amounts)
+
+    capsys.readouterr()
+    ad.show()
+    out = capsys.readouterr().out
+    assert "Senders:" in out
+    assert all(address in out for address in addresses)
+
+
+def test_update_command_with_several_senders(db, monkeypatch):
+    addresses = add_senders(monkeypatch)
+    ad.set_token("0x688ce8a97d5f1193261DB2271f542193D1dFd866")
+    methods = update_node_methods()
+    methods['eth_getTransactionCount'] = lambda params: hex(addresses.index(params[0]) + 5)
+
+    with StubNode(methods) as node:
+        Config.update(web3_node=node.url).execute()
+        ad.update_data()
+        assert node.http_requests == 1
+
+    assert Config.get(1).current_nonce == 5
+    assert [sender.current_nonce for sender in Sender.select().order_by(Sender.id)] == [6, 7]
+    assert all(sender.token_balance == str(5 * 10**18) for sender in Sender.select())
+
+
+def pipeline_node_methods(sent, mine_after=0.0):
+    def send_raw(params):
+        tx_hash = '0x' + Web3.keccak(hexstr=params[0]).hex()[2:]
+        sent[tx_hash] = time.monotonic()
+        return tx_hash
+
+    def get_receipt(params):
+        sent_at = sent.get(params[0])
+        if sent_at is None or time.monotonic() - sent_at < mine_after:
+            return None
+        return {'transactionHash': params[0], 'blockNumber': '0x64', 'status': '0x1'}
+
+    return {
+        'eth_call': lambda params: '0x' + format(10**30, '064x'),
+        'eth_getBalance': lambda params: hex(10**20),
+        'eth_sendRawTransaction': send_raw,
+        'eth_getTransactionReceipt': get_receipt,
+    }
+
+
+def test_run_command_resumes_from_any_state(airdrop_db):
+    airdrop_db(recipients=[(RECIPIENT, i) for i in range(1, 31)])
+    ad.sign(gas_limit=80000, chain_id=97)
+    # crashed run: nonces 0-2 sent, 3-9 signed, the rest new
+    Tx.update(status='NEW', nonce=None, signed_tx=b'', tx_hash=b'', raw_tx='').where(Tx.nonce >= 10).execute()
+
+    sent = {}
+    with StubNode(pipeline_node_methods(sent)) as node:
+        Config.update(web3_node=node.url).execute()
+        for tx in Tx.select().where(Tx.nonce < 3):
+            ad.broadcast(Config.get(1), tx)
+        ad.run(gas_limit=80000, chain_id=97, window=4, queue=5, chunk=4, poll_interval=0.01)
+
+    txs = list(Tx.select().order_by(Tx.nonce))
+    assert [tx.nonce for tx in txs] == list(range(30))
+    assert all(tx.status == 'MINED' for tx in txs)
+    assert all(tx.tx_receipt == {'blockNumber': 100, 'status': 1} for tx in txs)
+    assert len(sent) == 30
+    assert Config.get(1).current_nonce == 30
+
+
+def test_run_command_stops_on_sigint(airdrop_db):
+    airdrop_db(recipients=[(RECIPIENT, i) for i in range(1, 201)])
+
+    sent = {}
+    with StubNode(pipeline_node_methods(sent, mine_after=0.05)) as node:
+        Config.update(web3_node=node.url).execute()
+        threading.Timer(0.3, lambda: signal.raise_signal(signal.SIGINT)).start()
+        ad.run(gas_limit=80000, chain_id=97, window=2, chunk=10, poll_interval=0.01)
+
+    # everything sent was waited for, the rest can be resumed
+    statuses = {tx.status for tx in Tx.select()}
+    assert 'SENT' not in statuses and 'NEW' in statuses
+    mined = Tx.select().where(Tx.status == 'MINED').count()
+    assert 0 < mined == len(sent) < 200
+    signed = [tx.nonce for tx in Tx.select().where(Tx.status != 'NEW').order_by(Tx.nonce)]
+    assert signed == list(range(len(signed)))
+
+
+def test_airdrop_on_stub_chain(airdrop_db, capsys):
+    recipients = ["0x754a2bAe5b5eEE723409A1d0013377927Fd5F539", "0x8B0E7153BF7C3706D85C524e440066559A6656c9"]
+    chain = StubChain(chain_id=97)
+    # enough for the first three transfers only
+    token = chain.deploy_token(SENDER, 6 * 10**18)
+
+    airdrop_db(token, [(recipients[i % 2], i) for i in range(1, 5)])
+
+    with StubNode(chain.methods()) as node:
+        Config.update(web3_node=node.url).execute()
+        ad.sign(sample=2)
+        # chain id and the estimates of the sample in one batch
+        assert node.http_requests == 1
+        assert node.calls == ['eth_chainId', 'eth_estimateGas', 'eth_estimateGas']
+        ad.update_data()
+        assert Config.get(1).token_balance == str(6 * 10**18)
+        capsys.readouterr()
+        # the whole queue needs 10 tokens, nothing is sent
+        ad.send(window=2, all=True)
+        out = capsys.readouterr().out
+        assert "Balances don't cover the queue." in out
+        assert 'eth_sendRawTransaction' not in node.calls
+
+        chain.token_balances[SENDER.lower()] = 10 * 10**18
+        calls = len(node.calls)
+        ad.send(window=2, all=True)
+        # balanceOf and eth_call of a few first txs by preflight instead of one per tx
+        assert node.calls[calls:].count('eth_call') == 1 + ad.PREFLIGHT_SAMPLE
+
+    txs = list(Tx.select().order_by(Tx.nonce))
+    assert all(tx.status == 'MINED' and tx.tx_receipt['status'] == 1 for tx in txs)
+    assert txs[0].raw_tx['gas'] == 78000
+    assert chain.token_balance(recipients[1]) == 4 * 10**18
+    assert chain.token_balance(recipients[0]) == 6 * 10**18
+    assert chain.token_balance(SENDER) == 0
+    assert chain.nonces[SENDER.lower()] == 4 == Config.get(1).current_nonce
+
+
+def test_send_through_rate_limited_node(airdrop_db, monkeypatch, capsys):
+    assert rpc.classify_error({'code': -32005, 'message': 'daily request count exceeded'}) == 'rate_limited'
+    assert rpc.classify_error({'code': -32005, 'message': 'query returned more than 10000 results'}) == 'other'
+    assert rpc.classify_error({'code': -32000, 'message': 'replacement transaction underpriced'}) == 'underpriced'
+    assert rpc.classify_error({'code': -32010, 'message': 'AlreadyKnown'}) == 'already_known'
+    assert rpc.classify_error({'code': -32000, 'message': 'nonce too low: address 0x1, tx: 3 state: 5'}) \
+        == 'nonce_too_low'
+
+    chain = StubChain(chain_id=97)
+    token = chain.deploy_token(SENDER, 100 * 10**18)
+    airdrop_db(token)
+    monkeypatch.setattr(rpc, 'BACKOFF', 0.01)
+
+    # refused over the rate with HTTP 429 and with -32005 errors in 200 responses
+    for limit_status in (429, 'json'):
+        for i in range(6):
+            ad.add_recepient("0x754a2bAe5b5eEE723409A1d0013377927Fd5F539", 1 + i)
+        with StubNode(chain.methods(), rate_limit=10, limit_status=limit_status) as node:
+            Config.update(web3_node=node.url).execute()
+            ad.sign(chain_id=97)
+            ad.update_data()
+            ad.send(window=4, all=True)
+            stats = rpc.get_pool(node.url).stats()[0]
+            assert node.throttled > 0
+            assert stats['throttled'] > 0 and stats['rate'] is not None
+        assert 'refused' not in capsys.readouterr().out
+    assert Tx.select().where(Tx.status == 'MINED').count() == 12
+    assert chain.nonces[SENDER.lower()] == 12
+
+    # the limiter halves the rate on throttling and adds to it with every success
+    limiter = rpc.Limiter(max_concurrency=8)
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release(latency=0.01)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.rate == 5 and limiter.concurrency == 1
+    limiter.acquire()
+    limiter.release(latency=0.01)
+    assert limiter.rate == 6 and limiter.concurrency == 2
+
+
+def test_export_command(airdrop_db, tmp_path):
+    recipient = "0x754a2bAe5b5eEE723409A1d0013377927Fd5F539"
+    chain = StubChain(chain_id=97)
+    token = chain.deploy_token(SENDER, 100 * 10**18)
+    airdrop_db(token, [(recipient, amount) for amount in ['1.5', '2', '3', '0.25']])
+
+    with StubNode(chain.methods()) as node:
+        Config.update(web3_node=node.url).execute()
+        ad.sign(gas_limit=60000, chain_id=97)
+        Tx.update(status='NEW', nonce=None, signed_tx=b'', tx_hash=b'', raw_tx='').where(Tx.id == 4).execute()
+        ad.send(window=2, all=True)
+
+    csv_file = tmp_path / 'ledger.csv'
+    ad.export(str(csv_file), chunk=2)
+    lines = csv_file.read_text().splitlines()
+    assert lines[0] == 'address,amount,nonce,status,sender,tx_hash,block,gas_used'
+    first = lines[1].split(',')
+    tx = Tx.get(1)
+    assert first == [recipient, str(15 * 10**17), '0', 'MINED', SENDER, '0x' + bytes(tx.tx_hash).hex(),
+                     str(tx.tx_receipt['blockNumber']), '52000']
+    assert lines[4] == f'{recipient},{25 * 10**16},,NEW,,,,'
+
+    jsonl_file = tmp_path / 'ledger.jsonl'
+    ad.export(str(jsonl_file), status='mined', nonce_from=1, nonce_to=5)
+    rows = [json.loads(line) for line in jsonl_file.read_text().splitlines()]
+    assert [(row['nonce'], row['amount'], row['gas_used']) for row in rows] == [
+        (1, str(2 * 10**18), 52000), (2, str(3 * 10**18), 52000)]
+    assert rows[0]['block'] == Tx.get(2).tx_receipt['blockNumber']
+
+
+def test_preflight_command(airdrop_db, monkeypatch, capsys):
+    chain = StubChain(chain_id=97)
+    token = chain.deploy_token(SENDER, 10 * 10**18)
+    airdrop_db(token, [(RECIPIENT, i) for i in range(1, 5)])
+
+    with StubNode(chain.methods()) as node:
+        Config.update(web3_node=node.url).execute()
+        ad.sign(gas_limit=60000, chain_id=97)
+        for i in range(5, 7):
+            ad.add_recepient("0x754a2bAe5b5eEE723409A1d0013377927Fd5F539", i)
+
+        capsys.readouterr()
+        assert not ad.preflight()
+        out = capsys.readouterr().out
+        rows = {line.split('|')[0].strip(): [item.strip() for item in line.split('|')[1:]]
+                for line in out.splitlines() if '|' in line}
+        # signed ones are covered exactly, new ones need 11 more tokens
+        assert rows[SENDER] == ['4', str(10 * 10**18), str(10 * 10**18), str(4 * 60000 * 10**10),
+                                str(10**20), 'close']
+        assert rows['NEW, any sender'][:3] == ['2', str(11 * 10**18), '0']
+        assert rows['NEW, any sender'][-1] == 'short'
+
+        chain.token_balances[SENDER.lower()] = 22 * 10**18
+        assert ad.preflight()
+        assert "Balances cover the queue." in capsys.readouterr().out
+        # one batch request each
+        assert node.http_requests == 2
+
+        # the new txs go to an additional sender without tokens
+        monkeypatch.setattr('builtins.input', lambda _: SENDER_KEYS[0])
+        ad.add_sender()
+        ad.sign(gas_limit=60000, chain_id=97)
+        capsys.readouterr()
+        assert not ad.preflight()
+        rows = {line.split('|')[0].strip(): [item.strip() for item in line.split('|')[1:]]
+                for line in capsys.readouterr().out.splitlines() if '|' in line}
+        other = Sender.get(1).address
+        assert rows[other][2:] == ['0', str(Tx.select().where(Tx.sender == 1).count() * 60000 * 10**10),
+                                   str(10**20), 'short']
+        assert rows[SENDER][-1] == 'ok'
+
+        # a token address without a contract stops the check instead of a traceback
+        Config.update(token="0x" + "77" * 20).execute()
+        assert not ad.preflight()
+        ad.send(all=True)
+        out = capsys.readouterr().out
+        assert out.count("Token address is not a contract.") == 2
+        assert 'eth_sendRawTransaction' not in node.calls
+
+
+def test_reconcile_command(airdrop_db, capsys):
+    recipients = ["0x754a2bAe5b5eEE723409A1d0013377927Fd5F539", "0x8B0E7153BF7C3706D85C524e440066559A6656c9"]
+    # a single log per eth_getLogs call, windows shrink until they fit
+    chain = StubChain(chain_id=97, max_logs=1)
+    token = chain.deploy_token(SENDER, 100 * 10**18)
+    airdrop_db(token, [(recipients[i % 2], i) for i in range(1, 5)])
+
+    with StubNode(chain.methods()) as node:
+        Config.update(web3_node=node.url).execute()
+        ad.sign(gas_limit=60000, chain_id=97)
+        txs = list(Tx.select().order_by(Tx.nonce))
+        # nonce 0 was marked as sent, nonce 1 was sent right before a crash
+        for tx in txs[:2]:
+            chain.send_raw_transaction(['0x' + bytes(tx.signed_tx).hex()])
+        Tx.update(status='SENT', tx_hash=keccak(bytes(txs[0].signed_tx))).where(Tx.id == txs[0].id).execute()
+        # the recipient of nonce 3 was paid by hand, someone else got tokens too
+        chain.transfer(SENDER, recipients[0], 4 * 10**18)
+        chain.transfer(SENDER, "0x" + "77" * 20, 10**18)
+        ad.add_recepient(recipients[1], 5)
+
+        capsys.readouterr()
+        ad.reconcile()
+        out = capsys.readouterr().out
+        assert "Mined: 1 sent txs, 1 signed txs sent before a crash." in out
+        assert "Already paid by other txs: 1 recipients." in out
+        assert "use command 'update'" in out
+        assert "Transfers matching no recipient: 1." in out
+        assert "0x" + "77" * 20 in out
+        assert node.calls.count('eth_getLogs') > 4
+
+    txs = {tx.recipient.amount: tx for tx in Tx.select()}
+    assert [txs[amount].status for amount in (1, 2, 3, 4, 5)] == ['MINED', 'MINED', 'SIGNED', 'MINED', 'NEW']
+    assert txs[2].tx_hash == keccak(bytes(txs[2].signed_tx))
+    assert txs[4].nonce is None
+    assert txs[4].tx_receipt['status'] == 1
+
+
+def test_reconcile_skips_mined_txs(airdrop_db, capsys):
+    chain = StubChain(chain_id=97)
+    token = chain.deploy_token(SENDER, 100 * 10**18)
+    # the same recipient and amount twice, only the first one is paid
+    airdrop_db(token, [(RECIPIENT, 1)] * 2)
+
+    with StubNode(chain.methods()) as node:
+        Config.update(web3_node=node.url).execute()
+        ad.sign(gas_limit=60000, chain_id=97)
+        first, second = Tx.select().order_by(Tx.nonce)
+        chain.transfer(SENDER, "0x" + "77" * 20, 10**18)
+        tx_hash = chain.send_raw_transaction(['0x' + bytes(first.signed_tx).hex()])
+        receipt = chain.methods()['eth_getTransactionReceipt']([tx_hash])
+        Tx.update(status='MINED', tx_receipt=receipt).where(Tx.id == first.id).execute()
+
+        capsys.readouterr()
+        ad.reconcile()
+        out = capsys.readouterr().out
+        # the scan starts at the block of the mined tx, the earlier transfer is not in it
+        assert f"Scanned blocks {int(receipt['blockNumber'], 16)}-" in out
+        assert "Already paid by other txs: 0 recipients." in out
+        assert "Transfers matching no recipient" not in out
+
+    second = Tx.get_by_id(second.id)
+    assert second.status == 'SIGNED' and second.nonce == 1
+
+
+def test_recover_after_crash_while_sending(airdrop_db, monkeypatch, capsys):
+    recipient = "0x754a2bAe5b5eEE723409A1d0013377927Fd5F539"
+    chain = StubChain(chain_id=97)
+    token = chain.deploy_token(SENDER, 100 * 10**18)
+    airdrop_db(token, [(recipient, 1)] * 6)
+    monkeypatch.setattr(ad, 'preflight_before_send', lambda *args: True)
+
+    with StubNode(chain.methods()) as node:
+        Config.update(web3_node=node.url).execute()
+        ad.sign(gas_limit=60000, chain_id=97)
+        txs = list(Tx.select().order_by(Tx.nonce))
+        # hashes are known before anything is sent
+        assert all(bytes(tx.tx_hash) == keccak(bytes(tx.signed_tx)) for tx in txs)
+
+        # the process dies right after the node took the tx with nonce 1
+        send_raw_tx = ad.send_raw_tx
+
+        def crashing(web3_node, signed_tx):
+            tx_hash = send_raw_tx(web3_node, signed_tx)
+            if bytes(signed_tx) == bytes(txs[1].signed_tx):
+                raise ConnectionError('crash')
+            return tx_hash
+
+        monkeypatch.setattr(ad, 'send_raw_tx', crashing)
+        try:
+            ad.send(window=1, all=True)
+        except ConnectionError:
+            pass
+        monkeypatch.setattr(ad, 'send_raw_tx', send_raw_tx)
+        assert Tx.get(txs[1].id).status == 'BROADCASTING'
+
+        # an older crash: nonce 3 reached the node before nonce 2, nonce 2 was journaled only
+        Tx.update(status='BROADCASTING').where(Tx.id.in_([txs[2].id, txs[3].id])).execute()
+        chain.send_raw_transaction(['0x' + bytes(txs[3].signed_tx).hex()])
+        capsys.readouterr()
+        ad.recover()
+        assert "1 mined, 1 pending on the node are SENT, 1 unknown to the node are SIGNED again." \
+            in capsys.readouterr().out
+        assert [Tx.get(tx.id).status for tx in txs] == ['MINED', 'MINED', 'SIGNED', 'SENT', 'SIGNED', 'SIGNED']
+        assert Config.get(1).current_nonce == 4
+        ad.recover()
+        assert "Nothing to recover." in capsys.readouterr().out
+
+        # the next send resumes without nonce errors and pays everyone once
+        Tx.update(status='BROADCASTING').where(Tx.id == txs[4].id).execute()
+        ad.send(window=2, all=True)
+        ad.get_receipt(all=True, poll_interval=0)
+
+    assert all(tx.status == 'MINED' for tx in Tx.select())
+    assert chain.token_balance(recipient) == 6 * 10**18
+    assert chain.nonces[SENDER.lower()] == 6
+
+
+def test_receipts_pushed_by_new_heads(airdrop_db, capsys, tmp_path):
+    recipient = "0x754a2bAe5b5eEE723409A1d0013377927Fd5F539"
+    chain = StubChain(chain_id=97)
+    token = chain.deploy_token(SENDER, 100 * 10**18)
+    airdrop_db(token, [(recipient, 1)] * 8)
+
+    ws = StubPushNode(chain.methods(), head=lambda: chain.block).start()
+    with StubNode(chain.methods()) as node:
+        ad.set_node_address(node.url, ws.url)
+        assert Config.get(1).web3_node == f"{node.url},{ws.url}"
+        ad.run(gas_limit=60000, chain_id=97, window=4, poll_interval=0.01)
+        assert all(tx.status == 'MINED' for tx in Tx.select())
+        assert 'eth_subscribe' in ws.calls and ws.notifications >= 8
+        # one receipt per mined tx, besides the first poll, instead of polling every pending tx
+        assert node.calls.count('eth_getTransactionReceipt') <= 8 + 4
+        assert 'eth_getBlockByNumber' in node.calls
+
+        # send --all waits for every receipt in a thread of its own
+        ad.add_recepient(recipient, 2)
+        ad.sign(gas_limit=60000, chain_id=97)
+        calls = len(node.calls)
+        ad.send(window=2, all=True)
+        assert Tx.select().where(Tx.status == 'MINED').count() == 9
+        assert node.calls[calls:].count('eth_getTransactionReceipt') == 1
+
+        # subscription is gone, receipts are polled
+        Tx.update(status='SENT').where(Tx.nonce == 8).execute()
+        ws.stop()
+        ad.get_receipt(all=True, poll_interval=0.01)
+        assert Tx.get(Tx.nonce == 8).status == 'MINED'
+
+    heads.close_watchers()
+    ipc = str(tmp_path / 'node.ipc')
+    with StubNode(chain.methods()) as node, StubPushNode(chain.methods(), head=lambda: chain.block, path=ipc):
+        ad.set_node_address(ipc)
+        assert 'Add an HTTP endpoint too.' in capsys.readouterr().out
+        ad.set_node_address(node.url, ipc)
+        assert Config.get(1).web3_node == f"{node.url},{ipc}"
+        Tx.update(status='SENT').where(Tx.nonce == 8).execute()
+        ad.get_receipt(all=True, poll_interval=0.01)
+        assert Tx.get(Tx.nonce == 8).status == 'MINED'
+    heads.close_watchers()
+
+    # blocks the HTTP node is behind on are asked again after the next head, not in a loop
+    watcher = heads.HeadWatcher(None, None)
+    watcher.alive, watcher.head = True, 100
+    passes = []
+    watcher.included = lambda hashes, from_block, to_block: passes.append(from_block) or ({}, 90)
+    assert watcher.wait_included(b'\x01' * 32, 0.2) is None
+    assert len(passes) == 1
+
+
+def test_send_stops_when_tx_fails_on_chain(airdrop_db, capsys):
+    chain = StubChain(chain_id=97)
+    token = chain.deploy_token(SENDER, 100 * 10**18)
+    airdrop_db(token, [(RECIPIENT, 1)] * 10)
+
+    methods = chain.methods()
+    send_raw = methods['eth_sendRawTransaction']
+
+    def drain_after_third(params):
+        tx_hash = send_raw(params)
+        if chain.nonces[SENDER.lower()] == 3:
+            # tokens spent elsewhere after the preflight
+            chain.token_balances[SENDER.lower()] = 0
+        return tx_hash
+
+    methods['eth_sendRawTransaction'] = drain_after_third
+    with StubNode(methods) as node:
+        Config.update(web3_node=node.url).execute()
+        ad.sign(gas_limit=60000, chain_id=97)
+        ad.send(window=1, all=True)
+
+    assert "Tx with nonce 3 failed on chain. Sending stopped" in capsys.readouterr().out
+    assert [tx.status for tx in Tx.select().order_by(Tx.nonce)] == ['MINED'] * 4 + ['SIGNED'] * 6
+
+
+def test_stats_of_rpc_signing_and_db_writes(airdrop_db, monkeypatch, tmp_path, capsys):
+    chain = StubChain(chain_id=97)
+    token = chain.deploy_token(SENDER, 6 * 10**18)
+    airdrop_db(token, [(RECIPIENT, i) for i in range(1, 4)])
+
+    metrics.reset()
+    with StubNode(chain.methods()) as node:
+        Config.update(web3_node=node.url).execute()
+        ad.sign(gas_limit=60000, chain_id=97, chunk=2)
+        ad.send(window=2, all=True)
+        rpc.batch_request(node.url, [('eth_unknown', []), ('eth_blockNumber', [])])
+    metrics.save('send', tmp_path)
+
+    prometheus = (tmp_path / metrics.METRICS_FILE).read_text()
+    assert 'airdrop_duration_seconds_count{kind="rpc",name="eth_sendRawTransaction"} 3' in prometheus
+    assert 'airdrop_items_total{kind="sign",name="chunk"} 3' in prometheus
+    assert 'airdrop_items_total{kind="db",name="save_signed"} 3' in prometheus
+    assert 'airdrop_errors_total{kind="rpc",name="eth_unknown",code="-32601"} 1' in prometheus
+
+    monkeypatch.setattr(metrics, 'TRACE_FILE', str(tmp_path / metrics.TRACE_FILE))
+    capsys.readouterr()
+    ad.show_stats(format='json')
+    stats = json.loads(capsys.readouterr().out)
+    assert stats['run']['command'] == 'send'
+    rows = {(row['kind'], row['name']): row for row in stats['stats']}
+    assert rows['sign', 'chunk']['count'] == 2
+    assert rows['db', 'mark_sent']['count'] == 3
+    assert rows['rpc', 'eth_unknown']['errors'] == {'-32601': 1}
+
+    ad.show_stats()
+    assert "Last run: 'send'" in capsys.readouterr().out
+    metrics.reset()
@@ -0,0 +1,83 @@
+import json
+import pytest
+import requests
+from web3 import Web3
+from rpc import EndpointPool, PooledProvider, batch_request, parse_endpoints
+from rpc_stub import StubNode
+
+
+def block_number(_):
+    return '0x10'
+
+
+def test_parse_endpoints():
+    assert parse_endpoints("http://a:8545/") == ["http://a:8545/"]
+    assert parse_endpoints("http://a:8545/, http://b:8545/ http://c/") == [
+        "http://a:8545/", "http://b:8545/", "http://c/"]
+
+
+def test_pool_reuses_connection():
+    with StubNode({'eth_blockNumber': block_number}) as node:
+        pool = EndpointPool([node.url])
+        w3 = Web3(PooledProvider(pool))
+        for _ in range(10):
+            assert w3.eth.block_number == 16
+
+        stats = pool.stats()[0]
+        assert stats['requests'] == 10
+        assert stats['errors'] == 0
+        assert stats['connections'] == 1
+        assert node.connections == 1
+
+
+def test_pool_fails_over_to_alive_endpoint():
+    dead = StubNode().start()
+    dead_url = dead.url
+    dead.stop()
+
+    with StubNode({'eth_blockNumber': block_number}) as node:
+        pool = EndpointPool([dead_url, node.url])
+        w3 = Web3(PooledProvider(pool))
+        for _ in range(10):
+            assert w3.eth.block_number == 16
+
+        dead_stats, alive_stats = pool.stats()
+        assert alive_stats['requests'] == 10
+        assert alive_stats['errors'] == 0
+        assert dead_stats['errors'] == dead_stats['requests']
+        # the dead endpoint is tried less and less
+        assert dead_stats['requests'] < 10
+        assert dead_stats['health'] < alive_stats['health']
+
+
+def test_pool_raises_when_all_endpoints_fail():
+    dead = StubNode().start()
+    dead.stop()
+
+    pool = EndpointPool([dead.url])
+    with pytest.raises(requests.ConnectionError):
+        pool.post(json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'eth_blockNumber', 'params': []}))
+
+
+def test_pool_prefers_faster_endpoint():
+    with StubNode({'eth_blockNumber': block_number}, latency=0.03) as slow, \
+            StubNode({'eth_blockNumber': block_number}) as fast:
+        pool = EndpointPool([slow.url, fast.url])
+        w3 = Web3(PooledProvider(pool))
+        for _ in range(40):
+            w3.eth.block_number
+
+        assert fast.http_requests > slow.http_requests
+
+
+def test_batch_request_matches_responses_by_id():
+    with StubNode({'eth_getBalance': lambda params: hex(len(params[0]))}) as node:
+        results = batch_request(node.url, [
+            ('eth_getBalance', ['0x01', 'latest']),
+            ('eth_unknown', []),
+            ('eth_getBalance', ['0x0102', 'latest']),
+        ])
+        assert results[0] == '0x4'
+        assert results[1].code == -32601
+        assert results[2] == '0x6'
+        assert node.http_requests == 1
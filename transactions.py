@@ -0,0 +1,215 @@
+import os
+import re
+import json
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from functools import lru_cache
+
+import metrics
+
+# eth_* packages take hundreds of milliseconds to import,
+# they are imported by the functions that need them
+
+
+ABI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tokens_abi')
+TOKEN_DECIMALS = 18
+
+# gas of disperseToken call without recipients: base tx cost, calldata header,
+# transferFrom of the total to the contract
+DISPERSE_BASE_GAS = 80000
+APPROVE_GAS = 100000
+# typical gas used by an ERC-20 transfer, for estimates before anything is signed
+TRANSFER_GAS = 52000
+# keccak of Transfer(address,address,uint256)
+TRANSFER_TOPIC = '0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
+
+
+@lru_cache(maxsize=None)
+def load_abi(name):
+    with open(os.path.join(ABI_DIR, f'{name}.abi'), 'r') as file:
+        return json.load(file)
+
+
+def keccak(data):
+    from Crypto.Hash import keccak as keccak_256
+    return keccak_256.new(data=data, digest_bits=256).digest()
+
+
+def to_checksum_address(address):
+    """EIP-55 mixed case address."""
+    hex_address = address[2:].lower()
+    digest = keccak(hex_address.encode()).hex()
+    return '0x' + ''.join(char.upper() if int(bit, 16) >= 8 else char
+                          for char, bit in zip(hex_address, digest))
+
+
+def is_checksum_address(address):
+    return (isinstance(address, str)
+            and re.fullmatch('0x[0-9a-fA-F]{40}', address) is not None
+            and address == to_checksum_address(address))
+
+
+@lru_cache(maxsize=None)
+def function_selector(abi_name, fn_name):
+    from eth_utils import function_abi_to_4byte_selector
+
+    for item in load_abi(abi_name):
+        if item.get('type') == 'function' and item.get('name') == fn_name:
+            return '0x' + function_abi_to_4byte_selector(item).hex()
+    raise KeyError(f'{fn_name} is not in {abi_name} ABI')
+
+
+def to_token_units(amount):
+    return int(Decimal(str(amount)) * 10**TOKEN_DECIMALS)
+
+
+def encode_transfer(recipient_address, value):
+    """
+    Calldata of ERC-20 transfer(address,uint256).
+    Both arguments are static, so each one is a single left-padded 32-byte word.
+    """
+    return (function_selector('ERC20', 'transfer')
+            + recipient_address[2:].lower().rjust(64, '0')
+            + format(value, '064x'))
+
+
+def encode_approve(spender, value):
+    return (function_selector('ERC20', 'approve')
+            + spender[2:].lower().rjust(64, '0')
+            + format(value, '064x'))
+
+
+def encode_disperse(token, recipients):
+    """Calldata of disperseToken(token, addresses, values) for (address, value) recipients."""
+    from eth_abi import encode_abi
+
+    addresses = [address for address, _ in recipients]
+    values = [value for _, value in recipients]
+    return (function_selector('Disperse', 'disperseToken')
+            + encode_abi(['address', 'address[]', 'uint256[]'], [token, addresses, values]).hex())
+
+
+def disperse_batch_size(block_gas_limit, gas_budget, recipient_gas, max_size=None):
+    """
+    Number of recipients per disperse tx, so that one tx takes at most
+    gas_budget share of the block gas limit.
+    """
+    size = int((block_gas_limit * gas_budget - DISPERSE_BASE_GAS) // recipient_gas)
+    if max_size is not None:
+        size = min(size, max_size)
+    return max(size, 1)
+
+
+def disperse_gas(batch_len, recipient_gas):
+    return DISPERSE_BASE_GAS + batch_len * recipient_gas
+
+
+def build_call(template, to, data, gas, nonce):
+    raw_tx = dict(template)
+    raw_tx['to'] = to
+    raw_tx['gas'] = gas
+    raw_tx['nonce'] = nonce
+    raw_tx['data'] = data
+    return raw_tx
+
+
+def encode_balance_of(address):
+    return function_selector('ERC20', 'balanceOf') + address[2:].lower().rjust(64, '0')
+
+
+def address_topic(address):
+    return '0x' + address[2:].lower().rjust(64, '0')
+
+
+def decode_transfer_log(log):
+    """(from, to, value) of Transfer log, addresses in lower case."""
+    topics = log['topics']
+    return '0x' + topics[1][-40:].lower(), '0x' + topics[2][-40:].lower(), int(log['data'], 16)
+
+
+def call_params(raw_tx):
+    """eth_call params of signed raw tx, numbers are hex encoded as JSON-RPC wants."""
+    return {
+        'from': raw_tx['from'],
+        'to': raw_tx['to'],
+        'data': raw_tx['data'],
+        'gas': hex(raw_tx['gas']),
+        'value': hex(raw_tx.get('value', 0)),
+    }
+
+
+def transfer_call(sender, token, recipient_address, amount):
+    """eth_call and eth_estimateGas params of a transfer of amount tokens."""
+    return {
+        'from': sender,
+        'to': token,
+        'data': encode_transfer(recipient_address, to_token_units(amount)),
+    }
+
+
+def transfer_template(sender, token, gas, fees, chain_id):
+    """fees is {'gasPrice': ...} or type 2 {'maxFeePerGas': ..., 'maxPriorityFeePerGas': ...}."""
+    template = {
+        'from': sender,
+        'to': token,
+        'value': 0,
+        'gas': gas,
+        'chainId': chain_id,
+    }
+    template.update(fees)
+    return template
+
+
+def build_transfer(template, recipient_address, amount, nonce):
+    raw_tx = dict(template)
+    raw_tx['nonce'] = nonce
+    raw_tx['data'] = encode_transfer(recipient_address, to_token_units(amount))
+    return raw_tx
+
+
+def sign_raw_tx(raw_tx, private_key):
+    from eth_account import Account
+
+    return Account.sign_transaction(raw_tx, private_key).rawTransaction
+
+
+def sign_chunk(private_key, items):
+    """Signs (tx_id, raw_tx) items, runs in a worker process."""
+    return [(tx_id, raw_tx, bytes(sign_raw_tx(raw_tx, private_key))) for tx_id, raw_tx in items]
+
+
+def timed_sign_chunk(private_key, items):
+    """sign_chunk returning its duration too, measured in the worker process."""
+    started = time.perf_counter()
+    signed = sign_chunk(private_key, items)
+    return time.perf_counter() - started, signed
+
+
+def observed(result):
+    seconds, signed = result
+    metrics.observe('sign', 'chunk', seconds, len(signed))
+    return signed
+
+
+def sign_chunks(private_key, chunks, workers=1):
+    """
+    Signs every chunk of (tx_id, raw_tx) items and yields lists of
+    (tx_id, raw_tx, signed_tx) in the same order as chunks come.
+    With several workers chunks are signed in a process pool, keeping
+    only a couple of chunks per worker in flight.
+    """
+    if workers <= 1:
+        for items in chunks:
+            yield observed(timed_sign_chunk(private_key, items))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for items in chunks:
+            pending.append(pool.submit(timed_sign_chunk, private_key, items))
+            if len(pending) >= workers * 2:
+                yield observed(pending.popleft().result())
+        while pending:
+            yield observed(pending.popleft().result())